@@ -1,17 +1,59 @@
+import eventlet
+eventlet.monkey_patch()
+
+import gzip
 import os
 import subprocess
-import sqlite3
-import hashlib
-from datetime import datetime
-from pathlib import Path
-from flask import Flask, render_template_string, request, session, redirect, jsonify
-from flask_socketio import SocketIO, emit
-import threading
+import json
+import secrets
+import socket
 import time
+from datetime import datetime, timezone
+from pathlib import Path
+from flask import Flask, Response, abort, request, session, redirect, jsonify
+from werkzeug.utils import secure_filename
+from flask_socketio import SocketIO, emit, join_room
+from db import (open_database, create_schema, RECENT_FILE_SQL, PROJECT_LIBRARIES_SQL,
+                INSERT_RUN_STATS_SQL)
+from logsink import open_log_sink
+from logstore import open_log_store
+from streaming import (FRAME_WINDOW, INTERACTIVE_WINDOW, OutputStream, client_bucket,
+                       forget_client, pump)
+from scheduler import ExecutionScheduler, SchedulerBusy
+from warmpool import open_warm_pool
+from envs import EnvironmentManager, WheelStore
+from documents import VersionMismatch, open_document_store
+from blobstore import BlobStore, content_hash, encode_content
+from identity import IdentityCache
+from installs import Installer, describe as describe_install, is_install, latest_versions, parse_install
+from cleanup import open_cleanup_engine
+from runcache import RunCache
+from workspace import FIELDS as WORKSPACE_FIELDS, BadPath, Workspace, clean_path, short_hash
+from assets import MIN_COMPRESS, AssetStore
+from metrics import REGISTRY, Counter, Gauge, SamplingProfiler, timed
+from sandbox import Cgroups, Limits, RunGuard
+from terminals import (TerminalLimit, open_pty, open_terminal_manager, set_winsize, tty_preexec,
+                       write_all)
+from mq import CONTROL_CHANNEL, open_message_queue
+import export
+
+# একাধিক প্রসেসে চালাতে: CYBER20UN_MESSAGE_QUEUE=unix:///path/mq.sock বা redis://...
+# এবং CYBER20UN_EXECUTION=workers দিলে রান/কমান্ড worker.py প্রসেসে চলে
+MESSAGE_QUEUE_URL = os.environ.get('CYBER20UN_MESSAGE_QUEUE')
+EXECUTION_WORKERS = os.environ.get('CYBER20UN_EXECUTION') == 'workers'
+PORT = int(os.environ.get('CYBER20UN_PORT', 5000))
+DEBUG = os.environ.get('CYBER20UN_DEBUG', '1') != '0'
+message_queue = open_message_queue(MESSAGE_QUEUE_URL)
+
+# Identifies this process in stream ids and control messages
+PROCESS_ID = secrets.token_hex(4)
 
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)
 app.secret_key = 'cyber_20_un_secret_key_2024'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", **message_queue.socketio_options())
+# Behind several web processes a client must keep one connection, so
+# skip long-polling (which would need sticky routing)
+SOCKET_OPTIONS = {'transports': ['websocket']} if message_queue.url else {}
 
 # ডাটাবেজ এবং ডিরেক্টরি সেটআপ
 DB_PATH = 'cyber20un.db'
@@ -26,83 +68,12 @@ HTML_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
     <title>Cyber 20 UN | Dual Terminal IDE</title>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.js"></script>
+    <script src="{{ asset('vendor/socket.io.min.js') }}"></script>
     <link href="https://fonts.googleapis.com/css2?family=Fira+Code:wght@400;500&family=Poppins:wght@300;400;600;700&display=swap" rel="stylesheet">
-    <script src="https://unpkg.com/lucide@latest"></script>
-    <style>
-        :root {
-            --bg: #020617; --purple: #8b5cf6; --blue: #3b82f6; --cyan: #06b6d4;
-            --text: #f8fafc; --glass: rgba(15, 23, 42, 0.8); --border: rgba(255, 255, 255, 0.1);
-        }
-        * { box-sizing: border-box; transition: all 0.3s ease; }
-        body {
-            margin: 0; font-family: 'Poppins', sans-serif; background: var(--bg);
-            color: var(--text); min-height: 100vh; overflow-x: hidden;
-            display: flex; flex-direction: column;
-        }
-        #bgCanvas { position: fixed; top: 0; left: 0; z-index: -1; }
-        .container { width: 100%; padding: 15px; margin-top: 10px; position: relative; z-index: 1; }
-        
-        .header { 
-            display: flex; justify-content: space-between; align-items: center; 
-            background: var(--glass); padding: 12px 20px; border-radius: 20px;
-            border: 1px solid var(--border); margin-bottom: 20px;
-        }
-        .logo-text { font-size: 18px; font-weight: 800; background: linear-gradient(to right, var(--purple), var(--cyan)); -webkit-background-clip: text; -webkit-text-fill-color: transparent; }
-
-        .card { background: var(--glass); backdrop-filter: blur(15px); border: 1px solid var(--border); border-radius: 24px; padding: 20px; margin-bottom: 20px; }
-        
-        textarea {
-            background: rgba(0, 0, 0, 0.4); border: 1px solid var(--border); color: #10b981; padding: 15px; border-radius: 15px;
-            width: 100%; font-family: 'Fira Code', monospace; font-size: 13px; height: 200px; outline: none; margin-top: 10px;
-        }
-
-        /* Terminal Styles */
-        .terminal-container { display: flex; flex-direction: column; gap: 15px; }
-        .terminal-box {
-            background: #000; color: #a5f3fc; height: 160px; overflow-y: auto; padding: 12px; border-radius: 15px;
-            font-family: 'Fira Code', monospace; font-size: 11px; border: 1px solid var(--border); line-height: 1.4;
-        }
-        .term-lib { border-color: var(--purple); }
-        .term-out { border-color: var(--cyan); }
-        
-        .term-label { font-size: 12px; font-weight: 600; margin-bottom: 5px; display: flex; align-items: center; gap: 6px; }
-
-        .cmd-input-group { display: flex; gap: 8px; margin-top: 10px; }
-        input[type="text"] { background: rgba(0, 0, 0, 0.3); border: 1px solid var(--border); color: var(--text); padding: 10px; border-radius: 10px; flex-grow: 1; font-size: 13px; outline: none; }
-        .btn { background: linear-gradient(45deg, var(--purple), var(--blue)); color: white; border: none; padding: 10px 18px; border-radius: 10px; font-weight: 700; cursor: pointer; display: flex; align-items: center; justify-content: center; gap: 6px; }
-        .btn-play { width: 100%; margin-top: 10px; }
-
-        .log-success { color: #10b981; }
-        .log-error { color: #ef4444; }
-        .spin { animation: spin 1s linear infinite; }
-        @keyframes spin { to { transform: rotate(360deg); } }
-        
-        /* Login Form */
-        .login-form {
-            max-width: 400px;
-            margin: 100px auto;
-            padding: 30px;
-            background: var(--glass);
-            border-radius: 20px;
-            text-align: center;
-        }
-        .login-form input {
-            width: 100%;
-            margin: 10px 0;
-            padding: 12px;
-            border-radius: 10px;
-            background: rgba(0,0,0,0.3);
-            border: 1px solid var(--border);
-            color: var(--text);
-        }
-        .login-btn {
-            width: 100%;
-            margin-top: 20px;
-        }
-    </style>
+    <script src="{{ asset('vendor/lucide.min.js') }}"></script>
+    <link rel="stylesheet" href="{{ asset('app.css') }}">
 </head>
-<body>
+<body data-socket-options='{{ socket_options|tojson }}'>
     <canvas id="bgCanvas"></canvas>
     <div class="container">
         <header class="header">
@@ -136,31 +107,35 @@ HTML_TEMPLATE = '''
                 <div style="display:flex; justify-content:space-between; align-items:center;">
                     <div style="display:flex; align-items:center; gap:8px;">
                         <i data-lucide="file-code" size="18" color="var(--purple)"></i>
-                        <input type="text" id="filename" value="{{ default_file }}" style="border:none; background:none; color:white; width:80px; font-weight:600;">
+                        <input type="text" id="filename" value="{{ default_file }}" title="File name; use a/b.py for a file in a folder" style="border:none; background:none; color:white; width:160px; font-weight:600;">
                     </div>
                     <div style="font-size: 12px; opacity: 0.7;">
-                        Project: <strong>{{ session.get('project_name', 'default') }}</strong>
+                        Project: <strong>{{ project_name }}</strong>
                     </div>
                 </div>
-                <textarea id="code" placeholder="# Write code here...">{{ default_content }}</textarea>
+                <div id="file-tree" class="file-tree"></div>
+                <textarea id="code" placeholder="# Write code here..."></textarea>
                 <button onclick="runCode(this)" class="btn btn-play"><i data-lucide="play"></i> Run Code</button>
+                <label style="display:flex; align-items:center; gap:6px; margin-top:8px; font-size:12px; opacity:0.7;" title="Replay the last output if the code, files and libraries are unchanged. Only for scripts that print the same thing every time.">
+                    <input type="checkbox" id="cache-run"> Reuse output of identical runs
+                </label>
             </div>
 
             <div class="terminal-container">
                 <div class="card" style="margin-bottom: 0;">
                     <div class="term-label" style="color: var(--purple);"><i data-lucide="package"></i> Library Installer Logs</div>
-                    <div id="lib-terminal" class="terminal-box term-lib">
+                    <div id="lib-terminal" class="terminal-box term-lib" data-scrollback="{{ scrollback }}">
                         <div style="opacity:0.5;">[WAITING] Install libraries via command...</div>
                     </div>
                     <div class="cmd-input-group">
-                        <input type="text" id="cmd" placeholder="pip install ...">
+                        <input type="text" id="cmd" placeholder="pip install ... / shell command / program input">
                         <button onclick="sendCmd()" class="btn"><i data-lucide="download" size="16"></i></button>
                     </div>
                 </div>
 
                 <div class="card">
                     <div class="term-label" style="color: var(--cyan);"><i data-lucide="terminal"></i> Execution Output</div>
-                    <div id="out-terminal" class="terminal-box term-out">
+                    <div id="out-terminal" class="terminal-box term-out" data-scrollback="{{ scrollback }}">
                         <div style="opacity:0.5;">[READY] Program output will appear here...</div>
                     </div>
                 </div>
@@ -169,215 +144,185 @@ HTML_TEMPLATE = '''
         {% endif %}
     </div>
 
-    <script>
-        lucide.createIcons();
-        const socket = io();
-
-        // Background
-        const canvas = document.getElementById('bgCanvas');
-        const ctx = canvas.getContext('2d');
-        function resize() { canvas.width = window.innerWidth; canvas.height = window.innerHeight; }
-        window.onresize = resize; resize();
-        function drawBg() { ctx.fillStyle = '#020617'; ctx.fillRect(0,0,canvas.width,canvas.height); requestAnimationFrame(drawBg); }
-        drawBg();
-
-        // --- Dual Terminal Logic ---
-        socket.on('terminal_output', data => {
-            const libTerm = document.getElementById('lib-terminal');
-            const outTerm = document.getElementById('out-terminal');
-            
-            // যদি আউটপুটে pip বা installation সংক্রান্ত কিছু থাকে, তবে লাইব্রেরি টার্মিনালে যাবে
-            if(data.output.toLowerCase().includes('pip') || 
-               data.output.toLowerCase().includes('install') || 
-               data.output.toLowerCase().includes('requirement')) {
-                libTerm.innerHTML += `<div style="margin-bottom:2px;">${data.output}</div>`;
-                libTerm.scrollTop = libTerm.scrollHeight;
-            } else {
-                // বাকি সব আউটপুট এক্সিকিউশন টার্মিনালে যাবে
-                outTerm.innerHTML += `<div style="margin-bottom:2px;">> ${data.output}</div>`;
-                outTerm.scrollTop = outTerm.scrollHeight;
-            }
-        });
-
-        function sendCmd() {
-            const cmdInput = document.getElementById('cmd');
-            if(!cmdInput.value) return;
-            document.getElementById('lib-terminal').innerHTML += `<div style="color:var(--purple);">$ ${cmdInput.value}</div>`;
-            socket.emit('terminal_command', {command: cmdInput.value});
-            cmdInput.value = '';
-        }
-
-        function runCode(btn) {
-            const filename = document.getElementById('filename').value;
-            const content = document.getElementById('code').value;
-            const outTerm = document.getElementById('out-terminal');
-            
-            outTerm.innerHTML = `<div style="color:var(--cyan);">[SYSTEM] Running ${filename}...</div>`;
-            socket.emit('save_file', {filename, content});
-            socket.emit('run_code', {filename});
-            
-            btn.innerHTML = '<i data-lucide="loader" class="spin"></i> Running...';
-            lucide.createIcons();
-            setTimeout(() => { 
-                btn.innerHTML = '<i data-lucide="play"></i> Run Code'; 
-                lucide.createIcons(); 
-            }, 1500);
-        }
-        
-        // Autosave code on change
-        let saveTimer;
-        document.getElementById('code').addEventListener('input', function() {
-            clearTimeout(saveTimer);
-            saveTimer = setTimeout(() => {
-                const filename = document.getElementById('filename').value;
-                const content = document.getElementById('code').value;
-                socket.emit('save_file', {filename, content});
-            }, 1000);
-        });
-    </script>
+    <script src="{{ asset('app.js') }}"></script>
 </body>
 </html>
 '''
 
+# CSS/JS static/ থেকে, একবার লোড ও কম্প্রেস করা; টেমপ্লেট একবার কম্পাইল করা
+STATIC_DIR = Path(__file__).resolve().parent / 'static'
+assets = AssetStore(STATIC_DIR)
+# ক্লায়েন্ট টার্মিনালে সর্বোচ্চ কত লাইন থাকবে
+TERMINAL_SCROLLBACK = 20000
+page = app.jinja_env.from_string(HTML_TEMPLATE, globals={'asset': assets.url,
+                                                         'socket_options': SOCKET_OPTIONS,
+                                                         'scrollback': TERMINAL_SCROLLBACK})
+
 # ডাটাবেজ ইনিশিয়ালাইজেশন
+db = open_database(DB_PATH)
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE,
-                  ip_address TEXT,
-                  project_name TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    # Code files table
-    c.execute('''CREATE TABLE IF NOT EXISTS code_files
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  filename TEXT,
-                  content TEXT,
-                  project_name TEXT,
-                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users(id),
-                  UNIQUE(user_id, filename, project_name))''')
-    
-    # Libraries table
-    c.execute('''CREATE TABLE IF NOT EXISTS libraries
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  package_name TEXT,
-                  version TEXT,
-                  command TEXT,
-                  project_name TEXT,
-                  installed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users(id))''')
-    
-    # Terminal logs table
-    c.execute('''CREATE TABLE IF NOT EXISTS terminal_logs
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  terminal_type TEXT,
-                  command TEXT,
-                  output TEXT,
-                  project_name TEXT,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY (user_id) REFERENCES users(id))''')
-    
-    conn.commit()
-    conn.close()
+    db.write(create_schema)
 
 init_db()
 
-def get_db():
-    return sqlite3.connect(DB_PATH)
+# টার্মিনাল লগ দিন অনুযায়ী আলাদা ফাইলে থাকে; পুরনোগুলো কমপ্রেস ও মুছে ফেলা হয়
+LOG_DIR = Path('logs')
+LOG_RETENTION_DAYS = 30
+log_store = open_log_store(LOG_DIR, period='day', retention_days=LOG_RETENTION_DAYS)
+# Rows written to the main database before partitioning move over once
+socketio.start_background_task(log_store.adopt, db)
+
+# টার্মিনাল লগ ব্যাকগ্রাউন্ডে ব্যাচ করে লেখা হয়
+log_sink = open_log_sink(log_store)
+
+# রান/কমান্ড কিউ: একসাথে সর্বোচ্চ CPU কোর সংখ্যক প্রসেস চলবে
+MAX_CONCURRENT_RUNS = os.cpu_count() or 1
+scheduler = ExecutionScheduler(socketio.start_background_task, max_workers=MAX_CONCURRENT_RUNS)
+
+# আগে থেকে চালু করা Python ইন্টারপ্রেটার, যাতে Run Code দ্রুত শুরু হয়
+WARM_PRELOAD = ('numpy', 'requests')
+warm_pool = open_warm_pool(preload=WARM_PRELOAD)
+
+# ইউজারের কোডের জন্য CPU/মেমোরি/সময়/আউটপুট সীমা
+RUN_LIMITS = Limits(cpu_seconds=30, memory_bytes=512 * 1024 * 1024, wall_seconds=60,
+                    output_bytes=4 * 1024 * 1024)
+# টার্মিনাল শেল: প্রতিটি প্রসেসের সীমা, সময়ের বদলে idle timeout
+SHELL_LIMITS = Limits(cpu_seconds=60, memory_bytes=1024 * 1024 * 1024, wall_seconds=None,
+                      output_bytes=None)
+cgroups = Cgroups()
+
+# ক্যাশ করা রানের আউটপুট (opt-in), LRU by bytes
+RUN_CACHE_BUDGET = 64 * 1024 * 1024
+run_cache = RunCache(budget=RUN_CACHE_BUDGET)
+
+# প্রতিটি প্রজেক্টের আলাদা virtualenv, শেয়ার্ড wheel ক্যাশ থেকে তৈরি
+ENV_DIR = Path('envs')
+WHEEL_DIR = Path('wheels')
+envs = EnvironmentManager(ENV_DIR, WheelStore(WHEEL_DIR))
+
+# কে কোন ইউজার: (username, project) -> id ক্যাশ, একসাথে আসা লগইন একটি কোয়েরি শেয়ার করে
+IDENTITY_TTL = 300
+identity = IdentityCache(db, ttl=IDENTITY_TTL)
 
 def get_or_create_user(username, ip_address, project_name):
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Check if user exists
-    c.execute('SELECT id FROM users WHERE username = ? AND project_name = ?', 
-              (username, project_name))
-    user = c.fetchone()
-    
-    if user:
-        user_id = user[0]
-    else:
-        # Create new user
-        c.execute('INSERT INTO users (username, ip_address, project_name) VALUES (?, ?, ?)',
-                  (username, ip_address, project_name))
-        user_id = c.lastrowid
-    
-    conn.commit()
-    conn.close()
-    return user_id
-
-def save_code_to_db(user_id, filename, content, project_name):
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Save to database
-    c.execute('''INSERT OR REPLACE INTO code_files 
-                 (user_id, filename, content, project_name) 
-                 VALUES (?, ?, ?, ?)''',
-              (user_id, filename, content, project_name))
-    
-    # Also save to file system
-    user_dir = CODE_DIR / str(user_id)
-    user_dir.mkdir(exist_ok=True)
-    
-    file_path = user_dir / filename
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(content)
-    
-    conn.commit()
-    conn.close()
-
-def save_library_to_db(user_id, package_name, version, command, project_name):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO libraries 
-                 (user_id, package_name, version, command, project_name) 
-                 VALUES (?, ?, ?, ?, ?)''',
-              (user_id, package_name, version, command, project_name))
-    conn.commit()
-    conn.close()
+    return identity.user_id(username, project_name, ip_address)
+
+# ফাইলের কনটেন্ট একবারই রাখা হয়, হ্যাশ দিয়ে (একই টেমপ্লেট হাজার ইউজারে একটি কপি)
+blobs = BlobStore(db)
+
+@timed('save_code_to_db')
+def save_code_to_db(user_id, filename, content, project_name, version=0):
+    # Save to database: the row points at the content's blob. user_codes/
+    # is written by workspace.checkout() when a run or shell needs it
+    blobs.save_file(user_id, filename, content, project_name, version)
+
+# এডিটরের ফাইলগুলো মেমোরিতে থাকে, ডেল্টা এডিট দিয়ে আপডেট হয়
+DOCUMENT_CACHE_BUDGET = 64 * 1024 * 1024
+# With several web processes each has its own cache: `shared` makes
+# them check the database's version of a file before trusting theirs
+documents = open_document_store(db, save_code_to_db, budget=DOCUMENT_CACHE_BUDGET,
+                                shared=bool(message_queue.url))
+# প্রজেক্টের ফাইল ট্রি: কনটেন্ট ছাড়া নাম, সাইজ, হ্যাশ
+workspace = Workspace(db, documents, blobs)
+
+# ৩০ দিন অব্যবহৃত প্রজেক্ট মুছে ফেলা হয় (শুধু একটি worker এ চলে)
+PROJECT_TTL = 30 * 24 * 3600
 
+def project_paths(user_id, project_name):
+    return [CODE_DIR / str(user_id), envs.env_dir(user_id)]
+
+def forget_project(user_id, project_name):
+    documents.forget_project(user_id, project_name)
+    warm_pool.discard(str(envs.python(user_id)))
+    forget_client(project_room(user_id, project_name))
+
+cleanup = open_cleanup_engine(db, project_paths, 'cleanup.lock',
+                              on_purge=forget_project, collect=blobs.collect, ttl=PROJECT_TTL)
+
+def save_libraries_to_db(user_id, packages, command, project_name):
+    # Every package of one install in a single write
+    db.executemany('''INSERT INTO libraries 
+                      (user_id, package_name, version, command, project_name) 
+                      VALUES (?, ?, ?, ?, ?)''',
+                   [(user_id, package_name, version, command, project_name)
+                    for package_name, version in packages])
+
+@timed('save_terminal_log')
 def save_terminal_log(user_id, terminal_type, command, output, project_name):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO terminal_logs 
-                 (user_id, terminal_type, command, output, project_name) 
-                 VALUES (?, ?, ?, ?, ?)''',
-              (user_id, terminal_type, command, output, project_name))
-    conn.commit()
-    conn.close()
+    log_sink.record(user_id, terminal_type, command, output, project_name)
+
+def project_libraries(user_id, project_name):
+    with db.reader() as conn:
+        return conn.execute(PROJECT_LIBRARIES_SQL, (user_id, project_name)).fetchall()
+
+def project_python(user_id, project_name):
+    """Python of the project's venv, restored from its libraries if missing."""
+    python = envs.python(user_id)
+    if not python.exists():
+        # One version per package: the newest row, not every row ever installed
+        envs.ensure(user_id, latest_versions(project_libraries(user_id, project_name)).items())
+    return str(python)
+
+# pip install: পার্স করা রিকোয়ারমেন্ট, আগে থেকে থাকলে বাদ, বাকিগুলো সমান্তরালে রিজলভ
+installer = Installer(envs)
+
+def install_packages(job, command, user_id, project_name, room, stream, run_log):
+    """pip install into the project's venv through the shared wheel store."""
+    python = project_python(user_id, project_name)
+    # -r reads the project's saved files
+    documents.snapshot_project(user_id, project_name)
+
+    def read_file(name):
+        try:
+            return blobs.read_file(user_id, project_name, clean_path(name))
+        except BadPath:
+            return None
+
+    def on_event(event):
+        message = describe_install(event)
+        run_log.write(message)
+        socketio.emit('install_progress', {'run': run_log.run_id, 'terminal': 'lib',
+                                           'message': message, **event}, to=room)
+
+    def on_output(data):
+        run_log.feed(data)
+        stream.feed(data)
+
+    try:
+        install_request = parse_install(command, read_file)
+        installed = installer.install(job, user_id, install_request,
+                                      latest_versions(project_libraries(user_id, project_name)),
+                                      on_event, on_output)
+    finally:
+        stream.close()
+    if installed:
+        # Running interpreters for this env have stale imports
+        warm_pool.discard(python)
+        save_libraries_to_db(user_id, installed, command, project_name)
+
+@timed('default_file')
+def default_file(user_id, project_name):
+    """The file last edited, or None for an empty project."""
+    filename = documents.latest(user_id, project_name)
+    if filename is None:
+        with db.reader() as conn:
+            file_data = conn.execute(RECENT_FILE_SQL, (user_id, project_name)).fetchone()
+        filename = file_data[0] if file_data else None
+    return filename
 
+@timed('get_user_data')
 def get_user_data(user_id, project_name):
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get default code file
-    c.execute('''SELECT filename, content FROM code_files 
-                 WHERE user_id = ? AND project_name = ? 
-                 ORDER BY updated_at DESC LIMIT 1''',
-              (user_id, project_name))
-    file_data = c.fetchone()
-    
-    # Get installed libraries
-    c.execute('''SELECT package_name, version FROM libraries 
-                 WHERE user_id = ? AND project_name = ? 
-                 ORDER BY installed_at DESC''',
-              (user_id, project_name))
-    libraries = c.fetchall()
-    
-    conn.close()
+    # Default code file: the one last edited, content served from the
+    # document cache
+    filename = default_file(user_id, project_name)
+    with db.reader() as conn:
+        # Get installed libraries
+        libraries = conn.execute(PROJECT_LIBRARIES_SQL, (user_id, project_name)).fetchall()
     
     return {
-        'default_file': file_data[0] if file_data else 'main.py',
-        'default_content': file_data[1] if file_data else '# Write code here...',
+        'default_file': filename or 'main.py',
+        'default_content': documents.get((user_id, project_name, filename)).content if filename else '# Write code here...',
         'libraries': libraries
     }
 
@@ -385,13 +330,21 @@ def get_user_data(user_id, project_name):
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if 'user_id' in session and 'project_name' in session:
-        user_data = get_user_data(session['user_id'], session['project_name'])
-        return render_template_string(HTML_TEMPLATE, 
-                                    user_id=session['user_id'],
-                                    default_file=user_data['default_file'],
-                                    default_content=user_data['default_content'])
+        # Only the name: the editor fetches contents from the workspace API
+        filename = default_file(session['user_id'], session['project_name'])
+        return page.render(user_id=session['user_id'],
+                           project_name=session['project_name'],
+                           default_file=filename or 'main.py')
     
-    return render_template_string(HTML_TEMPLATE, user_id=None)
+    return page.render(user_id=None)
+
+@app.route('/static/<path:name>')
+def static_asset(name):
+    """Fingerprinted CSS/JS; the URL changes with the content, so cache forever."""
+    response = assets.response(name, request.headers)
+    if response is None:
+        abort(404)
+    return response
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -402,6 +355,7 @@ def login():
         return redirect('/')
     
     user_id = get_or_create_user(username, request.remote_addr, project_name)
+    cleanup.touch(user_id, project_name)
     
     session['user_id'] = user_id
     session['username'] = username
@@ -422,230 +376,715 @@ def api_user_data():
     user_data = get_user_data(session['user_id'], session.get('project_name', 'default'))
     return jsonify(user_data)
 
+# Contents change under the same URL: clients may keep them, but must
+# revalidate (If-None-Match) before using them
+REVALIDATE = 'private, no-cache'
+
+def not_modified(etag, headers=None):
+    """A 304 if the request already has etag, else None."""
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={'ETag': etag, 'Cache-Control': REVALIDATE,
+                                             **(headers or {})})
+    return None
+
+@app.route('/api/workspace')
+@timed('workspace_files')
+def api_workspace():
+    """The project's file tree, without contents."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    project_name = session.get('project_name', 'default')
+    files = workspace.files(session['user_id'], project_name)
+    body = json.dumps({'project': project_name, 'fields': WORKSPACE_FIELDS, 'files': files},
+                      separators=(',', ':')).encode()
+    etag = f'"{short_hash(content_hash(body))}"'
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    headers = {'ETag': etag, 'Cache-Control': REVALIDATE, 'Vary': 'Accept-Encoding'}
+    # Names and numbers compress well; hundreds of files stay a few KB
+    if len(body) >= MIN_COMPRESS and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype='application/json', headers=headers)
+
+@app.route('/api/workspace/files/<path:filename>')
+@timed('workspace_file')
+def api_workspace_file(filename):
+    """One file's content; ETag is its hash, X-File-Version its edit version."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    try:
+        filename = clean_path(filename)
+    except BadPath as e:
+        return jsonify({'error': str(e)}), 400
+    project_name = session.get('project_name', 'default')
+    entry = workspace.entry(session['user_id'], project_name, filename)
+    if entry is None:
+        return jsonify({'error': 'File not found'}), 404
+    
+    # Answered from the index, without loading the content
+    _, _, digest, version, _ = entry
+    response = not_modified(f'"{digest}"', {'X-File-Version': str(version)})
+    if response is not None:
+        return response
+    
+    doc = documents.get((session['user_id'], project_name, filename))
+    with doc.lock:
+        content, version = doc.content, doc.version
+        _, digest = doc.digest()
+    return Response(encode_content(content), mimetype='text/plain',
+                    headers={'ETag': f'"{short_hash(digest)}"', 'Cache-Control': REVALIDATE,
+                             'X-File-Version': str(version)})
+
+@app.route('/api/workspace/snapshots', methods=['GET', 'POST'])
+@timed('workspace_snapshots')
+def api_workspace_snapshots():
+    """The project's snapshots, newest first; POST records one ({"label": ...})."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    user_id, project_name = session['user_id'], session.get('project_name', 'default')
+    if request.method == 'POST':
+        label = (request.get_json(silent=True) or {}).get('label')
+        label = str(label)[:100] if label else None
+        documents.snapshot_project(user_id, project_name)
+        snapshot_id, created = workspace.snapshot(user_id, project_name, label)
+        return jsonify({'id': snapshot_id, 'created': created})
+    return jsonify({'snapshots': workspace.snapshots(user_id, project_name)})
+
+@app.route('/api/workspace/snapshots/<int:snapshot_id>')
+def api_workspace_snapshot(snapshot_id):
+    """A snapshot's [name, size, hash] rows."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    files = workspace.snapshot_files(session['user_id'], session.get('project_name', 'default'),
+                                     snapshot_id)
+    if not files:
+        return jsonify({'error': 'Snapshot not found'}), 404
+    return jsonify({'id': snapshot_id, 'files': files})
+
+@app.route('/api/workspace/snapshots/<int:snapshot_id>/restore', methods=['POST'])
+@timed('workspace_restore')
+def api_workspace_restore(snapshot_id):
+    """Put a snapshot's files back; every tab on the project reloads them."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    user_id, project_name = session['user_id'], session.get('project_name', 'default')
+    names = workspace.restore(user_id, project_name, snapshot_id)
+    if names is None:
+        return jsonify({'error': 'Snapshot not found'}), 404
+    socketio.emit('workspace_restored', {'snapshot': snapshot_id, 'files': names},
+                  to=project_room(user_id, project_name))
+    return jsonify({'id': snapshot_id, 'files': names})
+
+# Prometheus /metrics: gauges read at scrape time, counters and histograms
+# recorded where things happen (metrics.timed, db.py)
+EMITS = Counter('cyber20un_emits_total', 'Socket.IO events emitted by this process', ['event'])
+Gauge('cyber20un_sockets_connected', 'Socket.IO connections on this process').set_function(
+    lambda: len(socketio.server.eio.sockets))
+Gauge('cyber20un_runs_active', 'Runs with a live process in this process').set_function(
+    lambda: len(run_ttys))
+Gauge('cyber20un_shells_open', 'Interactive shells open in this process').set_function(
+    lambda: terminals.stats()['open'])
+Gauge('cyber20un_run_queue_depth', 'Jobs waiting for a free runner').set_function(
+    lambda: scheduler.stats()['queued'])
+Gauge('cyber20un_runs_running', 'Jobs holding a runner slot').set_function(
+    lambda: scheduler.stats()['running'])
+Gauge('cyber20un_log_backlog_rows', 'Sealed terminal log rows waiting to be written').set_function(
+    lambda: log_sink.stats()['pending_rows'])
+Gauge('cyber20un_db_pending_writes', 'Writes queued for the database writer').set_function(
+    lambda: db.stats()['pending_writes'])
+
+def count_emits(manager):
+    """Count every emit this process originates, by event."""
+    emit = manager.emit
+    def counted_emit(event, *args, **kwargs):
+        EMITS.labels(event).inc()
+        return emit(event, *args, **kwargs)
+    manager.emit = counted_emit
+
+count_emits(socketio.server.manager)
+
+# নমুনা প্রোফাইলার: CYBER20UN_PROFILER=1 হলে /debug/profile চালু
+PROFILER_ENABLED = os.environ.get('CYBER20UN_PROFILER') == '1'
+MAX_PROFILE_SECONDS = 60
+profiler = SamplingProfiler()
+
+@app.route('/metrics')
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Sample this process for ?seconds=N and return flamegraph.pl-ready stacks."""
+    if not PROFILER_ENABLED:
+        abort(404)
+    try:
+        seconds = min(float(request.args.get('seconds', 10)), MAX_PROFILE_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'seconds must be a number'}), 400
+    if not profiler.start():
+        return jsonify({'error': 'A profile is already being taken'}), 409
+    try:
+        socketio.sleep(seconds)
+    finally:
+        stacks = profiler.stop()
+    return Response(stacks, mimetype='text/plain',
+                    headers={'X-Profile-Samples': str(profiler.samples)})
+
+@app.route('/api/stats')
+def api_stats():
+    return jsonify({
+        'documents': documents.stats(),
+        'scheduler': scheduler.stats(),
+        'logs': log_store.stats(),
+        'log_sink': log_sink.stats(),
+        'database': db.stats(),
+        'cleanup': cleanup.stats(),
+        'terminals': terminals.stats(),
+        'run_cache': run_cache.stats(),
+        'assets': assets.stats(),
+        'blobs': blobs.stats(),
+        'identity': identity.stats(),
+        'installs': installer.stats(),
+        'workspace': workspace.stats(),
+    })
+
 @app.route('/api/projects')
 def api_projects():
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'})
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''SELECT DISTINCT project_name FROM users 
-                 WHERE username = ? ORDER BY created_at DESC''',
-              (session['username'],))
-    projects = [row[0] for row in c.fetchall()]
-    conn.close()
-    
+    projects = identity.project_names(session['username'], session.get('project_name'))
     return jsonify({'projects': projects})
 
 # WebSocket হ্যান্ডলারস
+def project_room(user_id, project_name):
+    """Every connection (tab) open on a project; runs print here."""
+    return f'project:{user_id}:{project_name}'
+
+def run_room(run_id):
+    """Extra watchers of one run (watch_run); closed when the run ends."""
+    return f'run:{run_id}'
+
 @socketio.on('connect')
 def handle_connect():
     if 'user_id' in session:
-        emit('terminal_output', {'output': f'[SYSTEM] Connected as {session["username"]} ({session["project_name"]})'})
+        user_id, project_name = session['user_id'], session['project_name']
+        join_room(project_room(user_id, project_name))
+        socketio.start_background_task(
+            lambda: warm_pool.prestart(project_python(user_id, project_name)))
+        emit('terminal_output', {'output': f'[SYSTEM] Connected as {session["username"]} ({session["project_name"]})', 'terminal': 'out'})
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    if 'user_id' in session:
+        # Output budgets are per project room: drop it with the room's
+        # last tab here (this sid still counts until the handler returns)
+        room = project_room(session['user_id'], session['project_name'])
+        tabs = socketio.server.manager.get_participants('/', room)
+        if all(sid == request.sid for sid, _ in tabs):
+            forget_client(room)
+
+@socketio.on('watch_run')
+def handle_watch_run(data):
+    """Follow a run's output from outside its project (e.g. a shared link)."""
+    run_id = str(data.get('run', ''))
+    if 'user_id' in session and run_id:
+        join_room(run_room(run_id))
+
+def job_status_sender(user_id, project_name):
+    """Report a job's queue position and state changes to the project's clients."""
+    room = project_room(user_id, project_name)
+    def send_status(job, state, position):
+        socketio.emit('run_status', {'job': job.id, 'state': state, 'position': position}, to=room)
+    return send_status
+
+def run_rooms(run_log):
+    """Rooms a run's output goes to: its project's tabs and its watchers."""
+    user_id, _, _, project_name = run_log.key
+    return [project_room(user_id, project_name), run_room(run_log.run_id)]
+
+def terminal_for(run_log):
+    """The client terminal a run's output goes to: 'lib' for installs, else 'out'."""
+    return 'lib' if run_log.key[1] == 'lib' else 'out'
+
+def report_run_stats(guard, run_log, user_id, project_name, command, room):
+    """Reap a guarded run and send its resource usage to the client and the DB."""
+    stats = guard.finish()
+    if stats['killed']:
+        run_log.write(f"[SANDBOX] Killed: {stats['killed']} limit exceeded")
+    socketio.emit('run_stats', {'run': run_log.run_id, 'command': command,
+                                'terminal': terminal_for(run_log), **stats}, to=room)
+    db.submit(lambda conn: conn.execute(INSERT_RUN_STATS_SQL, (
+        run_log.run_id, user_id, project_name, command, stats['exit_code'], stats['user_cpu'],
+        stats['sys_cpu'], stats['max_rss'], stats['wall_seconds'], stats['bytes_out'],
+        stats['killed'])))
+    return stats
+
+def open_output_stream(kind, run_log, room, window=FRAME_WINDOW):
+    """Frame stream that delivers a child's output to everyone in room."""
+    terminal = terminal_for(run_log)
+    def send_frame(frame):
+        frame['terminal'] = terminal
+        socketio.emit('terminal_frame', frame, to=room)
+    # One budget per project, shared by all its tabs
+    return OutputStream(f'{kind}-{run_log.run_id}', send_frame, client_bucket(room[0]),
+                        window=window)
+
+def replay_run(job, cached, stream, run_log, command, room):
+    """Send a cached run's output on its recorded schedule, then its stats."""
+    for delay, data in cached.schedule():
+        if job.cancelled.is_set():
+            break
+        # Frames still go out on time while we wait for the next chunk
+        due = stream.time_to_flush()
+        if due is not None and due < delay:
+            time.sleep(due)
+            stream.flush()
+            delay -= due
+        time.sleep(delay)
+        run_log.feed(data)
+        stream.feed(data)
+    stream.close()
+    socketio.emit('run_stats', {'run': run_log.run_id, 'command': command,
+                                'terminal': terminal_for(run_log), **cached.stats, 'cached': True},
+                  to=room)
+
+def run_python_code(job, user_id, project_name, filename, cache=False):
+    user_dir = CODE_DIR / str(user_id)
+    file_path = user_dir / filename
+    command = f'python {filename}'
+    run_log = log_sink.open_run(user_id, 'exec', command, project_name)
+    room = run_rooms(run_log)
+    stream = open_output_stream('run', run_log, room)
+    tty_key = (user_id, str(run_log.run_id))
+    try:
+        # The saved files, written out where they changed
+        workspace.checkout(user_id, project_name, user_dir)
+        # Run the code in the project's venv, forked from a warm
+        # interpreter when possible
+        python = project_python(user_id, project_name)
+        recorder = None
+        if cache:
+            cache_key = run_cache.key(user_dir, filename, python,
+                                      project_libraries(user_id, project_name))
+            cached = run_cache.get(cache_key)
+            socketio.emit('run_cache', {'run': run_log.run_id, 'hit': cached is not None,
+                                        'created': cached and cached.created}, to=room)
+            if cached is not None:
+                replay_run(job, cached, stream, run_log, command, room)
+                return
+            recorder = run_cache.recorder()
+        cgroup = cgroups.create(f'run-{run_log.run_id}', RUN_LIMITS)
+        # On a pty, so input() and Ctrl-C work
+        try:
+            process = warm_pool.spawn(python, file_path.resolve(), user_dir,
+                                      RUN_LIMITS, cgroup, tty=True)
+        except OSError:
+            master, slave = open_pty()
+            try:
+                process = subprocess.Popen(
+                    [python, str(file_path.resolve())],
+                    stdin=slave,
+                    stdout=slave,
+                    stderr=slave,
+                    cwd=str(user_dir),
+                    # Like the warm path: the project root is importable
+                    env={**os.environ, 'PYTHONPATH': str(user_dir.resolve())},
+                    start_new_session=True,
+                    preexec_fn=tty_preexec(RUN_LIMITS, cgroup)
+                )
+            except BaseException:
+                os.close(master)
+                raise
+            finally:
+                os.close(slave)
+            process.stdout = os.fdopen(master, 'rb', buffering=0)
+            process.tty = master
+        guard = RunGuard(process, RUN_LIMITS, cgroup)
+        job.attach(guard)
+        run_ttys[tty_key] = process.tty
+
+        # Stream output in coalesced frames
+        def on_data(data):
+            guard.count(data)
+            run_log.feed(data)
+            if recorder is not None:
+                recorder.feed(data)
+        pump(process.stdout, stream, on_data=on_data)
+        stats = report_run_stats(guard, run_log, user_id, project_name, command, room)
+        # A run that read input isn't a function of its files alone
+        if recorder is not None and tty_key not in typed_runs:
+            run_cache.put(cache_key, recorder, stats)
+
+    except Exception as e:
+        error_msg = f'[ERROR] {str(e)}'
+        socketio.emit('terminal_output', {'output': error_msg, 'terminal': 'out'}, to=room)
+        run_log.write(error_msg)
+    finally:
+        run_ttys.pop(tty_key, None)
+        typed_runs.discard(tty_key)
+        run_log.close()
+        socketio.close_room(room[1])
+
+def execute_command(job, user_id, project_name, command):
+    """A pip install job; every other command goes to the project's shell."""
+    run_log = log_sink.open_run(user_id, 'lib', command, project_name)
+    room = run_rooms(run_log)
+    stream = open_output_stream('cmd', run_log, room)
+    try:
+        install_packages(job, command, user_id, project_name, room, stream, run_log)
+    except Exception as e:
+        error_msg = f'[ERROR] Command failed: {str(e)}'
+        socketio.emit('terminal_output', {'output': error_msg, 'terminal': 'lib'}, to=room)
+        save_terminal_log(
+            user_id,
+            'error',
+            command,
+            error_msg,
+            project_name
+        )
+    finally:
+        run_log.close()
+        socketio.close_room(room[1])
+
+# Job kinds an execution worker understands
+RUNNERS = {'run': run_python_code, 'command': execute_command}
+
+# ইন্টারঅ্যাকটিভ টার্মিনাল: প্রজেক্ট প্রতি একটি স্থায়ী শেল
+MAX_SHELLS_PER_USER = 3
+SHELL_IDLE_TIMEOUT = 15 * 60
+
+# pty master of every run in progress in this process, by (user id, run id),
+# and the runs someone typed into
+run_ttys = {}
+typed_runs = set()
+
+def pump_shell(shell):
+    """Stream a shell's output to its project until the shell exits."""
+    user_id, project_name = shell.key
+    run_log = log_sink.open_run(user_id, 'cmd', 'shell', project_name)
+    shell.run_log = run_log
+    room = run_rooms(run_log)
+    stream = open_output_stream('shell', run_log, room, window=INTERACTIVE_WINDOW)
+    def on_data(data):
+        shell.touch()
+        run_log.feed(data)
+    try:
+        pump(shell.output, stream, on_data=on_data)
+    finally:
+        run_log.close()
+        socketio.close_room(room[1])
+        socketio.emit('terminal_output', {'output': '[SYSTEM] Shell closed', 'terminal': 'out'},
+                      to=project_room(user_id, project_name))
+
+terminals = open_terminal_manager(socketio.start_background_task, pump_shell,
+                                  max_per_user=MAX_SHELLS_PER_USER,
+                                  idle_timeout=SHELL_IDLE_TIMEOUT)
+
+def open_shell(user_id, username, project_name, rows=None, cols=None):
+    """The project's shell, started in the project's directory and venv if needed."""
+    user_dir = CODE_DIR / str(user_id)
+    user_dir.mkdir(exist_ok=True)
+    project_python(user_id, project_name)
+    size = {'rows': rows, 'cols': cols} if rows and cols else {}
+    shell, _ = terminals.open(
+        (user_id, project_name), username, user_dir, envs.environ(user_id), SHELL_LIMITS,
+        new_cgroup=lambda: cgroups.create(f'shell-{user_id}-{secrets.token_hex(4)}', SHELL_LIMITS),
+        **size)
+    return shell
+
+def deliver_input(target, data=None, size=None):
+    """Write to (or resize) a run's or shell's pty if it lives in this process."""
+    kind, key = target
+    if kind == 'run':
+        fd = run_ttys.get(tuple(key))
+        if fd is not None and data:
+            typed_runs.add(tuple(key))
+    else:
+        shell = terminals.get(tuple(key))
+        fd = shell.master if shell is not None else None
+        if shell is not None and data:
+            shell.touch()
+    if fd is None:
+        return False
+    try:
+        if size is not None:
+            set_winsize(fd, *size)
+        if data:
+            write_all(fd, data.encode() if isinstance(data, str) else data)
+    except OSError:
+        # The run ended while the input was on its way
+        pass
+    return True
+
+def route_input(target, data=None, size=None):
+    """deliver_input here, or in whichever process holds the pty."""
+    if not deliver_input(target, data, size) and message_queue.url:
+        message_queue.publish(CONTROL_CHANNEL, {'input': target, 'data': data, 'size': size,
+                                                'worker': PROCESS_ID})
+
+def listen_control():
+    """Apply control messages other processes broadcast to this one."""
+    for message in message_queue.listen(CONTROL_CHANNEL):
+        if message.get('worker') == PROCESS_ID:
+            continue
+        if message.get('supersede') is not None:
+            # A newer run of the same file started elsewhere
+            scheduler.cancel_key(tuple(message['supersede']))
+        if message.get('input') is not None:
+            deliver_input(message['input'], message.get('data'), message.get('size'))
+
+if message_queue.url:
+    socketio.start_background_task(listen_control)
+
+def run_job(spec, on_status):
+    """Queue a job spec on this process's scheduler."""
+    runner = RUNNERS[spec['kind']]
+    options = spec.get('options') or {}
+    return scheduler.submit(
+        (spec['user_id'], spec['project_name']),
+        lambda job: runner(job, spec['user_id'], spec['project_name'], spec['arg'], **options),
+        key=spec['key'], on_status=on_status)
+
+def submit_run(kind, user_id, project_name, arg, key=None, options=None):
+    """Run here, or hand the job to the execution workers (worker.py)."""
+    spec = {'kind': kind, 'user_id': user_id, 'project_name': project_name,
+            'arg': arg, 'key': key, 'options': options}
+    if EXECUTION_WORKERS:
+        message_queue.push(spec)
+    else:
+        run_job(spec, job_status_sender(user_id, project_name))
+
+def request_filename(data):
+    """The event's filename, made safe; None (after telling the client) if it isn't."""
+    try:
+        return clean_path(data.get('filename', 'main.py'))
+    except BadPath as e:
+        emit('terminal_output', {'output': f'[ERROR] {e}', 'terminal': 'out'})
+        return None
 
 @socketio.on('save_file')
 def handle_save_file(data):
     if 'user_id' not in session:
         return
     
-    filename = data.get('filename', 'main.py')
+    filename = request_filename(data)
+    if filename is None:
+        return
     content = data.get('content', '')
     project_name = session.get('project_name', 'default')
     
-    save_code_to_db(session['user_id'], filename, content, project_name)
-    emit('terminal_output', {'output': f'[SYSTEM] Saved {filename}'})
+    version = documents.replace((session['user_id'], project_name, filename), content)
+    cleanup.touch(session['user_id'], project_name)
+    emit('file_ack', {'filename': filename, 'version': version})
+    emit('terminal_output', {'output': f'[SYSTEM] Saved {filename}', 'terminal': 'out'})
+
+@socketio.on('open_file')
+def handle_open_file(data):
+    if 'user_id' not in session:
+        return
+    
+    filename = request_filename(data)
+    if filename is None:
+        return
+    project_name = session.get('project_name', 'default')
+    
+    doc = documents.get((session['user_id'], project_name, filename))
+    emit('file_state', {'filename': filename, 'version': doc.version, 'content': doc.content})
+
+@socketio.on('edit_file')
+def handle_edit_file(data):
+    """Apply an autosave delta: ops against the client's last acked version."""
+    if 'user_id' not in session:
+        return
+    
+    filename = request_filename(data)
+    if filename is None:
+        return
+    project_name = session.get('project_name', 'default')
+    key = (session['user_id'], project_name, filename)
+    
+    try:
+        version = documents.edit(key, data.get('version'), data.get('ops', []))
+        cleanup.touch(session['user_id'], project_name)
+    except (VersionMismatch, ValueError, TypeError):
+        # Out of sync: send the server's copy so the client can rebase
+        doc = documents.get(key)
+        emit('file_state', {'filename': filename, 'version': doc.version, 'content': doc.content})
+        return
+    emit('file_ack', {'filename': filename, 'version': version})
 
 @socketio.on('run_code')
+@timed('handle_run_code')
 def handle_run_code(data):
     if 'user_id' not in session:
         return
     
-    filename = data.get('filename', 'main.py')
+    filename = request_filename(data)
+    if filename is None:
+        return
     project_name = session.get('project_name', 'default')
-    user_dir = CODE_DIR / str(session['user_id'])
-    file_path = user_dir / filename
+    user_id = session['user_id']
+    
+    # Make sure the latest edits, of every module it may import, are
+    # saved before running; the run checks them out
+    documents.snapshot_project(user_id, project_name)
+    cleanup.touch(user_id, project_name)
     
-    if not file_path.exists():
-        emit('terminal_output', {'output': f'[ERROR] File {filename} not found'})
+    if workspace.entry(user_id, project_name, filename) is None:
+        emit('terminal_output', {'output': f'[ERROR] File {filename} not found', 'terminal': 'out'})
         return
+    # Every run that changed something is a point in the project's
+    # history; recorded behind, the run doesn't wait for it
+    workspace.snapshot_behind(user_id, project_name)
     
-    def run_python_code():
-        try:
-            # Run the code
-            process = subprocess.Popen(
-                ['python', str(file_path)],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                cwd=str(user_dir)
-            )
-            
-            # Read output in real-time
-            for line in process.stdout:
-                if line.strip():
-                    emit('terminal_output', {'output': line.strip()})
-                    save_terminal_log(
-                        session['user_id'], 
-                        'exec', 
-                        f'python {filename}', 
-                        line.strip(),
-                        project_name
-                    )
-            
-            process.wait()
-            
-        except Exception as e:
-            error_msg = f'[ERROR] {str(e)}'
-            emit('terminal_output', {'output': error_msg})
-            save_terminal_log(
-                session['user_id'], 
-                'exec', 
-                f'python {filename}', 
-                error_msg,
-                project_name
-            )
-    
-    # Run in background thread
-    thread = threading.Thread(target=run_python_code)
-    thread.start()
+    # Queue the run; re-running the same file cancels the previous run
+    try:
+        submit_run('run', user_id, project_name, filename,
+                   key=(user_id, project_name, filename),
+                   options={'cache': bool(data.get('cache'))})
+    except SchedulerBusy:
+        emit('terminal_output', {'output': '[ERROR] Too many runs waiting, try again shortly', 'terminal': 'out'})
 
 @socketio.on('terminal_command')
+@timed('handle_terminal_command')
 def handle_terminal_command(data):
     if 'user_id' not in session:
         return
     
     command = data.get('command', '').strip()
     project_name = session.get('project_name', 'default')
+    user_id = session['user_id']
     
     if not command:
         return
     
-    emit('terminal_output', {'output': f'$ {command}'})
+    # Every tab on the project sees the command its output belongs to
+    is_pip_install = is_install(command)
+    emit('terminal_output', {'output': f'$ {command}', 'terminal': 'lib' if is_pip_install else 'out',
+                             'color': 'var(--purple)'},
+         to=project_room(user_id, project_name))
+    cleanup.touch(user_id, project_name)
     
-    def execute_command():
+    if is_pip_install:
         try:
-            # Check if it's a pip install command
-            is_pip_install = command.startswith('pip install')
-            
-            # Run command
-            process = subprocess.Popen(
-                command,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                cwd=str(CODE_DIR / str(session['user_id']))
-            )
-            
-            # Read output
-            output_lines = []
-            for line in process.stdout:
-                if line.strip():
-                    output = line.strip()
-                    emit('terminal_output', {'output': output})
-                    output_lines.append(output)
-            
-            process.wait()
-            full_output = '\n'.join(output_lines)
-            
-            # Save terminal log
-            terminal_type = 'lib' if is_pip_install else 'cmd'
-            save_terminal_log(
-                session['user_id'],
-                terminal_type,
-                command,
-                full_output,
-                project_name
-            )
-            
-            # If pip install, save library info
-            if is_pip_install:
-                # Parse package name from command
-                parts = command.split()
-                if len(parts) >= 3:
-                    package_name = parts[2]
-                    # Try to extract version
-                    version = 'latest'
-                    if '==' in package_name:
-                        package_name, version = package_name.split('==')
-                    
-                    save_library_to_db(
-                        session['user_id'],
-                        package_name,
-                        version,
-                        command,
-                        project_name
-                    )
-                    
-        except Exception as e:
-            error_msg = f'[ERROR] Command failed: {str(e)}'
-            emit('terminal_output', {'output': error_msg})
-            save_terminal_log(
-                session['user_id'],
-                'error',
-                command,
-                error_msg,
-                project_name
-            )
-    
-    # Run in background thread
-    thread = threading.Thread(target=execute_command)
-    thread.start()
+            submit_run('command', user_id, project_name, command)
+        except SchedulerBusy:
+            emit('terminal_output', {'output': '[ERROR] Too many commands waiting, try again shortly', 'terminal': 'lib'})
+        return
+
+    # Everything else goes to the project's shell, so cd and exports stick
+    try:
+        # The shell sees the files as saved
+        documents.snapshot_project(user_id, project_name)
+        workspace.checkout(user_id, project_name, CODE_DIR / str(user_id))
+        shell = open_shell(user_id, session['username'], project_name,
+                           data.get('rows'), data.get('cols'))
+        if shell.run_log is not None:
+            shell.run_log.write(f'$ {command}')
+        shell.write(command + '\n')
+    except TerminalLimit as e:
+        emit('terminal_output', {'output': f'[ERROR] {e}, close one first', 'terminal': 'out'})
+    except OSError as e:
+        emit('terminal_output', {'output': f'[ERROR] Command failed: {e}', 'terminal': 'out'})
+
+@socketio.on('run_input')
+def handle_run_input(data):
+    """Text typed while a run is waiting on input()."""
+    if 'user_id' not in session:
+        return
+    run_id, text = str(data.get('run', '')), data.get('data', '')
+    if run_id and text:
+        route_input(('run', (session['user_id'], run_id)), text)
+
+@socketio.on('terminal_input')
+def handle_terminal_input(data):
+    """Raw keys for the project's shell, e.g. '\\x03' for Ctrl-C."""
+    if 'user_id' not in session:
+        return
+    text = data.get('data', '')
+    if text:
+        route_input(('shell', (session['user_id'], session['project_name'])), text)
+
+@socketio.on('terminal_resize')
+def handle_terminal_resize(data):
+    if 'user_id' not in session:
+        return
+    try:
+        size = (int(data['rows']), int(data['cols']))
+    except (KeyError, TypeError, ValueError):
+        return
+    route_input(('shell', (session['user_id'], session['project_name'])), size=size)
+    if data.get('run'):
+        route_input(('run', (session['user_id'], str(data['run']))), size=size)
+
+@socketio.on('terminal_close')
+def handle_terminal_close():
+    if 'user_id' not in session:
+        return
+    if terminals.close((session['user_id'], session['project_name'])):
+        emit('terminal_output', {'output': '[SYSTEM] Shell closed', 'terminal': 'out'})
 
 @app.route('/api/export/<username>/<project_name>')
+@timed('export_project')
 def export_project(username, project_name):
-    """Export project data as JSON"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get user ID
-    c.execute('SELECT id FROM users WHERE username = ? AND project_name = ?',
-              (username, project_name))
-    user = c.fetchone()
-    
-    if not user:
+    """Export project data as paginated JSON, or streamed as NDJSON or zip.
+
+    Query parameters: format=json|ndjson|zip, cursor and limit (json
+    pages), logs=1 to include terminal_logs, since/until to bound them.
+    """
+    user_id = identity.find(username, project_name)
+    if user_id is None:
         return jsonify({'error': 'Project not found'})
     
-    user_id = user[0]
+    try:
+        since, until = (parse_log_time(request.args.get(name)) for name in ('since', 'until'))
+        limit = min(int(request.args.get('limit', export.PAGE_ROWS)), export.MAX_API_LIMIT)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid export parameters: {e}'})
     
-    # Get all data
-    c.execute('SELECT filename, content FROM code_files WHERE user_id = ? AND project_name = ?',
-              (user_id, project_name))
-    code_files = [{'filename': row[0], 'content': row[1]} for row in c.fetchall()]
+    # Unsnapshotted edits only live in the document cache
+    documents.snapshot_project(user_id, project_name)
+    options = export.ExportOptions(
+        user_id, username, project_name, datetime.now().isoformat(),
+        include_logs=request.args.get('logs') in ('1', 'true'),
+        since=since, until=until
+    )
     
-    c.execute('SELECT package_name, version, command FROM libraries WHERE user_id = ? AND project_name = ?',
-              (user_id, project_name))
-    libraries = [{'package': row[0], 'version': row[1], 'command': row[2]} for row in c.fetchall()]
+    export_format = request.args.get('format', 'json')
+    if export_format == 'ndjson':
+        return Response(export.ndjson_export(db, log_store, options), mimetype='application/x-ndjson',
+                        headers=attachment(f'{project_name}.ndjson'))
+    if export_format == 'zip':
+        return Response(export.zip_export(db, log_store, options), mimetype='application/zip',
+                        headers=attachment(f'{project_name}.zip'))
     
-    conn.close()
-    
-    return jsonify({
-        'username': username,
-        'project_name': project_name,
-        'code_files': code_files,
-        'libraries': libraries,
-        'exported_at': datetime.now().isoformat()
-    })
+    try:
+        result_page = export.json_page(db, log_store, options, request.args.get('cursor'),
+                                       max(limit, 1))
+    except ValueError as e:
+        return jsonify({'error': str(e)})
+    return jsonify(result_page)
 
-# Cleanup old files periodically
-def cleanup_old_files():
-    """Clean up files older than 30 days"""
-    while True:
-        try:
-            for user_dir in CODE_DIR.iterdir():
-                if user_dir.is_dir():
-                    for file in user_dir.iterdir():
-                        # Check if file is older than 30 days
-                        if file.stat().st_mtime < time.time() - (30 * 24 * 3600):
-                            file.unlink()
-        except:
-            pass
-        
-        time.sleep(24 * 3600)  # Run once per day
-
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
-cleanup_thread.start()
+def parse_log_time(value):
+    """ISO time from the query string as a terminal_logs created_at bound."""
+    if not value:
+        return None
+    # created_at is stored as UTC 'YYYY-MM-DD HH:MM:SS'
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def attachment(filename):
+    return {'Content-Disposition': f'attachment; filename="{secure_filename(filename) or "export"}"'}
 
 if __name__ == '__main__':
     print("=" * 50)
@@ -653,14 +1092,24 @@ if __name__ == '__main__':
     print("=" * 50)
     print(f"Database: {DB_PATH}")
     print(f"Code directory: {CODE_DIR}")
-    print(f"Access URL: http://localhost:5000")
-    print(f"Local network URL: http://{os.popen('hostname -I').read().strip()}:5000")
+    print(f"Access URL: http://localhost:{PORT}")
+    print(f"Local network URL: http://{os.popen('hostname -I').read().strip()}:{PORT}")
     print("=" * 50)
     
-    # Create virtual environment if not exists
-    if not os.path.exists('venv'):
+    # Create the shared base virtual environment if not exists
+    if not envs.base_dir.exists():
         print("Creating virtual environment...")
-        subprocess.run(['python', '-m', 'venv', 'venv'], check=False)
+        envs.base_python()
         print("Virtual environment created at 'venv/'")
     
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True, allow_unsafe_werkzeug=True)
+    # A terminal frame goes out as two small writes (event, then binary
+    # attachment); without TCP_NODELAY the second waits for the client's
+    # delayed ACK, which adds ~40 ms to every keystroke's echo
+    listen = eventlet.listen
+    def listen_nodelay(*args, **kwargs):
+        sock = listen(*args, **kwargs)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    eventlet.listen = listen_nodelay
+
+    socketio.run(app, host='0.0.0.0', port=PORT, debug=DEBUG)
@@ -0,0 +1,130 @@
+"""Static assets: fingerprinted, precompressed once, cached forever by clients.
+
+Every file under static/ is read at startup and served as
+/static/<name>.<hash>.<ext>, so its URL changes whenever its content
+does and responses can carry a one-year immutable Cache-Control. Gzip
+(and brotli, with the brotli package) bodies are built up front; a
+request only picks one by Accept-Encoding and answers If-None-Match
+with 304.
+
+Third-party scripts are vendored into static/vendor/ by
+`python assets.py vendor` (needs network once). Until then the page
+falls back to the pinned CDN URLs in VENDOR.
+"""
+import gzip
+import hashlib
+import mimetypes
+import sys
+import urllib.request
+from pathlib import Path
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Pinned, so a vendored copy and the CDN serve the same file
+VENDOR = {
+    'vendor/socket.io.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.min.js',
+    'vendor/lucide.min.js': 'https://unpkg.com/lucide@0.263.1/dist/umd/lucide.min.js',
+}
+
+CACHE_FOREVER = 'public, max-age=31536000, immutable'
+# Below this, compressing costs more than it saves
+MIN_COMPRESS = 512
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class Asset:
+    """One static file and its precompressed bodies."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        stem, dot, ext = name.rpartition('.')
+        self.url_name = f'{stem}.{self.digest}.{ext}' if dot else f'{name}.{self.digest}'
+        self.etag = f'"{self.digest}"'
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.bodies = {'identity': data}
+        if len(data) >= MIN_COMPRESS and self.mimetype.startswith(COMPRESSIBLE):
+            self.bodies['gzip'] = gzip.compress(data, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(data, quality=11)
+
+    def pick(self, accept_encoding):
+        """(encoding, body): the smallest body the client accepts."""
+        accepted = {part.split(';', 1)[0].strip() for part in accept_encoding.split(',')}
+        options = [(len(body), encoding) for encoding, body in self.bodies.items()
+                   if encoding == 'identity' or encoding in accepted]
+        _, encoding = min(options)
+        return encoding, self.bodies[encoding]
+
+
+class AssetStore:
+    """Fingerprinted assets under root, loaded once."""
+
+    def __init__(self, root, prefix='/static/'):
+        self.root = Path(root)
+        self.prefix = prefix
+        self._by_name = {}
+        self._by_url = {}
+        if self.root.exists():
+            for path in sorted(self.root.rglob('*')):
+                if path.is_file():
+                    self.add(path.relative_to(self.root).as_posix(), path.read_bytes())
+
+    def add(self, name, data):
+        asset = Asset(name, data)
+        self._by_name[name] = asset
+        self._by_url[asset.url_name] = asset
+        return asset
+
+    def url(self, name):
+        """Fingerprinted URL of name, or its CDN URL if it isn't vendored yet."""
+        asset = self._by_name.get(name)
+        if asset is not None:
+            return self.prefix + asset.url_name
+        if name in VENDOR:
+            return VENDOR[name]
+        raise KeyError(f'unknown asset: {name}')
+
+    def response(self, url_name, headers):
+        """Response for a fingerprinted URL; None if there is no such asset."""
+        asset = self._by_url.get(url_name)
+        if asset is None:
+            return None
+        common = {'ETag': asset.etag, 'Cache-Control': CACHE_FOREVER, 'Vary': 'Accept-Encoding'}
+        if asset.etag in headers.get('If-None-Match', ''):
+            return Response(status=304, headers=common)
+        encoding, body = asset.pick(headers.get('Accept-Encoding', ''))
+        response = Response(body, mimetype=asset.mimetype, headers=common)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    def stats(self):
+        return {
+            'assets': len(self._by_name),
+            'bytes': sum(len(a.bodies['identity']) for a in self._by_name.values()),
+            'compressed_bytes': sum(min(len(b) for b in a.bodies.values())
+                                    for a in self._by_name.values()),
+            'vendored': sorted(name for name in VENDOR if name in self._by_name),
+        }
+
+
+def vendor(root):
+    """Download the VENDOR scripts into root."""
+    for name, url in VENDOR.items():
+        path = Path(root) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with urllib.request.urlopen(url, timeout=60) as response:
+            path.write_bytes(response.read())
+        print(f'[assets] {url} -> {path}')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['vendor']:
+        sys.exit('usage: python assets.py vendor [static-dir]')
+    vendor(sys.argv[2] if len(sys.argv) > 2 else Path(__file__).resolve().parent / 'static')
@@ -0,0 +1,1185 @@
+"""Benchmarks for the Cyber 20 UN IDE server.
+
+Usage:
+    python bench.py saves [--threads 8] [--count 2000]
+    python bench.py logs [--lines 100000]
+    python bench.py warm [--runs 50] [--preload json ...]
+    python bench.py runcache [--files 20] [--runs 2000]
+    python bench.py export [--size-mb 1024] [--legacy]
+    python bench.py queries [--projects 2000] [--log-rows 200000]
+    python bench.py scale [--users 50] [--runs 5] [--web 1 2] [--workers 1 2 4]
+    python bench.py pty [--keys 500]
+    python bench.py page [--requests 2000]
+    python bench.py suite [--users 10] [--json results.json] [--baseline base.json --threshold 0.25]
+    python bench.py blobs [--tenants 500] [--files 20] [--saves 40]
+    python bench.py logins [--users 300] [--logins 5000] [--threads 64]
+    python bench.py installs [--packages 50] [--runs 1000]
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from datetime import timedelta
+from pathlib import Path
+
+import blobstore
+from blobstore import BlobStore
+from db import (Database, create_schema, FIND_USER_SQL, RECENT_FILE_SQL,
+                PROJECT_LIBRARIES_SQL, USER_PROJECTS_SQL)
+from documents import LOAD_SQL, LOAD_OPS_SQL
+import export
+from identity import IdentityCache
+from installs import Installer, latest_versions, parse_install
+from logsink import TerminalLogSink
+from logstore import (LogStore, PROJECT_BLOCKS_SQL, PROJECT_SQL, RUN_BLOCKS_SQL, RUN_SQL,
+                      timestamp, utcnow)
+from runcache import RunCache
+from warmpool import WarmPool
+from workspace import TREE_SQL, Workspace
+
+import simple_websocket
+
+SAVE_SQL = '''INSERT OR REPLACE INTO code_files
+              (user_id, filename, content, project_name)
+              VALUES (?, ?, ?, ?)'''
+LEGACY_LOG_SQL = '''INSERT INTO terminal_logs
+                    (user_id, terminal_type, command, output, project_name)
+                    VALUES (?, ?, ?, ?, ?)'''
+
+
+def run_threads(threads, count, fn):
+    """Call fn(i) count times spread over threads; return calls/sec."""
+    per_thread = count // threads
+
+    def worker(t):
+        for i in range(per_thread):
+            fn(t * per_thread + i)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.perf_counter() - started)
+
+
+def bench_saves(args):
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    content = 'print("hello")\n' * 50
+
+    # The original helpers: a fresh connection and commit per call
+    legacy_path = tmp / 'legacy.db'
+    conn = sqlite3.connect(legacy_path)
+    create_schema(conn)
+    conn.commit()
+    conn.close()
+
+    def legacy_save(i):
+        conn = sqlite3.connect(legacy_path, timeout=30)
+        conn.execute(SAVE_SQL, (i % 50, f'file{i}.py', content, 'bench'))
+        conn.commit()
+        conn.close()
+
+    database = Database(tmp / 'pooled.db')
+    database.write(create_schema)
+
+    def pooled_save(i):
+        database.execute(SAVE_SQL, (i % 50, f'file{i}.py', content, 'bench'))
+
+    legacy = run_threads(args.threads, args.count, legacy_save)
+    pooled = run_threads(args.threads, args.count, pooled_save)
+    database.close()
+
+    print(f'legacy per-call connect: {legacy:10.1f} saves/sec')
+    print(f'pooled WAL writer:       {pooled:10.1f} saves/sec')
+    print(f'speedup:                 {pooled / legacy:10.1f}x')
+
+
+def bench_logs(args):
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    lines = [f'line {i}: ' + 'x' * 40 for i in range(args.lines)]
+
+    # One connect/INSERT/commit per output line, as run_python_code did
+    legacy_path = tmp / 'legacy.db'
+    conn = sqlite3.connect(legacy_path)
+    create_schema(conn)
+    conn.commit()
+    conn.close()
+    legacy_lines = lines[:min(len(lines), 2000)]
+    started = time.perf_counter()
+    for line in legacy_lines:
+        conn = sqlite3.connect(legacy_path)
+        conn.execute(LEGACY_LOG_SQL, (1, 'exec', 'python main.py', line, 'bench'))
+        conn.commit()
+        conn.close()
+    legacy = len(legacy_lines) / (time.perf_counter() - started)
+
+    store = LogStore(tmp / 'logs')
+    sink = TerminalLogSink(store)
+    started = time.perf_counter()
+    with sink.open_run(1, 'exec', 'python main.py', 'bench') as run:
+        for line in lines:
+            run.write(line)
+    sink.close()
+    batched = len(lines) / (time.perf_counter() - started)
+    rows = sum(1 for _ in store.iter_run(run.run_id))
+    store.close()
+
+    print(f'legacy row per line:  {legacy:12.1f} lines/sec')
+    print(f'batched log sink:     {batched:12.1f} lines/sec ({rows} rows for {len(lines)} lines)')
+    print(f'speedup:              {batched / legacy:12.1f}x')
+
+    partition, = store.partitions()
+    hot = os.path.getsize(partition.path)
+    started = time.perf_counter()
+    store.compact(partition)
+    elapsed = time.perf_counter() - started
+    cold, = store.partitions()
+    print(f'compaction:           {hot / 1e6:8.1f} MB hot -> {os.path.getsize(cold.path) / 1e6:.1f} MB'
+          f' cold in {elapsed:.2f} s')
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def time_to_first_output(spawn):
+    started = time.perf_counter()
+    process = spawn()
+    os.read(process.stdout.fileno(), 1)
+    elapsed = time.perf_counter() - started
+    process.stdout.read()
+    process.wait()
+    return elapsed
+
+
+def bench_warm(args):
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    script = tmp / 'main.py'
+    script.write_text('print("ready", flush=True)\n')
+    python = shutil.which('python') or sys.executable
+
+    def cold():
+        return subprocess.Popen([python, str(script)], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, cwd=str(tmp))
+
+    pool = WarmPool(preload=args.preload)
+    pool.prestart(python)
+
+    def warm():
+        return pool.spawn(python, script, tmp)
+
+    for name, spawn in (('cold spawn', cold), ('warm fork', warm)):
+        samples = [time_to_first_output(spawn) for _ in range(args.runs)]
+        print(f'{name:10}  p50 {percentile(samples, 50) * 1000:8.2f} ms'
+              f'  p99 {percentile(samples, 99) * 1000:8.2f} ms')
+    pool.close()
+
+
+def bench_runcache(args):
+    """Cost of a cache hit: hashing the project's files plus the lookup."""
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    try:
+        (tmp / 'main.py').write_text('print("hello")\n')
+        for i in range(args.files - 1):
+            (tmp / f'module{i}.py').write_text(f'VALUE = {i}\n' * 200)
+        python = shutil.which('python') or sys.executable
+        libraries = [('numpy', '1.26.4'), ('requests', '2.31.0')]
+        cache = RunCache()
+        key = cache.key(tmp, 'main.py', python, libraries)
+        recorder = cache.recorder()
+        recorder.feed(b'hello\n')
+        cache.put(key, recorder, {'exit_code': 0, 'killed': None})
+
+        samples = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            hit = cache.get(cache.key(tmp, 'main.py', python, libraries))
+            samples.append(time.perf_counter() - started)
+            assert hit is not None
+        print(f'{args.files} files: hit p50 {percentile(samples, 50) * 1e6:8.1f} us'
+              f'  p99 {percentile(samples, 99) * 1e6:8.1f} us')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def build_project(database, store, size_mb, files):
+    """Fill a synthetic project: half code files, half terminal logs."""
+    half = size_mb * 1024 * 1024 // 2
+    line = 'value = compute(value) + 1  # synthetic\n'
+    file_size = max(half // files, 1)
+    content = line * (file_size // len(line) + 1)
+    for i in range(files):
+        database.execute('INSERT INTO code_files (user_id, filename, content, project_name) '
+                         'VALUES (?, ?, ?, ?)', (1, f'file{i}.py', content[:file_size], 'bench'))
+    output = ('x' * 79 + '\n') * 800
+    run = store.new_run_id()
+    created_at = timestamp()
+    for batch in range(max(half // (len(output) * 100), 1)):
+        store.append([(run, batch * 100 + i, 1, 'exec', 'python main.py', output, 'bench',
+                       created_at) for i in range(100)])
+
+
+def legacy_export(database, store):
+    # The original handler: every row in lists, then one JSON document
+    with database.reader() as conn:
+        code_files = [{'filename': r[0], 'content': r[1]} for r in conn.execute(
+            'SELECT filename, content FROM code_files WHERE user_id = 1')]
+    logs = [record for _, record in store.iter_project(1, 'bench', None, None)]
+    yield json.dumps({'code_files': code_files, 'terminal_logs': logs}).encode()
+
+
+def measure_export(chunks):
+    """Drain an export generator; returns (bytes, seconds, peak traced bytes)."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    total = sum(len(chunk) for chunk in chunks)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return total, elapsed, peak
+
+
+def bench_export(args):
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    database = Database(tmp / 'export.db')
+    database.write(create_schema)
+    store = LogStore(tmp / 'logs')
+    build_project(database, store, args.size_mb, args.files)
+    options = export.ExportOptions(1, 'bench', 'bench', 'now', include_logs=True)
+
+    exports = [('ndjson', lambda: export.ndjson_export(database, store, options)),
+               ('zip', lambda: export.zip_export(database, store, options))]
+    if args.legacy:
+        exports.append(('legacy json', lambda: legacy_export(database, store)))
+    print(f'synthetic project: {args.size_mb} MB in {args.files} files plus logs')
+    for name, make in exports:
+        total, elapsed, peak = measure_export(make())
+        print(f'{name:12} {total / 1e6:10.1f} MB out  {elapsed:8.2f} s'
+              f'  peak {peak / 1e6:8.2f} MB')
+    store.close()
+    database.close()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+# (name, sql, params, index the plan must search with)
+QUERY_PLANS = (
+    ('login lookup', FIND_USER_SQL, ('user7', 'project3'), 'sqlite_autoindex_users'),
+    ('latest file', RECENT_FILE_SQL, (7, 'project3'), 'code_files_recent'),
+    ('project libraries', PROJECT_LIBRARIES_SQL, (7, 'project3'), 'libraries_project'),
+    ('user projects', USER_PROJECTS_SQL, ('user7',), 'projects_by_user'),
+    ('document load', LOAD_SQL, (7, 'project3', 'file1.py'), 'code_files_tree'),
+    ('document ops', LOAD_OPS_SQL, (7, 'project3', 'file1.py', 0), 'sqlite_autoindex_code_file_ops'),
+    ('export files page', export.PAGE_SQL['code_files'], (7, 'project3', 0, 200),
+     'code_files_project'),
+    ('file tree', TREE_SQL, (7, 'project3'), 'code_files_tree'),
+    ('blob lookup', blobstore.EXISTS_SQL, ('0' * 64,), 'sqlite_autoindex_blobs'),
+    ('blob garbage', blobstore.GARBAGE_SQL, (1000,), 'blobs_garbage'),
+)
+# The same for log partitions: (name, cold file?, sql, params, index)
+LOG_QUERY_PLANS = (
+    ('run logs', False, RUN_SQL, ('run7', -1, 200), 'terminal_logs_run'),
+    ('project logs', False, PROJECT_SQL,
+     (7, 'project3', 0, '', '9999', 200), 'terminal_logs_project'),
+    ('cold run logs', True, RUN_BLOCKS_SQL, ('run7',), 'log_blocks_run'),
+    ('cold project logs', True, PROJECT_BLOCKS_SQL,
+     (7, 'project3', 0, '', '9999', 200), 'log_blocks_project'),
+)
+
+
+def plan_problems(conn, sql, params, index):
+    """Why a query plan is unacceptable, or [] if it searches `index`."""
+    details = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+    problems = [d for d in details if d.startswith('SCAN') or 'TEMP B-TREE' in d]
+    if not any(d.startswith('SEARCH') and index in d for d in details):
+        problems.append(f'does not search {index}: {details}')
+    return problems
+
+
+def build_tables(database, store, projects, log_rows):
+    per_user = 4
+    users = [(f'user{i // per_user}', f'project{i % per_user}') for i in range(projects)]
+    database.executemany('INSERT INTO users (username, project_name) VALUES (?, ?)', users)
+    database.executemany('INSERT INTO code_files (user_id, filename, content, project_name) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(i // per_user, f'file{f}.py', 'print(1)\n', f'project{i % per_user}')
+                          for i in range(projects) for f in range(5)])
+    database.executemany('INSERT INTO libraries (user_id, package_name, version, project_name) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(i // per_user, f'pkg{p}', '1.0', f'project{i % per_user}')
+                          for i in range(projects) for p in range(3)])
+    database.execute('ANALYZE')
+
+    # Half the logs in a closed, compacted partition, half in today's
+    batch = 10000
+    for created_at in (timestamp(utcnow() - timedelta(days=2)), timestamp()):
+        for start in range(0, log_rows // 2, batch):
+            store.append([(f'run{i % projects}', i, i % projects // per_user, 'exec',
+                           'python main.py', 'output', f'project{i % per_user}', created_at)
+                          for i in range(start, min(start + batch, log_rows // 2))])
+    old, today = store.partitions()
+    store.compact(old)
+    for partition in store.partitions():
+        conn = partition.connect()
+        conn.execute('ANALYZE')
+        conn.close()
+
+
+def bench_queries(args):
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    database = Database(tmp / 'queries.db')
+    database.write(create_schema)
+    store = LogStore(tmp / 'logs')
+    build_tables(database, store, args.projects, args.log_rows)
+    cold, hot = store.partitions()
+
+    def check(conn, name, sql, params, index):
+        problems = plan_problems(conn, sql, params, index)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            conn.execute(sql, params).fetchall()
+        elapsed = (time.perf_counter() - started) / args.repeat
+        status = 'ok' if not problems else 'FAIL'
+        print(f'{name:18} {elapsed * 1e6:10.1f} us  {status}')
+        for problem in problems:
+            print(f'    {problem}')
+        return not problems
+
+    results = []
+    with database.reader() as conn:
+        for name, sql, params, index in QUERY_PLANS:
+            results.append(check(conn, name, sql, params, index))
+    for name, is_cold, sql, params, index in LOG_QUERY_PLANS:
+        conn = (cold if is_cold else hot).connect()
+        results.append(check(conn, name, sql, params, index))
+        conn.close()
+    failed = not all(results)
+    store.close()
+    database.close()
+    shutil.rmtree(tmp, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+# Bounds on each wait for a server event, so a lost event fails its
+# scenario, naming the event, instead of stalling the whole suite
+EVENT_TIMEOUT = 60
+RUN_TIMEOUT = 120
+
+
+class SocketClient:
+    """Just enough of a Socket.IO client (websocket transport) for load tests."""
+
+    def __init__(self, port, cookie):
+        self.ws = simple_websocket.Client(
+            f'ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket',
+            headers={'Cookie': cookie})
+        # Small frames, sent one at a time: don't let Nagle hold them back
+        self.ws.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Connect to the namespace without waiting for the engine.io open
+        # packet: simple_websocket may hold a first frame that arrived with
+        # the handshake until more data comes in
+        self.ws.send('40')
+        self.wait_for(lambda packet: packet.startswith('40'), what='namespace connect')
+
+    def emit(self, event, data):
+        self.ws.send('42' + json.dumps([event, data]))
+
+    def wait_for(self, match, timeout=EVENT_TIMEOUT, what='matching event'):
+        deadline = time.monotonic() + timeout
+        while True:
+            packet = self.ws.receive(timeout=max(0.0, deadline - time.monotonic()))
+            if packet is None:
+                raise TimeoutError(f'no {what} within {timeout}s')
+            if isinstance(packet, bytes):
+                # binary attachment of a terminal_frame
+                continue
+            if packet == '2':
+                self.ws.send('3')
+            elif match(packet):
+                return packet
+            elif packet.startswith('42["terminal_output"') and '[ERROR]' in packet:
+                # The server gave up on what we are waiting for
+                raise RuntimeError(f'no {what}: {packet_data(packet)["output"]}')
+
+    def wait_event(self, event, timeout=EVENT_TIMEOUT):
+        # Plain events are 42[...], ones with binary attachments 45N-[...]
+        marker = f'["{event}"'
+        return self.wait_for(lambda packet: packet[0] == '4' and marker in packet[:40], timeout,
+                             f'{event} event')
+
+    def close(self):
+        self.ws.close()
+
+
+def login_cookie(port, username, project):
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args):
+            return None
+
+    body = urllib.parse.urlencode({'username': username, 'project_name': project}).encode()
+    opener = urllib.request.build_opener(NoRedirect)
+    try:
+        opener.open(f'http://127.0.0.1:{port}/login', data=body, timeout=30)
+    except urllib.error.HTTPError as e:
+        response = e
+    cookie = response.headers['Set-Cookie'].split(';', 1)[0]
+    response.close()
+    return cookie
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f'server on port {port} did not start')
+
+
+def scale_run(args, tmp, web, workers):
+    """Start `web` web processes and `workers` execution workers; load them."""
+    sock = tmp / 'mq.sock'
+    env = {**os.environ, 'CYBER20UN_MESSAGE_QUEUE': f'unix://{sock}',
+           'CYBER20UN_EXECUTION': 'workers', 'CYBER20UN_PORT': str(args.port),
+           'CYBER20UN_DEBUG': '0', 'PYTHONPATH': str(Path(__file__).resolve().parent)}
+    here = Path(__file__).resolve().parent
+    processes = [subprocess.Popen([sys.executable, str(here / 'mq.py'), str(sock)], cwd=tmp,
+                                  stdout=subprocess.DEVNULL)]
+    try:
+        while not sock.exists():
+            time.sleep(0.05)
+        for _ in range(web):
+            processes.append(subprocess.Popen([sys.executable, str(here / 'app.py')], cwd=tmp,
+                                              env=env, stdout=subprocess.DEVNULL,
+                                              stderr=subprocess.DEVNULL))
+        for _ in range(workers):
+            processes.append(subprocess.Popen([sys.executable, str(here / 'worker.py')], cwd=tmp,
+                                              env=env, stdout=subprocess.DEVNULL,
+                                              stderr=subprocess.DEVNULL))
+        wait_for_port(args.port)
+
+        connect_times = []
+        run_times = []
+        errors = []
+        connected = threading.Barrier(args.users + 1)
+
+        def user(i):
+            try:
+                started = time.perf_counter()
+                client = SocketClient(args.port, login_cookie(args.port, f'load{i}', 'scale'))
+                connect_times.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(e)
+                connected.abort()
+                return
+            try:
+                connected.wait()
+                client.emit('save_file', {'filename': 'main.py', 'content': 'print("hello")\n'})
+                client.wait_event('file_ack')
+                for _ in range(args.runs):
+                    started = time.perf_counter()
+                    client.emit('run_code', {'filename': 'main.py'})
+                    client.wait_event('run_stats')
+                    run_times.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=user, args=(i,)) for i in range(args.users)]
+        for t in threads:
+            t.start()
+        connected.wait()
+        started = time.perf_counter()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            process.wait()
+    return {
+        'web': web,
+        'workers': workers,
+        'connected': len(connect_times),
+        'connect_p95_ms': percentile(connect_times, 95) * 1000 if connect_times else None,
+        'runs': len(run_times),
+        'runs_per_sec': len(run_times) / elapsed,
+        'run_p50_ms': percentile(run_times, 50) * 1000 if run_times else None,
+        'run_p95_ms': percentile(run_times, 95) * 1000 if run_times else None,
+        'errors': len(errors),
+    }
+
+
+def build_base_env(tmp):
+    # The base venv is created once up front, not by every web process
+    subprocess.run([sys.executable, '-c',
+                    'from pathlib import Path; from envs import EnvironmentManager, WheelStore; '
+                    'EnvironmentManager(Path("envs"), WheelStore(Path("wheels"))).base_python()'],
+                   cwd=tmp, env={**os.environ, 'PYTHONPATH': str(Path(__file__).resolve().parent)},
+                   check=True)
+
+
+def bench_scale(args):
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    build_base_env(tmp)
+    print(f'{args.users} users x {args.runs} runs, {os.cpu_count()} cores')
+    try:
+        for web in args.web:
+            for workers in args.workers:
+                r = scale_run(args, tmp, web, workers)
+                connect = f"{r['connect_p95_ms']:.0f}" if r['connect_p95_ms'] is not None else '-'
+                run_p95 = f"{r['run_p95_ms']:.0f}" if r['run_p95_ms'] is not None else '-'
+                print(f"web {web:2}  workers {workers:2}  connected {r['connected']:4}"
+                      f"  connect p95 {connect:>6} ms  {r['runs_per_sec']:7.1f} runs/s"
+                      f"  run p95 {run_p95:>6} ms  errors {r['errors']}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_pty(args):
+    """Keystroke round trip through a project shell: key in, echo out."""
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    build_base_env(tmp)
+    here = Path(__file__).resolve().parent
+    env = {**os.environ, 'CYBER20UN_PORT': str(args.port), 'CYBER20UN_DEBUG': '0',
+           'PYTHONPATH': str(here)}
+    server = subprocess.Popen([sys.executable, str(here / 'app.py')], cwd=tmp, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.port)
+        client = SocketClient(args.port, login_cookie(args.port, 'ptybench', 'pty'))
+        try:
+            started = time.perf_counter()
+            client.emit('terminal_command', {'command': 'echo ready'})
+            client.wait_event('terminal_frame')
+            shell_start = time.perf_counter() - started
+
+            # cat on the shell's pty sends every line straight back
+            client.emit('terminal_command', {'command': 'cat'})
+            round_trips = []
+            for i in range(args.keys):
+                started = time.perf_counter()
+                client.emit('terminal_input', {'data': f'{i}\n'})
+                client.wait_event('terminal_frame')
+                round_trips.append(time.perf_counter() - started)
+            client.emit('terminal_input', {'data': '\x03'})
+        finally:
+            client.close()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f'shell start {shell_start * 1000:.0f} ms')
+    print(f'{args.keys} keystrokes: p50 {percentile(round_trips, 50) * 1000:.2f} ms'
+          f'  p95 {percentile(round_trips, 95) * 1000:.2f} ms'
+          f'  p99 {percentile(round_trips, 99) * 1000:.2f} ms')
+
+
+def bench_page(args):
+    """Requests/sec for the index page and a static asset, in process."""
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    here = Path(__file__).resolve().parent
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    sys.path.insert(0, str(here))
+    try:
+        import app
+        anonymous = app.app.test_client()
+        user = app.app.test_client()
+        user.post('/login', data={'username': 'pagebench', 'project_name': 'page'})
+        cases = [('/ anonymous', anonymous, '/', {}), ('/ logged in', user, '/', {})]
+        assets = getattr(app, 'assets', None)
+        if assets is not None:
+            js = assets.url('app.js')
+            cases.append(('app.js gzip', anonymous, js, {'Accept-Encoding': 'gzip, br'}))
+            etag = anonymous.get(js).headers['ETag']
+            cases.append(('app.js 304', anonymous, js, {'If-None-Match': etag}))
+        for name, client, url, headers in cases:
+            response = client.get(url, headers=headers)
+            size = len(response.get_data())
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                client.get(url, headers=headers).close()
+            elapsed = time.perf_counter() - started
+            print(f'{name:14} {args.requests / elapsed:8.0f} req/s'
+                  f'  {elapsed / args.requests * 1e6:7.0f} us/req  {size:6} bytes')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def summarize(samples, elapsed, errors=0, **extra):
+    """Throughput and latency percentiles of one scenario, JSON-ready."""
+    result = {
+        'ops': len(samples),
+        'seconds': round(elapsed, 4),
+        'ops_per_sec': round(len(samples) / elapsed, 2) if elapsed else None,
+        'errors': errors,
+    }
+    for pct in (50, 95, 99):
+        result[f'p{pct}_ms'] = round(percentile(samples, pct) * 1000, 3) if samples else None
+    result.update(extra)
+    return result
+
+
+class SuiteServer:
+    """app.py on a real port in a temp directory, with its metrics and memory."""
+
+    def __init__(self, tmp, port):
+        here = Path(__file__).resolve().parent
+        env = {**os.environ, 'CYBER20UN_PORT': str(port), 'CYBER20UN_DEBUG': '0',
+               'CYBER20UN_METRICS': '1', 'PYTHONPATH': str(here)}
+        self.port = port
+        self.process = subprocess.Popen([sys.executable, str(here / 'app.py')], cwd=tmp, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(port)
+
+    def get(self, path, cookie=None):
+        """(seconds, bytes) to fetch path and read the whole body."""
+        request = urllib.request.Request(f'http://127.0.0.1:{self.port}{path}',
+                                         headers={'Cookie': cookie} if cookie else {})
+        started = time.perf_counter()
+        with urllib.request.urlopen(request, timeout=300) as response:
+            size = 0
+            for block in iter(lambda: response.read(256 * 1024), b''):
+                size += len(block)
+        return time.perf_counter() - started, size
+
+    def metric(self, text, name):
+        """Sum of every sample of name in a /metrics page."""
+        total = 0.0
+        for line in text.splitlines():
+            if line.startswith(name + ' ') or line.startswith(name + '{'):
+                total += float(line.rsplit(' ', 1)[1])
+        return total
+
+    def db_waits(self):
+        """(lock waits, lock wait seconds, pool wait seconds) so far."""
+        with urllib.request.urlopen(f'http://127.0.0.1:{self.port}/metrics', timeout=30) as r:
+            text = r.read().decode()
+        return (self.metric(text, 'cyber20un_db_lock_wait_seconds_count'),
+                self.metric(text, 'cyber20un_db_lock_wait_seconds_sum'),
+                self.metric(text, 'cyber20un_db_pool_wait_seconds_sum'))
+
+    def peak_rss(self):
+        # VmHWM: the high-water mark of the server's resident set
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def concurrently(count, fn):
+    """Run fn(i) for i in range(count) on their own threads; return the errors."""
+    errors = []
+
+    def guarded(i):
+        try:
+            fn(i)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=guarded, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def packet_data(packet):
+    """The payload of a '42["event", data]' packet."""
+    return json.loads(packet[packet.index('['):])[1]
+
+
+def suite_scenarios(server, args):
+    port = server.port
+    prefix = f'suite{os.getpid()}'
+
+    def connect(i, project):
+        return SocketClient(port, login_cookie(port, f'{prefix}-{i}', project))
+
+    def page(i):
+        cookie = login_cookie(port, f'{prefix}-{i}', 'page')
+        for _ in range(args.pages):
+            seconds, _ = server.get('/', cookie)
+            samples.append(seconds)
+
+    def autosave(i):
+        client = connect(i, 'autosave')
+        try:
+            content = 'print("hello")\n'
+            client.emit('save_file', {'filename': 'main.py', 'content': content})
+            version = packet_data(client.wait_event('file_ack'))['version']
+            for n in range(args.edits):
+                started = time.perf_counter()
+                edit = f'# edit {n}\n'
+                client.emit('edit_file', {'filename': 'main.py', 'version': version,
+                                          'ops': [[len(content), 0, edit]]})
+                version = packet_data(client.wait_event('file_ack'))['version']
+                content += edit
+                samples.append(time.perf_counter() - started)
+        finally:
+            client.close()
+
+    def stdout(i):
+        client = connect(i, 'stdout')
+        try:
+            program = f'for i in range({args.lines}):\n    print("line", i, "x" * 60)\n'
+            client.emit('save_file', {'filename': 'main.py', 'content': program})
+            client.wait_event('file_ack')
+            started = time.perf_counter()
+            client.emit('run_code', {'filename': 'main.py'})
+            stats = packet_data(client.wait_event('run_stats', timeout=RUN_TIMEOUT))
+            samples.append(time.perf_counter() - started)
+            output_bytes.append(stats['bytes_out'])
+        finally:
+            client.close()
+
+    def command(i):
+        client = connect(i, 'command')
+        try:
+            for n in range(args.commands):
+                started = time.perf_counter()
+                client.emit('terminal_command', {'command': f'echo {n}'})
+                client.wait_event('terminal_frame')
+                samples.append(time.perf_counter() - started)
+        finally:
+            client.close()
+
+    def flow(i):
+        started = time.perf_counter()
+        client = connect(i, 'flow')
+        try:
+            client.emit('save_file', {'filename': 'main.py', 'content': 'print("hello")\n'})
+            client.wait_event('file_ack')
+            client.emit('run_code', {'filename': 'main.py'})
+            client.wait_event('run_stats', timeout=RUN_TIMEOUT)
+            client.emit('terminal_command', {'command': 'echo done'})
+            client.wait_event('terminal_frame')
+        finally:
+            client.close()
+        samples.append(time.perf_counter() - started)
+
+    def export(i):
+        seconds, size = server.get(f'/api/export/{prefix}-export/export?format=zip&logs=1')
+        samples.append(seconds)
+        output_bytes.append(size)
+
+    def build_export_project():
+        client = connect('export', 'export')
+        try:
+            # Half a megabyte per file keeps the server's echo under the
+            # websocket client's frame limit
+            block = ''.join(f'x = "{os.urandom(500).hex()}"\n' for _ in range(512))
+            for n in range(args.export_mb * 2):
+                client.emit('save_file', {'filename': f'module{n}.py', 'content': block})
+                client.wait_event('file_ack')
+        finally:
+            client.close()
+
+    scenarios = [
+        ('page', args.users, page),
+        ('autosave', args.users, autosave),
+        ('stdout', args.users, stdout),
+        ('command', args.users, command),
+        ('flow', args.users, flow),
+        ('export', min(args.users, 4), export),
+    ]
+    results = {}
+    for name, users, fn in scenarios:
+        if args.only and name not in args.only:
+            continue
+        if name == 'export':
+            build_export_project()
+        samples = []
+        output_bytes = []
+        before = server.db_waits()
+        started = time.perf_counter()
+        errors = concurrently(users, fn)
+        elapsed = time.perf_counter() - started
+        after = server.db_waits()
+        extra = {
+            'users': users,
+            'db_lock_waits': int(after[0] - before[0]),
+            'db_lock_wait_ms': round((after[1] - before[1]) * 1000, 3),
+            'db_pool_wait_ms': round((after[2] - before[2]) * 1000, 3),
+        }
+        if output_bytes:
+            extra['out_mb_per_sec'] = round(sum(output_bytes) / elapsed / 1e6, 2)
+        results[name] = summarize(samples, elapsed, len(errors), **extra)
+        if errors:
+            print(f'[suite] {name}: {len(errors)} errors, first: {errors[0]!r}', file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Regressions against a baseline run: slower p95 or lower throughput."""
+    regressions = []
+    for name, base in baseline.get('scenarios', {}).items():
+        now = results['scenarios'].get(name)
+        if now is None:
+            continue
+        if now['errors'] > base['errors']:
+            regressions.append(f"{name}: errors {base['errors']} -> {now['errors']}")
+        if base.get('p95_ms') and now.get('p95_ms') and now['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {base['p95_ms']} -> {now['p95_ms']} ms")
+        if (base.get('ops_per_sec') and now.get('ops_per_sec')
+                and now['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold)):
+            regressions.append(f"{name}: {base['ops_per_sec']} -> {now['ops_per_sec']} ops/s")
+    base_rss = baseline.get('peak_rss_bytes')
+    if base_rss and results['peak_rss_bytes'] and results['peak_rss_bytes'] > base_rss * (1 + threshold):
+        regressions.append(f"peak RSS {base_rss} -> {results['peak_rss_bytes']} bytes")
+    return regressions
+
+
+def bench_suite(args):
+    """Page/autosave/stdout/command/flow/export scenarios for N concurrent users, as JSON."""
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    build_base_env(tmp)
+    try:
+        server = SuiteServer(tmp, args.port)
+        try:
+            scenarios = suite_scenarios(server, args)
+            peak_rss = server.peak_rss()
+        finally:
+            server.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    results = {
+        'cores': os.cpu_count(),
+        'users': args.users,
+        'scenarios': scenarios,
+        'peak_rss_bytes': peak_rss,
+        # Largest of the server and the runs, shells and pip it started; KiB
+        'peak_child_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+    text = json.dumps(results, indent=2)
+    if args.json:
+        Path(args.json).write_text(text + '\n')
+    print(text)
+
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.threshold)
+        for regression in regressions:
+            print(f'[suite] REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def template_files(files):
+    """A project template: modules of plausible, compressible Python."""
+    body = ''.join(f'def handler_{i}(request):\n'
+                   f'    """Handle request {i}."""\n'
+                   f'    value = request.get("field_{i}", {i})\n'
+                   f'    return {{"status": "ok", "value": value * {i}}}\n\n'
+                   for i in range(40))
+    return {f'pkg/module{f}.py' if f else 'main.py': f'# module {f}\n' + body
+            for f in range(files)}
+
+
+def tenant_saves(template, tenant, saves):
+    """(filename, content) saves of one tenant editing a copy of template."""
+    names = sorted(template)
+    contents = dict(template)
+    # Everyone starts by saving the template as is
+    yield from contents.items()
+    for i in range(saves):
+        # Most edits touch main.py, some a module; a few revert
+        name = names[0] if i % 3 else names[i % len(names)]
+        if i % 10 == 9:
+            contents[name] = template[name]
+        else:
+            contents[name] += f'print("tenant {tenant} edit {i}")\n'
+        yield name, contents[name]
+
+
+def io_written():
+    """(write_bytes, wchar) of this process so far, from /proc/self/io."""
+    try:
+        fields = dict(line.split(': ') for line in Path('/proc/self/io').read_text().splitlines())
+        return int(fields['write_bytes']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def disk_usage(path):
+    return sum(p.stat().st_size for p in Path(path).rglob('*') if p.is_file())
+
+
+def db_size(database):
+    # Pages in use as of the last commit, WAL included
+    with database.reader() as conn:
+        pages = conn.execute('PRAGMA page_count').fetchone()[0] - \
+            conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return pages * conn.execute('PRAGMA page_size').fetchone()[0]
+
+
+def bench_blobs(args):
+    """Storage of many tenants working from one template: content in every
+    row plus a file per save, against blobs plus one checkout per tenant."""
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    template = template_files(args.files)
+    results = {}
+    try:
+        for layout in ('legacy', 'blobs'):
+            database = Database(tmp / f'{layout}.db')
+            database.write(create_schema)
+            codes = tmp / f'{layout}-codes'
+            blobs = BlobStore(database)
+            workspace = Workspace(database, None, blobs)
+            logical = saves = 0
+            before = io_written()
+            started = time.perf_counter()
+            for tenant in range(args.tenants):
+                root = codes / str(tenant)
+                for name, content in tenant_saves(template, tenant, args.saves):
+                    logical += len(content.encode())
+                    saves += 1
+                    if layout == 'legacy':
+                        # The row and the file, rewritten on every save
+                        database.execute(SAVE_SQL, (tenant, name, content, 'bench'))
+                        path = root / name
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        path.write_text(content)
+                    else:
+                        blobs.save_file(tenant, name, content, 'bench')
+                if layout == 'blobs':
+                    # The files are written out once, when the tenant runs
+                    workspace.checkout(tenant, 'bench', root)
+            elapsed = time.perf_counter() - started
+            after = io_written()
+            results[layout] = {
+                'saves': saves,
+                'saves_per_sec': round(saves / elapsed, 1),
+                'db_bytes': db_size(database),
+                'disk_bytes': disk_usage(codes),
+                'write_bytes': after[0] - before[0],
+                'wchar': after[1] - before[1],
+            }
+            if layout == 'blobs':
+                usage = blobs.usage()
+                results[layout]['blobs'] = usage['blobs']
+                results[layout]['dedup_ratio'] = round(logical / max(usage['stored_bytes'], 1), 1)
+            database.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f'{args.tenants} tenants x {args.files}-file template, {args.saves} edits each')
+    for layout, result in results.items():
+        print(f'{layout:7} {result["saves_per_sec"]:9.1f} saves/s'
+              f'  db {result["db_bytes"] / 1e6:8.1f} MB'
+              f'  disk {result["disk_bytes"] / 1e6:8.1f} MB'
+              f'  written {result["write_bytes"] / 1e6:8.1f} MB (wchar {result["wchar"] / 1e6:.1f} MB)')
+    print(f'distinct blobs: {results["blobs"]["blobs"]}'
+          f'  logical/stored: {results["blobs"]["dedup_ratio"]}x')
+
+
+def legacy_login(database, username, project_name):
+    # The original get_or_create_user: a lookup, then a re-check and
+    # insert on the writer if the pair is new
+    with database.reader() as conn:
+        user = conn.execute(FIND_USER_SQL, (username, project_name)).fetchone()
+    if user:
+        return user[0]
+
+    def create_user(conn):
+        user = conn.execute(FIND_USER_SQL, (username, project_name)).fetchone()
+        if user:
+            return user[0]
+        return conn.execute('INSERT INTO users (username, ip_address, project_name) '
+                            'VALUES (?, ?, ?)', (username, '127.0.0.1', project_name)).lastrowid
+
+    return database.write(create_user)
+
+
+def bench_logins(args):
+    """A classroom starting at once: logins of args.users students, most
+    of them repeated (reloads, second tabs), arriving together."""
+    tmp = Path(tempfile.mkdtemp(prefix='cyber20un-bench-'))
+    pairs = [(f'student{i % args.users}', 'lab') for i in range(args.logins)]
+    random.Random(0).shuffle(pairs)
+    try:
+        for name in ('legacy', 'cached'):
+            database = Database(tmp / f'{name}.db')
+            database.write(create_schema)
+            # Half the class has logged in before
+            database.executemany('INSERT INTO users (username, project_name) VALUES (?, ?)',
+                                 [(f'student{i}', 'lab') for i in range(0, args.users, 2)])
+            identity = IdentityCache(database)
+            if name == 'legacy':
+                login = lambda pair: legacy_login(database, *pair)
+            else:
+                login = lambda pair: identity.user_id(*pair, '127.0.0.1')
+            samples = []
+            ids = {}
+            lock = threading.Lock()
+
+            def one(i):
+                started = time.perf_counter()
+                user_id = login(pairs[i])
+                elapsed = time.perf_counter() - started
+                with lock:
+                    samples.append(elapsed)
+                    ids.setdefault(pairs[i], set()).add(user_id)
+
+            rate = run_threads(args.threads, len(pairs), one)
+            with database.reader() as conn:
+                rows = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+            assert rows == args.users and all(len(v) == 1 for v in ids.values()), 'duplicate users'
+            line = (f'{name:7} {rate:10.1f} logins/s  p50 {percentile(samples, 50) * 1000:7.2f} ms'
+                    f'  p99 {percentile(samples, 99) * 1000:7.2f} ms')
+            if name == 'cached':
+                stats = identity.stats()
+                line += (f'  queries {stats["misses"] - stats["coalesced"]}'
+                         f'  coalesced {stats["coalesced"]}  created {stats["created"]}')
+            else:
+                line += f'  queries {len(samples)}'
+            print(line)
+            database.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_installs(args):
+    """Re-running an install the project already has: parse, compare, no pip."""
+    libraries = [(f'package-{i}', f'1.{i}.0') for i in range(args.packages)]
+    # Requirements files mix pins, ranges and bare names
+    requirements = '\n'.join(f'package_{i}=={v}' if i % 3 == 0 else
+                              f'Package.{i}>=1.0,<2' if i % 3 == 1 else f'package-{i}'
+                              for i, (_, v) in enumerate(libraries)).encode()
+    command = 'pip install -q -r requirements.txt'
+
+    class NoEnvs:
+        def wheel_command(self, *_):
+            raise AssertionError('pip was run for a satisfied requirement set')
+
+    installer = Installer(NoEnvs())
+    samples = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        request = parse_install(command, lambda name: requirements)
+        installed = installer.install(None, 1, request, latest_versions(libraries), lambda e: None)
+        samples.append(time.perf_counter() - started)
+        assert installed == []
+    print(f'{args.packages} requirements already installed: no-op p50 '
+          f'{percentile(samples, 50) * 1000:.3f} ms  p99 {percentile(samples, 99) * 1000:.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    saves = sub.add_parser('saves', help='save_code_to_db throughput')
+    saves.add_argument('--threads', type=int, default=8)
+    saves.add_argument('--count', type=int, default=2000)
+    saves.set_defaults(func=bench_saves)
+
+    logs = sub.add_parser('logs', help='terminal log write throughput')
+    logs.add_argument('--lines', type=int, default=100000)
+    logs.set_defaults(func=bench_logs)
+
+    warm = sub.add_parser('warm', help='run_code time to first output')
+    warm.add_argument('--runs', type=int, default=50)
+    warm.add_argument('--preload', nargs='*', default=['json', 'decimal', 'asyncio'])
+    warm.set_defaults(func=bench_warm)
+
+    runcache = sub.add_parser('runcache', help='run_code cache hit cost')
+    runcache.add_argument('--files', type=int, default=20)
+    runcache.add_argument('--runs', type=int, default=2000)
+    runcache.set_defaults(func=bench_runcache)
+
+    exp = sub.add_parser('export', help='project export peak memory')
+    exp.add_argument('--size-mb', type=int, default=1024)
+    exp.add_argument('--files', type=int, default=64)
+    exp.add_argument('--legacy', action='store_true',
+                     help='also run the load-everything export (needs several times the size in RAM)')
+    exp.set_defaults(func=bench_export)
+
+    queries = sub.add_parser('queries', help='hot query plans and latency')
+    queries.add_argument('--projects', type=int, default=2000)
+    queries.add_argument('--log-rows', type=int, default=200000)
+    queries.add_argument('--repeat', type=int, default=200)
+    queries.set_defaults(func=bench_queries)
+
+    scale = sub.add_parser('scale', help='connected users and runs/sec vs process count')
+    scale.add_argument('--users', type=int, default=50)
+    scale.add_argument('--runs', type=int, default=5)
+    scale.add_argument('--web', type=int, nargs='+', default=[1, 2])
+    scale.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    scale.add_argument('--port', type=int, default=5077)
+    scale.set_defaults(func=bench_scale)
+
+    pty = sub.add_parser('pty', help='interactive terminal keystroke round trip')
+    pty.add_argument('--keys', type=int, default=500)
+    pty.add_argument('--port', type=int, default=5078)
+    pty.set_defaults(func=bench_pty)
+
+    page = sub.add_parser('page', help='index page and static asset requests/sec')
+    page.add_argument('--requests', type=int, default=2000)
+    page.set_defaults(func=bench_page)
+
+    suite = sub.add_parser('suite', help='concurrent-user scenarios as JSON, with regression gate')
+    suite.add_argument('--users', type=int, default=10)
+    suite.add_argument('--pages', type=int, default=50, help='page loads per user')
+    suite.add_argument('--edits', type=int, default=50, help='autosave deltas per user')
+    suite.add_argument('--lines', type=int, default=20000, help='lines printed per stdout run')
+    suite.add_argument('--commands', type=int, default=5, help='shell commands per user')
+    suite.add_argument('--export-mb', type=int, default=20, help='size of the exported project')
+    suite.add_argument('--only', nargs='*', help='run only these scenarios')
+    suite.add_argument('--json', help='also write the results to this file')
+    suite.add_argument('--baseline', help='results of an earlier run to compare against')
+    suite.add_argument('--threshold', type=float, default=0.25,
+                       help='allowed relative slowdown before failing (default 0.25)')
+    suite.add_argument('--port', type=int, default=5079)
+    suite.set_defaults(func=bench_suite)
+
+    blobs = sub.add_parser('blobs', help='storage and write volume, legacy rows vs deduplicated blobs')
+    blobs.add_argument('--tenants', type=int, default=500)
+    blobs.add_argument('--files', type=int, default=20, help='files in the shared template')
+    blobs.add_argument('--saves', type=int, default=40, help='edits per tenant')
+    blobs.set_defaults(func=bench_blobs)
+
+    logins = sub.add_parser('logins', help='login storm: identity cache vs a lookup per login')
+    logins.add_argument('--users', type=int, default=300)
+    logins.add_argument('--logins', type=int, default=5000)
+    logins.add_argument('--threads', type=int, default=64)
+    logins.set_defaults(func=bench_logins)
+
+    installs = sub.add_parser('installs', help='cost of re-running a satisfied pip install')
+    installs.add_argument('--packages', type=int, default=50)
+    installs.add_argument('--runs', type=int, default=1000)
+    installs.set_defaults(func=bench_installs)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
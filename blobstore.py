@@ -0,0 +1,171 @@
+"""Content-addressed, deduplicated storage for code file contents.
+
+Each distinct content is stored once, as a blob keyed by its sha256 (the
+hash code_files lists) and zlib-compressed when that makes it smaller.
+code_files rows and snapshot entries refer to blobs by hash; triggers
+keep every blob's reference count, so the projects that start from the
+same template share one copy, and a snapshot of a project is a list of
+hashes that copies no content.
+
+Blobs are written, and unreferenced ones collected, on the database
+writer in the same transaction as the rows that refer to them, so the
+collector never sees a blob whose row is still being written.
+"""
+import hashlib
+import zlib
+
+from db import SAVE_CODE_SQL
+
+# Below this, the zlib header and checksum eat most of the saving
+MIN_COMPRESS = 128
+LEVEL = 6
+
+EXISTS_SQL = 'SELECT 1 FROM blobs WHERE hash = ?'
+PUT_SQL = 'INSERT OR IGNORE INTO blobs (hash, size, encoding, data) VALUES (?, ?, ?, ?)'
+GET_SQL = 'SELECT encoding, data FROM blobs WHERE hash = ?'
+# Legacy rows still carry their content inline
+FILE_SQL = '''SELECT c.content, b.encoding, b.data FROM code_files c
+              LEFT JOIN blobs b ON b.hash = c.hash
+              WHERE c.user_id = ? AND c.project_name = ? AND c.filename = ?'''
+GARBAGE_SQL = 'SELECT id, length(data) FROM blobs WHERE refs <= 0 LIMIT ?'
+USAGE_SQL = 'SELECT COUNT(*), TOTAL(size), TOTAL(length(data)), TOTAL(refs) FROM blobs'
+
+
+def encode_content(content):
+    # Lone surrogates can arrive from the browser; keep them round-trippable
+    return content.encode('utf-8', 'surrogatepass')
+
+
+def decode_content(data):
+    return data.decode('utf-8', 'surrogatepass')
+
+
+def content_hash(data):
+    """sha256 hex of a file's encoded content: its blob key."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def encode_blob(data):
+    """(encoding, stored bytes) for content `data`."""
+    if len(data) >= MIN_COMPRESS:
+        compressed = zlib.compress(data, LEVEL)
+        if len(compressed) < len(data):
+            return 'zlib', compressed
+    return 'raw', data
+
+
+def decode_blob(encoding, stored):
+    return zlib.decompress(stored) if encoding == 'zlib' else bytes(stored)
+
+
+def row_content(content, encoding, stored):
+    """A code_files row's content as text, inline (legacy) or from its blob."""
+    if content is not None:
+        return content
+    if stored is None:
+        return ''
+    return decode_content(decode_blob(encoding, stored))
+
+
+def put(conn, digest, data, encoded=None):
+    """Store data under digest unless it is there already; True if it was new."""
+    if conn.execute(EXISTS_SQL, (digest,)).fetchone():
+        return False
+    encoding, stored = encoded or encode_blob(data)
+    conn.execute(PUT_SQL, (digest, len(data), encoding, stored))
+    return True
+
+
+def _save_file(conn, user_id, filename, project_name, version, data, digest, encoded):
+    created = put(conn, digest, data, encoded)
+    # The row points at the blob; content stays NULL
+    conn.execute(SAVE_CODE_SQL, (user_id, filename, None, project_name, version,
+                                 len(data), digest))
+    return created
+
+
+def _collect(conn, batch):
+    garbage = conn.execute(GARBAGE_SQL, (batch,)).fetchall()
+    conn.executemany('DELETE FROM blobs WHERE id = ? AND refs <= 0',
+                     [(blob_id,) for blob_id, _ in garbage])
+    return len(garbage), sum(size or 0 for _, size in garbage)
+
+
+class BlobStore:
+    """Blobs in the `blobs` table of database."""
+
+    def __init__(self, database):
+        self.database = database
+        self.saves = 0
+        self.deduplicated = 0
+        self.bytes_in = 0
+        self.bytes_stored = 0
+        self.collected = 0
+        self.collected_bytes = 0
+
+    def exists(self, digest):
+        with self.database.reader() as conn:
+            return conn.execute(EXISTS_SQL, (digest,)).fetchone() is not None
+
+    def save_file(self, user_id, filename, content, project_name, version=0):
+        """Point the code_files row at content's blob, storing the blob if new."""
+        data = encode_content(content)
+        digest = content_hash(data)
+        # Compress here rather than on the writer, and only if it's needed
+        encoded = None if self.exists(digest) else encode_blob(data)
+        created = self.database.write(_save_file, user_id, filename, project_name, version,
+                                      data, digest, encoded)
+        self.saves += 1
+        self.bytes_in += len(data)
+        if created:
+            self.bytes_stored += len(encoded[1]) if encoded else len(data)
+        else:
+            self.deduplicated += 1
+        return digest
+
+    def get(self, digest):
+        """The content stored under digest, as bytes; None if there is none."""
+        with self.database.reader() as conn:
+            row = conn.execute(GET_SQL, (digest,)).fetchone()
+        return decode_blob(*row) if row else None
+
+    def read_file(self, user_id, project_name, filename):
+        """A saved file's content as bytes; None if there is no such file."""
+        with self.database.reader() as conn:
+            row = conn.execute(FILE_SQL, (user_id, project_name, filename)).fetchone()
+        if row is None:
+            return None
+        content, encoding, stored = row
+        if content is not None:
+            return encode_content(content)
+        return decode_blob(encoding, stored) if stored is not None else b''
+
+    def collect(self, batch=1000):
+        """Delete unreferenced blobs; returns (blobs, stored bytes) freed."""
+        count = freed = 0
+        while True:
+            deleted, size = self.database.write(_collect, batch)
+            count += deleted
+            freed += size
+            if deleted < batch:
+                break
+        self.collected += count
+        self.collected_bytes += freed
+        return count, freed
+
+    def usage(self):
+        """Blobs, content bytes, stored bytes and references, from the table."""
+        with self.database.reader() as conn:
+            blobs, size, stored, refs = conn.execute(USAGE_SQL).fetchone()
+        return {'blobs': blobs, 'bytes': int(size), 'stored_bytes': int(stored),
+                'references': int(refs)}
+
+    def stats(self):
+        return {
+            'saves': self.saves,
+            'deduplicated': self.deduplicated,
+            'bytes_in': self.bytes_in,
+            'bytes_stored': self.bytes_stored,
+            'collected': self.collected,
+            'collected_bytes': self.collected_bytes,
+        }
@@ -0,0 +1,246 @@
+"""Expiry-driven cleanup of idle projects.
+
+Activity (saves, edits, runs, commands, logins) touches the project in
+memory; touches are written to the project_expiry table at most every
+`touch_interval` seconds. Each cleanup pass reads only the projects whose
+last touch is older than `ttl` off the touched_at index and purges them
+in small batches with a pause in between, so there is no full-tree scan
+and no I/O spike.
+
+Every worker process runs an engine, but only the one holding the leader
+lock (an flock on `lock_path`) does any purging. The lock is released
+when the process exits, and another worker picks it up on its next pass.
+"""
+import atexit
+import fcntl
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+EXPIRED_SQL = '''SELECT user_id, project_name, touched_at FROM project_expiry
+                 WHERE touched_at < ? ORDER BY touched_at LIMIT ?'''
+TOUCH_SQL = '''INSERT INTO project_expiry (user_id, project_name, touched_at)
+               VALUES (?, ?, ?)
+               ON CONFLICT (user_id, project_name)
+               DO UPDATE SET touched_at = MAX(touched_at, excluded.touched_at)'''
+PURGE_SQL = (
+    'DELETE FROM code_files WHERE user_id = ? AND project_name = ?',
+    'DELETE FROM code_file_ops WHERE user_id = ? AND project_name = ?',
+    'DELETE FROM libraries WHERE user_id = ? AND project_name = ?',
+    'DELETE FROM project_snapshots WHERE user_id = ? AND project_name = ?',
+)
+
+
+class LeaderLock:
+    """Non-blocking, process-lifetime flock; held by at most one worker."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+def reclaimable_bytes(path):
+    """Bytes freed by deleting path; files hardlinked elsewhere don't count."""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if st.st_nlink == 1:
+                total += st.st_blocks * 512
+    return total
+
+
+class CleanupEngine:
+    """Purges projects idle for longer than `ttl` seconds.
+
+    `paths(user_id, project_name)` lists the directories a project owns
+    on disk; `on_purge(user_id, project_name)` drops whatever in-process
+    state still refers to it. `collect()`, if given, runs after every
+    pass that purged something and returns (items, bytes) it freed, e.g.
+    blobs no purged project refers to any more.
+    """
+
+    def __init__(self, database, paths, lock_path, on_purge=None, collect=None,
+                 ttl=30 * 24 * 3600,
+                 interval=300, batch=20, pause=1.0, max_batches=50, touch_interval=60):
+        self.database = database
+        self.paths = paths
+        self.on_purge = on_purge
+        self.collect = collect
+        self.ttl = ttl
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self.max_batches = max_batches
+        self.touch_interval = touch_interval
+        self.leader = LeaderLock(lock_path)
+        self._touches = {}
+        self._touched_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.purged = 0
+        self.reclaimed_bytes = 0
+        self.deleted_rows = 0
+        self.errors = 0
+        self.collected = 0
+        self.collected_bytes = 0
+        self.last_pass_seconds = 0.0
+
+    def touch(self, user_id, project_name):
+        """Record activity on a project; cheap enough to call per request."""
+        now = time.time()
+        with self._lock:
+            self._touches[(user_id, project_name)] = now
+            due = time.monotonic() - self._touched_flush >= self.touch_interval
+        if due:
+            self.flush_touches()
+
+    def flush_touches(self):
+        with self._lock:
+            touches = self._touches
+            self._touches = {}
+            self._touched_flush = time.monotonic()
+        if touches:
+            self.database.submit(_write_touches, [key + (at,) for key, at in touches.items()])
+
+    def run_once(self):
+        """One cleanup pass if this worker is the leader; returns projects purged."""
+        if not self.leader.acquire():
+            return 0
+        started = time.monotonic()
+        self.flush_touches()
+        purged = 0
+        cutoff = time.time() - self.ttl
+        for batch_number in range(self.max_batches):
+            if batch_number and self._stopping.wait(self.pause):
+                break
+            with self.database.reader() as conn:
+                expired = conn.execute(EXPIRED_SQL, (cutoff, self.batch)).fetchall()
+            for user_id, project_name, touched_at in expired:
+                if self._purge(user_id, project_name, cutoff):
+                    purged += 1
+            if len(expired) < self.batch:
+                break
+        if purged and self.collect is not None:
+            collected, freed = self.collect()
+            with self._lock:
+                self.collected += collected
+                self.collected_bytes += freed
+        with self._lock:
+            self.last_pass_seconds = time.monotonic() - started
+        return purged
+
+    def _purge(self, user_id, project_name, cutoff):
+        with self._lock:
+            if self._touches.get((user_id, project_name), 0) >= cutoff:
+                return False
+        try:
+            rows = self.database.write(_purge_rows, user_id, project_name, cutoff)
+            if rows is None:
+                # Touched by another worker since we read it
+                return False
+            if self.on_purge is not None:
+                self.on_purge(user_id, project_name)
+            reclaimed = 0
+            for path in self.paths(user_id, project_name):
+                if os.path.isdir(path):
+                    reclaimed += reclaimable_bytes(path)
+                    shutil.rmtree(path, ignore_errors=True)
+        except (OSError, sqlite3.Error) as e:
+            print(f'[cleanup] failed to purge {user_id}/{project_name}: {e}')
+            with self._lock:
+                self.errors += 1
+            return False
+        with self._lock:
+            self.purged += 1
+            self.deleted_rows += rows
+            self.reclaimed_bytes += reclaimed
+        return True
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cleanup', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.run_once()
+            except (OSError, sqlite3.Error) as e:
+                print(f'[cleanup] pass failed: {e}')
+                with self._lock:
+                    self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'leader': self.leader.held,
+                'purged': self.purged,
+                'reclaimed_bytes': self.reclaimed_bytes,
+                'deleted_rows': self.deleted_rows,
+                'errors': self.errors,
+                'collected': self.collected,
+                'collected_bytes': self.collected_bytes,
+                'last_pass_seconds': self.last_pass_seconds,
+                'pending_touches': len(self._touches),
+            }
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush_touches()
+        self.leader.release()
+
+
+def _write_touches(conn, rows):
+    conn.executemany(TOUCH_SQL, rows)
+
+
+def _purge_rows(conn, user_id, project_name, cutoff):
+    # Re-check inside the write transaction so a touch that landed after
+    # the expired list was read keeps the project
+    deleted = conn.execute('''DELETE FROM project_expiry
+                              WHERE user_id = ? AND project_name = ? AND touched_at < ?''',
+                           (user_id, project_name, cutoff)).rowcount
+    if not deleted:
+        return None
+    rows = deleted
+    for sql in PURGE_SQL:
+        rows += conn.execute(sql, (user_id, project_name)).rowcount
+    return rows
+
+
+def open_cleanup_engine(database, paths, lock_path, **kwargs):
+    engine = CleanupEngine(database, paths, lock_path, **kwargs)
+    atexit.register(engine.close)
+    engine.start()
+    return engine
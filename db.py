@@ -0,0 +1,503 @@
+import atexit
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from metrics import Histogram
+
+# Every pooled connection gets the same settings. WAL lets readers run
+# alongside the single writer, and synchronous=NORMAL only fsyncs on
+# checkpoints instead of on every commit.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# sqlite3 keeps a per-connection cache of compiled statements keyed by SQL
+# text, so pooled connections reuse prepared statements across calls.
+STATEMENT_CACHE_SIZE = 256
+
+POOL_WAIT = Histogram('cyber20un_db_pool_wait_seconds', 'Wait for a pooled read connection')
+LOCK_WAIT = Histogram('cyber20un_db_lock_wait_seconds', 'Writer wait for the database lock (BEGIN IMMEDIATE)')
+COMMIT_SECONDS = Histogram('cyber20un_db_commit_seconds', 'Writer batch, BEGIN to COMMIT')
+BATCH_SIZE = Histogram('cyber20un_db_write_batch_size', 'Writes committed per transaction',
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+# Queries on the request path. bench.py checks their plans stay indexed.
+FIND_USER_SQL = 'SELECT id FROM users WHERE username = ? AND project_name = ?'
+SAVE_CODE_SQL = '''INSERT INTO code_files
+                   (user_id, filename, content, project_name, version, size, hash)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (user_id, filename, project_name)
+                   DO UPDATE SET content = excluded.content, version = excluded.version,
+                                 size = excluded.size, hash = excluded.hash
+                   -- A versioned save never goes back: a process with an
+                   -- older copy of the file can't overwrite a newer one
+                   WHERE excluded.version = 0 OR code_files.version IS NULL
+                      OR excluded.version >= code_files.version'''
+RECENT_FILE_SQL = '''SELECT filename FROM code_files
+                     WHERE user_id = ? AND project_name = ?
+                     ORDER BY updated_at DESC LIMIT 1'''
+PROJECT_LIBRARIES_SQL = '''SELECT package_name, version FROM libraries
+                           WHERE user_id = ? AND project_name = ?
+                           ORDER BY installed_at DESC'''
+INSERT_RUN_STATS_SQL = '''INSERT INTO run_stats
+                          (run_id, user_id, project_name, command, exit_code, user_cpu, sys_cpu,
+                           max_rss, wall_seconds, bytes_out, killed)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+USER_PROJECTS_SQL = '''SELECT project_name FROM projects
+                       WHERE username = ? ORDER BY created_at DESC'''
+
+
+def _baseline(conn):
+    c = conn.cursor()
+
+    # Users table
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  username TEXT UNIQUE,
+                  ip_address TEXT,
+                  project_name TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    # Code files table
+    c.execute('''CREATE TABLE IF NOT EXISTS code_files
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  filename TEXT,
+                  content TEXT,
+                  project_name TEXT,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  version INTEGER DEFAULT 0,
+                  FOREIGN KEY (user_id) REFERENCES users(id),
+                  UNIQUE(user_id, filename, project_name))''')
+    columns = [row[1] for row in c.execute('PRAGMA table_info(code_files)')]
+    if 'version' not in columns:
+        c.execute('ALTER TABLE code_files ADD COLUMN version INTEGER DEFAULT 0')
+
+    # Edits applied since each file's last snapshot
+    c.execute('''CREATE TABLE IF NOT EXISTS code_file_ops
+                 (user_id INTEGER,
+                  project_name TEXT,
+                  filename TEXT,
+                  version INTEGER,
+                  ops TEXT,
+                  PRIMARY KEY (user_id, project_name, filename, version))''')
+
+    # Libraries table
+    c.execute('''CREATE TABLE IF NOT EXISTS libraries
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  package_name TEXT,
+                  version TEXT,
+                  command TEXT,
+                  project_name TEXT,
+                  installed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users(id))''')
+
+    # Terminal logs table
+    c.execute('''CREATE TABLE IF NOT EXISTS terminal_logs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  terminal_type TEXT,
+                  command TEXT,
+                  output TEXT,
+                  project_name TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users(id))''')
+
+
+def _users_per_project(conn):
+    # A users row is one (username, project) pair, but username alone was
+    # UNIQUE, so a second project for the same name could never be created
+    conn.execute('''CREATE TABLE users_new
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     username TEXT,
+                     ip_address TEXT,
+                     project_name TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     UNIQUE(username, project_name))''')
+    conn.execute('''INSERT INTO users_new (id, username, ip_address, project_name, created_at)
+                    SELECT id, username, ip_address, project_name, created_at FROM users''')
+    conn.execute('DROP TABLE users')
+    conn.execute('ALTER TABLE users_new RENAME TO users')
+
+
+def _indexes(conn):
+    # Latest file of a project, covering the filename it returns
+    conn.execute('''CREATE INDEX IF NOT EXISTS code_files_recent
+                    ON code_files (user_id, project_name, updated_at, filename)''')
+    # Keyset pages by id within a project (the rowid ends every index)
+    conn.execute('''CREATE INDEX IF NOT EXISTS code_files_project
+                    ON code_files (user_id, project_name)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS libraries_project
+                    ON libraries (user_id, project_name, installed_at, package_name, version)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS terminal_logs_project
+                    ON terminal_logs (user_id, project_name)''')
+
+
+def _track_updated_at(conn):
+    # Saves update rows in place (SAVE_CODE_SQL) instead of INSERT OR
+    # REPLACE, which deleted the row and gave it a new id on every save
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS code_files_updated_at
+                    AFTER UPDATE OF content, version ON code_files
+                    BEGIN
+                        UPDATE code_files SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+                    END''')
+
+
+def _projects(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS projects
+                    (user_id INTEGER PRIMARY KEY,
+                     username TEXT,
+                     project_name TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     FOREIGN KEY (user_id) REFERENCES users(id),
+                     UNIQUE(username, project_name))''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS projects_by_user
+                    ON projects (username, created_at, project_name)''')
+    conn.execute('''INSERT OR IGNORE INTO projects (user_id, username, project_name, created_at)
+                    SELECT id, username, project_name, created_at FROM users''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS users_project
+                    AFTER INSERT ON users
+                    BEGIN
+                        INSERT OR IGNORE INTO projects (user_id, username, project_name, created_at)
+                        VALUES (NEW.id, NEW.username, NEW.project_name, NEW.created_at);
+                    END''')
+
+
+def _project_expiry(conn):
+    # Last activity per project, so cleanup reads expired projects off an
+    # index instead of walking user_codes/
+    conn.execute('''CREATE TABLE IF NOT EXISTS project_expiry
+                    (user_id INTEGER,
+                     project_name TEXT,
+                     touched_at REAL,
+                     PRIMARY KEY (user_id, project_name))''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS project_expiry_touched
+                    ON project_expiry (touched_at)''')
+    conn.execute('''INSERT OR IGNORE INTO project_expiry (user_id, project_name, touched_at)
+                    SELECT user_id, project_name, MAX(strftime('%s', updated_at))
+                    FROM code_files GROUP BY user_id, project_name''')
+    conn.execute('''INSERT OR IGNORE INTO project_expiry (user_id, project_name, touched_at)
+                    SELECT id, project_name, strftime('%s', created_at) FROM users''')
+
+
+def _run_stats(conn):
+    # Resource usage of every sandboxed run or command
+    conn.execute('''CREATE TABLE IF NOT EXISTS run_stats
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     run_id TEXT,
+                     user_id INTEGER,
+                     project_name TEXT,
+                     command TEXT,
+                     exit_code INTEGER,
+                     user_cpu REAL,
+                     sys_cpu REAL,
+                     max_rss INTEGER,
+                     wall_seconds REAL,
+                     bytes_out INTEGER,
+                     killed TEXT,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS run_stats_project
+                    ON run_stats (user_id, project_name)''')
+
+
+def _file_index(conn):
+    # Size and content hash per file, so a project's file tree is listed
+    # from an index without reading any content
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(code_files)')]
+    if 'size' not in columns:
+        conn.execute('ALTER TABLE code_files ADD COLUMN size INTEGER')
+    if 'hash' not in columns:
+        conn.execute('ALTER TABLE code_files ADD COLUMN hash TEXT')
+    rows = conn.execute('SELECT id, content FROM code_files WHERE hash IS NULL').fetchall()
+    for row_id, content in rows:
+        data = (content or '').encode('utf-8', 'surrogatepass')
+        conn.execute('UPDATE code_files SET size = ?, hash = ? WHERE id = ?',
+                     (len(data), hashlib.sha256(data).hexdigest(), row_id))
+    conn.execute('''CREATE INDEX IF NOT EXISTS code_files_tree
+                    ON code_files (user_id, project_name, filename, size, hash, version,
+                                   updated_at)''')
+
+
+def _blobs(conn):
+    # File contents move into content-addressed, reference-counted blobs
+    # (blobstore.py); code_files.content is only kept for rows not yet moved
+    from blobstore import content_hash, encode_blob, encode_content
+    conn.execute('''CREATE TABLE IF NOT EXISTS blobs
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     hash TEXT UNIQUE NOT NULL,
+                     size INTEGER,
+                     encoding TEXT,
+                     data BLOB,
+                     refs INTEGER NOT NULL DEFAULT 0,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS blobs_garbage ON blobs (refs) WHERE refs <= 0''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS project_snapshots
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     project_name TEXT,
+                     tree TEXT,
+                     label TEXT,
+                     files INTEGER,
+                     bytes INTEGER,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS project_snapshots_project
+                    ON project_snapshots (user_id, project_name)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS snapshot_files
+                    (snapshot_id INTEGER,
+                     filename TEXT,
+                     hash TEXT,
+                     PRIMARY KEY (snapshot_id, filename)) WITHOUT ROWID''')
+
+    # Moving content out must not look like an edit
+    conn.execute('DROP TRIGGER IF EXISTS code_files_updated_at')
+    rows = conn.execute('SELECT id, content FROM code_files WHERE content IS NOT NULL').fetchall()
+    for row_id, content in rows:
+        data = encode_content(content)
+        digest = content_hash(data)
+        encoding, stored = encode_blob(data)
+        conn.execute('INSERT OR IGNORE INTO blobs (hash, size, encoding, data) VALUES (?, ?, ?, ?)',
+                     (digest, len(data), encoding, stored))
+        conn.execute('UPDATE code_files SET content = NULL, size = ?, hash = ? WHERE id = ?',
+                     (len(data), digest, row_id))
+    conn.execute('''UPDATE blobs SET refs = (SELECT COUNT(*) FROM code_files
+                                             WHERE code_files.hash = blobs.hash)''')
+    conn.execute('''CREATE TRIGGER code_files_updated_at
+                    AFTER UPDATE OF content, hash, version ON code_files
+                    BEGIN
+                        UPDATE code_files SET updated_at = CURRENT_TIMESTAMP WHERE id = NEW.id;
+                    END''')
+
+    # Reference counts follow the rows that point at blobs
+    for table in ('code_files', 'snapshot_files'):
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_blob_insert
+                         AFTER INSERT ON {table} WHEN NEW.hash IS NOT NULL
+                         BEGIN
+                             UPDATE blobs SET refs = refs + 1 WHERE hash = NEW.hash;
+                         END''')
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_blob_delete
+                         AFTER DELETE ON {table} WHEN OLD.hash IS NOT NULL
+                         BEGIN
+                             UPDATE blobs SET refs = refs - 1 WHERE hash = OLD.hash;
+                         END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS code_files_blob_update
+                    AFTER UPDATE OF hash ON code_files WHEN OLD.hash IS NOT NEW.hash
+                    BEGIN
+                        UPDATE blobs SET refs = refs - 1 WHERE hash = OLD.hash;
+                        UPDATE blobs SET refs = refs + 1 WHERE hash = NEW.hash;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS project_snapshots_files
+                    AFTER DELETE ON project_snapshots
+                    BEGIN
+                        DELETE FROM snapshot_files WHERE snapshot_id = OLD.id;
+                    END''')
+
+
+# Applied in order; PRAGMA user_version records the last one applied.
+# Never edit a released migration, append a new one.
+MIGRATIONS = (
+    (1, _baseline),
+    (2, _users_per_project),
+    (3, _indexes),
+    (4, _track_updated_at),
+    (5, _projects),
+    (6, _project_expiry),
+    (7, _run_stats),
+    (8, _file_index),
+    (9, _blobs),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def create_schema(conn):
+    """Bring the schema up to SCHEMA_VERSION; returns the version it started at.
+
+    Runs on the writer, inside its transaction, so a failing migration
+    leaves the database at the previous version.
+    """
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, migration in MIGRATIONS:
+        if version > current:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+    return current
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+
+def _executemany(conn, sql, rows):
+    return conn.executemany(sql, rows).rowcount
+
+
+class Database:
+    """Bounded SQLite connection pool with a single serialized writer.
+
+    Reads borrow a connection from the pool. Writes are queued to one
+    writer thread which commits whatever is waiting in a single
+    transaction, so concurrent saves share one fsync instead of fighting
+    over the database lock.
+    """
+
+    def __init__(self, path, pool_size=8, write_batch=256, timeout=30):
+        self.path = str(path)
+        self.pool_size = pool_size
+        self.write_batch = write_batch
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._writes = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """Borrow a pooled connection for read queries."""
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('database connection pool exhausted')
+        POOL_WAIT.observe(time.perf_counter() - started)
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def submit(self, fn, *args):
+        """Queue fn(conn, *args) on the writer thread and return a Future."""
+        future = Future()
+        if self._closed:
+            future.set_exception(sqlite3.ProgrammingError('database is closed'))
+            return future
+        self._ensure_writer()
+        self._writes.put((fn, args, future))
+        return future
+
+    def write(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def execute(self, sql, params=()):
+        """Run one write statement and return its lastrowid once committed."""
+        return self.write(_execute, sql, params)
+
+    def executemany(self, sql, rows):
+        return self.write(_executemany, sql, rows)
+
+    def _ensure_writer(self):
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer,
+                                                name='db-writer', daemon=True)
+                self._writer.start()
+
+    def _run_writer(self):
+        conn = self.connect()
+        running = True
+        while running:
+            job = self._writes.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.write_batch:
+                try:
+                    job = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                batch.append(job)
+            self._commit_batch(conn, batch)
+        conn.close()
+
+    def _commit_batch(self, conn, batch):
+        results = []
+        started = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            LOCK_WAIT.observe(time.perf_counter() - started)
+            for fn, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                # A savepoint per job keeps one failing write from
+                # rolling back the others committed alongside it.
+                conn.execute('SAVEPOINT job')
+                try:
+                    value = fn(conn, *args)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    results.append((future, e, False))
+                else:
+                    results.append((future, value, True))
+                conn.execute('RELEASE job')
+            conn.execute('COMMIT')
+            COMMIT_SECONDS.observe(time.perf_counter() - started)
+            BATCH_SIZE.observe(len(batch))
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future in batch:
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        for future, value, ok in results:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def stats(self):
+        return {
+            'pending_writes': self._writes.qsize(),
+            'idle_connections': self._idle.qsize(),
+            'pool_size': self.pool_size,
+        }
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def open_database(path, **kwargs):
+    database = Database(path, **kwargs)
+    atexit.register(database.close)
+    return database
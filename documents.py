@@ -0,0 +1,376 @@
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from blobstore import content_hash, encode_content, row_content
+
+# Write a full snapshot after this many edits, or this much op log text,
+# since the last one
+SNAPSHOT_EVERY = 100
+SNAPSHOT_BYTES = 64 * 1024
+
+# Pinned to the covering index: with the join, the planner's choice
+# between it and the unique key otherwise depends on table statistics
+LOAD_SQL = '''SELECT c.content, c.version, b.encoding, b.data FROM code_files c INDEXED BY code_files_tree
+              LEFT JOIN blobs b ON b.hash = c.hash
+              WHERE c.user_id = ? AND c.project_name = ? AND c.filename = ?'''
+LOAD_OPS_SQL = '''SELECT version, ops FROM code_file_ops
+                  WHERE user_id = ? AND project_name = ? AND filename = ? AND version > ?
+                  ORDER BY version'''
+# A plain INSERT: the version must be new, in the op log and in the saved
+# row, or another process got there first
+APPEND_OP_SQL = '''INSERT INTO code_file_ops (user_id, project_name, filename, version, ops)
+                   SELECT ?, ?, ?, ?, ?
+                   WHERE NOT EXISTS (SELECT 1 FROM code_files
+                                     WHERE user_id = ? AND project_name = ? AND filename = ?
+                                       AND version >= ?)'''
+# The newest version any process has committed
+DB_VERSION_SQL = '''SELECT max(coalesce((SELECT version FROM code_files
+                                         WHERE user_id = ? AND project_name = ? AND filename = ?), 0),
+                               coalesce((SELECT max(version) FROM code_file_ops
+                                         WHERE user_id = ? AND project_name = ? AND filename = ?), 0))'''
+TRIM_OPS_SQL = '''DELETE FROM code_file_ops
+                  WHERE user_id = ? AND project_name = ? AND filename = ? AND version <= ?'''
+
+
+class VersionMismatch(Exception):
+    """The client edited a version the server no longer has."""
+
+
+class VersionConflict(Exception):
+    """Another process committed the version this edit would have made."""
+
+
+def apply_ops(content, ops):
+    """Apply [offset, delete, insert] ops in order; offsets are code points."""
+    for offset, delete, insert in ops:
+        if not (0 <= offset <= len(content) and 0 <= delete <= len(content) - offset):
+            raise ValueError(f'op out of range: {offset}/{delete} on {len(content)} chars')
+        content = content[:offset] + insert + content[offset + delete:]
+    return content
+
+
+class Document:
+    """In-memory copy of one code file and how far it is persisted."""
+
+    def __init__(self, key, content, version):
+        self.key = key
+        self.content = content
+        self.version = version
+        self.snapshot_version = version
+        self.ops_since_snapshot = 0
+        self.op_bytes_since_snapshot = 0
+        self.touched = time.monotonic()
+        self.modified = time.time()
+        self.lock = threading.Lock()
+        self._digest = None
+
+    def digest(self):
+        """(size in bytes, content hash) of the current version, computed once."""
+        digest = self._digest
+        if digest is None or digest[0] != self.version:
+            data = encode_content(self.content)
+            digest = self._digest = (self.version, len(data), content_hash(data))
+        return digest[1:]
+
+    @property
+    def dirty(self):
+        return self.version != self.snapshot_version
+
+    @property
+    def size(self):
+        return len(self.content)
+
+
+class DocumentStore:
+    """LRU write-behind cache of versioned code files.
+
+    Every accepted edit bumps the document version and appends its ops
+    to code_file_ops. edit() and replace() return only once that append
+    is committed, so an acknowledged edit survives a crash. The
+    full snapshot (the code_files row and its blob) is written behind:
+    once a document has been idle for `debounce` seconds, after
+    SNAPSHOT_EVERY edits or SNAPSHOT_BYTES of op log, before a run
+    (snapshot()) and at shutdown (close()). The ops a snapshot covers
+    are then dropped; loading replays any newer ones.
+
+    Documents are kept in LRU order within `budget` characters. Dirty
+    documents are snapshotted before they are evicted.
+
+    With `shared`, other processes edit the same files through their
+    own stores. An append whose version is already taken (in the op log
+    or the saved row) fails instead of replacing the other edit. The
+    document is then reloaded and the edit reported as a VersionMismatch,
+    so the client rebases. Reads (get(), project_documents()) check the
+    database's version first and reload a copy that has fallen behind.
+    """
+
+    def __init__(self, database, save_snapshot, budget=64 * 1024 * 1024, debounce=2.0,
+                 shared=False):
+        self.database = database
+        self.save_snapshot = save_snapshot
+        self.budget = budget
+        self.debounce = debounce
+        self.shared = shared
+        self._docs = OrderedDict()
+        self._latest = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.flush_seconds_max = 0.0
+        self.conflicts = 0
+        self.reloads = 0
+
+    def get(self, key):
+        with self._lock:
+            doc = self._docs.get(key)
+            if doc is not None:
+                self._docs.move_to_end(key)
+        if doc is not None and self.shared and self._behind(doc):
+            doc = self._drop(doc)
+        with self._lock:
+            if doc is not None:
+                self.hits += 1
+                return doc
+            self.misses += 1
+        doc = self._load(key)
+        with self._lock:
+            # Another thread may have loaded it meanwhile; keep the first
+            existing = self._docs.get(key)
+            if existing is not None:
+                return existing
+            self._docs[key] = doc
+            self._size += doc.size
+        self._evict()
+        return doc
+
+    def _behind(self, doc):
+        """True if another process committed a newer version of doc."""
+        with self.database.reader() as conn:
+            version = conn.execute(DB_VERSION_SQL, doc.key + doc.key).fetchone()[0]
+        return version > doc.version
+
+    def _drop(self, doc):
+        """Uncache a stale doc so the next get() loads it afresh; returns None."""
+        with self._lock:
+            if self._docs.get(doc.key) is doc:
+                del self._docs[doc.key]
+                self._size -= doc.size
+            self.reloads += 1
+        return None
+
+    def latest(self, user_id, project_name):
+        """Filename most recently edited through the cache, if any."""
+        with self._lock:
+            return self._latest.get((user_id, project_name))
+
+    def _load(self, key):
+        user_id, project_name, filename = key
+        with self.database.reader() as conn:
+            row = conn.execute(LOAD_SQL, (user_id, project_name, filename)).fetchone()
+            content, version = (row_content(row[0], row[2], row[3]), row[1]) if row else ('', 0)
+            version = version or 0
+            replay = conn.execute(LOAD_OPS_SQL, (user_id, project_name, filename, version)).fetchall()
+        doc = Document(key, content, version)
+        for op_version, ops in replay:
+            doc.content = apply_ops(doc.content, json.loads(ops))
+            doc.version = op_version
+            doc.ops_since_snapshot += 1
+        return doc
+
+    def edit(self, key, base_version, ops):
+        """Apply ops made against base_version; returns the new version."""
+        doc = self.get(key)
+        with doc.lock:
+            if base_version != doc.version:
+                raise VersionMismatch(doc.version)
+            try:
+                self._apply(doc, apply_ops(doc.content, ops), ops)
+            except VersionConflict:
+                self._drop(doc)
+                raise VersionMismatch(None)
+            if (doc.ops_since_snapshot >= SNAPSHOT_EVERY
+                    or doc.op_bytes_since_snapshot >= SNAPSHOT_BYTES):
+                self._snapshot(doc)
+            version = doc.version
+        self._evict()
+        return version
+
+    def replace(self, key, content):
+        """Overwrite the whole document; returns the new version."""
+        while True:
+            doc = self.get(key)
+            with doc.lock:
+                try:
+                    # Logged as one op replacing everything, so it is durable too
+                    self._apply(doc, content, [[0, len(doc.content), content]])
+                except VersionConflict:
+                    # Whatever the other process wrote, this replaces it
+                    self._drop(doc)
+                    continue
+                if doc.op_bytes_since_snapshot >= SNAPSHOT_BYTES:
+                    self._snapshot(doc)
+                version = doc.version
+            self._evict()
+            return version
+
+    def _apply(self, doc, content, ops):
+        encoded = json.dumps(ops)
+        # Committed before the new version exists (and is acked): if the
+        # write fails, the document is left as it was
+        if not self.database.write(self._append_op, doc.key, doc.version + 1, encoded):
+            with self._lock:
+                self.conflicts += 1
+            raise VersionConflict(doc.version + 1)
+        with self._lock:
+            if self._docs.get(doc.key) is doc:
+                self._size += len(content) - doc.size
+            self._latest[doc.key[:2]] = doc.key[2]
+        doc.content = content
+        doc.version += 1
+        doc.touched = time.monotonic()
+        doc.modified = time.time()
+        doc.ops_since_snapshot += 1
+        doc.op_bytes_since_snapshot += len(encoded)
+        self._ensure_thread()
+
+    def snapshot(self, key):
+        """Persist the document now if it has unsnapshotted edits."""
+        with self._lock:
+            doc = self._docs.get(key)
+        if doc is None:
+            return
+        with doc.lock:
+            if doc.dirty:
+                self._snapshot(doc)
+
+    def _snapshot(self, doc):
+        started = time.perf_counter()
+        user_id, project_name, filename = doc.key
+        self.save_snapshot(user_id, filename, doc.content, project_name, doc.version)
+        self.database.submit(self._trim_ops, doc.key, doc.version)
+        doc.snapshot_version = doc.version
+        doc.ops_since_snapshot = 0
+        doc.op_bytes_since_snapshot = 0
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self.budget or len(self._docs) <= 1:
+                    return
+                key, doc = next(iter(self._docs.items()))
+            with doc.lock:
+                if doc.dirty:
+                    self._snapshot(doc)
+                with self._lock:
+                    if self._docs.get(key) is doc:
+                        del self._docs[key]
+                        self._size -= doc.size
+                        self.evictions += 1
+                        if self._latest.get(key[:2]) == key[2]:
+                            del self._latest[key[:2]]
+
+    def project_documents(self, user_id, project_name):
+        """Cached documents of one project (current ones, if shared)."""
+        with self._lock:
+            docs = [doc for key, doc in self._docs.items() if key[:2] == (user_id, project_name)]
+        if self.shared:
+            stale = [doc for doc in docs if self._behind(doc)]
+            for doc in stale:
+                self._drop(doc)
+            docs = [doc for doc in docs if doc not in stale]
+        return docs
+
+    def snapshot_project(self, user_id, project_name):
+        """Persist every cached document of one project, e.g. before export."""
+        with self._lock:
+            keys = [key for key in self._docs if key[:2] == (user_id, project_name)]
+        for key in keys:
+            self.snapshot(key)
+
+    def forget_project(self, user_id, project_name):
+        """Drop a project's documents without writing them, e.g. once purged."""
+        with self._lock:
+            for key in [key for key in self._docs if key[:2] == (user_id, project_name)]:
+                self._size -= self._docs.pop(key).size
+            self._latest.pop((user_id, project_name), None)
+
+    def flush_idle(self, idle=None):
+        """Snapshot dirty documents untouched for `idle` seconds."""
+        idle = self.debounce if idle is None else idle
+        now = time.monotonic()
+        with self._lock:
+            docs = [doc for doc in self._docs.values()
+                    if doc.dirty and now - doc.touched >= idle]
+        for doc in docs:
+            self.snapshot(doc.key)
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='doc-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.debounce / 2):
+            self.flush_idle()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush_idle(idle=0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'documents': len(self._docs),
+                'dirty': sum(1 for doc in self._docs.values() if doc.dirty),
+                'size': self._size,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'flushes': self.flushes,
+                'flush_seconds_avg': self.flush_seconds / self.flushes if self.flushes else 0.0,
+                'flush_seconds_max': self.flush_seconds_max,
+                'conflicts': self.conflicts,
+                'reloads': self.reloads,
+            }
+
+    @staticmethod
+    def _append_op(conn, key, version, ops):
+        """True if appended; False if another process already has that version."""
+        try:
+            return conn.execute(APPEND_OP_SQL, key + (version, ops) + key + (version,)).rowcount == 1
+        except sqlite3.IntegrityError:
+            return False
+
+    @staticmethod
+    def _trim_ops(conn, key, version):
+        user_id, project_name, filename = key
+        conn.execute(TRIM_OPS_SQL, (user_id, project_name, filename, version))
+
+
+def open_document_store(database, save_snapshot, **kwargs):
+    store = DocumentStore(database, save_snapshot, **kwargs)
+    atexit.register(store.close)
+    return store
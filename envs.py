@@ -0,0 +1,327 @@
+"""Per-project virtualenvs backed by a shared, content-addressed wheel store.
+
+Layout under the wheel store root:
+    blobs/<sha256>.whl       every wheel ever built or downloaded, by hash
+    files/<wheel filename>   hardlinks into blobs/, used as pip's --find-links
+    files/<filename>.sha256  the hash each named wheel points at
+    index/<name>-<version>   that hash again, by normalized name and version
+    unpacked/<sha256>/       the wheel's install tree, extracted once, read-only
+
+A project environment is a pip-less venv on the server's interpreter plus
+a .pth pointing at the shared base venv (which carries pip). Installing a
+package hardlinks the files from unpacked/ into the project's
+site-packages, so restoring an environment from the libraries table needs
+no network and no pip run once its wheels are in the store.
+
+A hardlink is the same file in every env that has it, so an edit to an
+installed package reaches every project using that wheel. Unpacked
+trees are made read-only, which stops accidental writes (an open() for
+writing fails). It is not isolation: runs have the server's uid, so
+they can chmod the file back and write it. Projects sharing a store
+must trust each other as far as their installed packages go; separate
+them with separate stores, or run untrusted code under its own uid.
+"""
+import hashlib
+import os
+import re
+import shutil
+import sysconfig
+import tempfile
+import threading
+import venv
+import zipfile
+from pathlib import Path
+
+WHEEL_NAME = re.compile(r'^(?P<name>[^-]+)-(?P<version>[^-]+)(-\d[^-]*)?-[^-]+-[^-]+-[^-]+\.whl$')
+
+
+def normalize_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_wheel_name(filename):
+    """Return (normalized name, version) for a wheel filename."""
+    match = WHEEL_NAME.match(filename)
+    if not match:
+        raise ValueError(f'not a wheel filename: {filename}')
+    return normalize_name(match.group('name')), match.group('version')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def dist_info_name(dirname):
+    """(normalized name, version) of a <name>-<version>.dist-info directory."""
+    name, _, version = dirname[:-len('.dist-info')].rpartition('-')
+    return normalize_name(name), version
+
+
+def uninstall(site, name):
+    """Remove every installed version of package `name` from site, by its RECORD."""
+    site = Path(site)
+    for dist_info in site.glob('*.dist-info'):
+        if dist_info_name(dist_info.name)[0] != name:
+            continue
+        dirs = set()
+        try:
+            record = (dist_info / 'RECORD').read_text().splitlines()
+        except OSError:
+            record = []
+        for line in record:
+            parts = Path(line.split(',', 1)[0]).parts
+            if len(parts) > 2 and parts[0].endswith('.data') and parts[1] in ('purelib', 'platlib'):
+                # Unpacked into site-packages itself (see WheelStore.unpack)
+                parts = parts[2:]
+            if not parts or '..' in parts or Path(*parts).is_absolute():
+                continue
+            path = site.joinpath(*parts)
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            dirs.update(parent for parent in path.parents if site in parent.parents)
+        shutil.rmtree(dist_info, ignore_errors=True)
+        # Package directories left empty (and their __pycache__)
+        for directory in sorted(dirs, key=lambda d: len(d.parts), reverse=True):
+            shutil.rmtree(directory / '__pycache__', ignore_errors=True)
+            try:
+                directory.rmdir()
+            except OSError:
+                pass
+
+
+def write_atomic(path, text):
+    tmp = path.with_name(f'.{path.name}.tmp')
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+
+def make_read_only(tree):
+    for dirpath, _, filenames in os.walk(tree):
+        for filename in filenames:
+            os.chmod(os.path.join(dirpath, filename), 0o444)
+        os.chmod(dirpath, 0o555)
+
+
+def remove_tree(tree):
+    """rmtree that also works on a read-only tree."""
+    for dirpath, _, _ in os.walk(tree):
+        os.chmod(dirpath, 0o755)
+    shutil.rmtree(tree, ignore_errors=True)
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class WheelStore:
+    """Content-addressed store of wheels and their unpacked install trees."""
+
+    def __init__(self, root):
+        self.root = Path(root).absolute()
+        self.blobs = self.root / 'blobs'
+        self.files = self.root / 'files'
+        self.unpacked = self.root / 'unpacked'
+        for path in (self.blobs, self.files, self.unpacked):
+            path.mkdir(parents=True, exist_ok=True)
+        self.index = self.root / 'index'
+        if not self.index.exists():
+            self._build_index()
+        self._lock = threading.Lock()
+
+    def _index_path(self, name, version):
+        return self.index / f'{normalize_name(name)}-{version}'
+
+    def _build_index(self):
+        """index/ from the sidecars of a store that predates it."""
+        # Its trees were unpacked writable, too
+        for tree in self.unpacked.iterdir():
+            if not tree.name.startswith('.'):
+                make_read_only(tree)
+        tmp = Path(tempfile.mkdtemp(dir=self.root, prefix='.index-'))
+        for sidecar in self.files.glob('*.whl.sha256'):
+            try:
+                name, version = parse_wheel_name(sidecar.name[:-len('.sha256')])
+            except ValueError:
+                continue
+            (tmp / self._index_path(name, version).name).write_text(sidecar.read_text().strip())
+        try:
+            os.replace(tmp, self.index)
+        except OSError:
+            # Another process built it first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def add(self, wheel_path):
+        """Store a wheel file; returns (name, version, sha256)."""
+        wheel_path = Path(wheel_path)
+        name, version = parse_wheel_name(wheel_path.name)
+        digest = file_sha256(wheel_path)
+        blob = self.blobs / f'{digest}.whl'
+        with self._lock:
+            if not blob.exists():
+                tmp = blob.with_suffix('.tmp')
+                shutil.copyfile(wheel_path, tmp)
+                os.replace(tmp, blob)
+            named = self.files / wheel_path.name
+            if not named.exists():
+                link_or_copy(blob, named)
+                (self.files / f'{wheel_path.name}.sha256').write_text(digest)
+                index = self._index_path(name, version)
+                if not index.exists():
+                    write_atomic(index, digest)
+        self.unpack(digest)
+        return name, version, digest
+
+    def find(self, name, version):
+        """Hash of a stored wheel for name==version, or None."""
+        try:
+            return self._index_path(name, version).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def unpack(self, digest):
+        """Extract a stored wheel's install tree once; returns its path."""
+        target = self.unpacked / digest
+        if target.exists():
+            return target
+        tmp = Path(tempfile.mkdtemp(dir=self.unpacked, prefix=f'.{digest[:12]}-'))
+        with zipfile.ZipFile(self.blobs / f'{digest}.whl') as wheel:
+            wheel.extractall(tmp)
+        # purelib/platlib payloads in <dist>.data belong in site-packages;
+        # scripts, headers and data files are not installed
+        for data_dir in tmp.glob('*.data'):
+            for lib in ('purelib', 'platlib'):
+                lib_dir = data_dir / lib
+                if lib_dir.is_dir():
+                    shutil.copytree(lib_dir, tmp, dirs_exist_ok=True)
+            shutil.rmtree(data_dir)
+        # Envs hardlink these files: an accidental write would reach them all
+        make_read_only(tmp)
+        try:
+            os.replace(tmp, target)
+        except OSError:
+            # Someone else unpacked it first
+            remove_tree(tmp)
+        return target
+
+
+class EnvironmentManager:
+    """Creates and restores one virtualenv per project (user_id)."""
+
+    def __init__(self, root, store, base_dir='venv'):
+        # Absolute, not resolved: resolving would follow the venv's python
+        # symlink back to the base interpreter
+        self.root = Path(root).absolute()
+        self.root.mkdir(exist_ok=True)
+        self.store = store
+        self.base_dir = Path(base_dir).absolute()
+        self._lock = threading.Lock()
+
+    def base_python(self):
+        """The shared base venv (with pip), created on first use."""
+        python = self.base_dir / 'bin' / 'python'
+        with self._lock:
+            if not python.exists():
+                venv.EnvBuilder(symlinks=True, with_pip=True).create(self.base_dir)
+        return python
+
+    def env_dir(self, user_id):
+        return self.root / str(user_id)
+
+    def python(self, user_id):
+        return self.env_dir(user_id) / 'bin' / 'python'
+
+    def site_packages(self, env_dir):
+        return Path(sysconfig.get_path('purelib', vars={'base': str(env_dir),
+                                                         'platbase': str(env_dir)}))
+
+    def ensure(self, user_id, locked=()):
+        """Create the project's env if needed and link its locked wheels.
+
+        `locked` is an iterable of (package_name, version) pairs, one per
+        package: the newest of the project's libraries rows. Pairs with no
+        stored wheel are skipped and returned.
+        """
+        locked = list(locked)
+        names = [normalize_name(name) for name, _ in locked]
+        if len(set(names)) != len(names):
+            raise ValueError('locked packages must be unique: '
+                             + ', '.join(sorted({n for n in names if names.count(n) > 1})))
+        env_dir = self.env_dir(user_id)
+        if not (env_dir / 'pyvenv.cfg').exists():
+            venv.EnvBuilder(symlinks=True, with_pip=False).create(env_dir)
+            base_site = self.site_packages(self.base_dir)
+            (self.site_packages(env_dir) / '_cyber20un_base.pth').write_text(f'{base_site}\n')
+            pip = env_dir / 'bin' / 'pip'
+            pip.write_text('#!/bin/sh\nexec "$(dirname "$0")/python" -m pip "$@"\n')
+            pip.chmod(0o755)
+        missing = []
+        digests = []
+        for name, version in locked:
+            digest = self.store.find(name, version)
+            if digest is None:
+                missing.append((name, version))
+            else:
+                digests.append(digest)
+        self.link(env_dir, digests)
+        return missing
+
+    def link(self, env_dir, digests):
+        """Hardlink unpacked wheels into the env's site-packages.
+
+        A version of the same package already there is uninstalled first,
+        so nothing only the old version had stays importable.
+        """
+        site = self.site_packages(env_dir)
+        for digest in digests:
+            tree = self.store.unpack(digest)
+            for dist_info in tree.glob('*.dist-info'):
+                uninstall(site, dist_info_name(dist_info.name)[0])
+            for dirpath, _, filenames in os.walk(tree):
+                dest_dir = site / os.path.relpath(dirpath, tree)
+                dest_dir.mkdir(parents=True, exist_ok=True)
+                for filename in filenames:
+                    dest = dest_dir / filename
+                    if dest.exists():
+                        dest.unlink()
+                    link_or_copy(os.path.join(dirpath, filename), dest)
+
+    def wheel_command(self, requirements, wheel_dir, offline):
+        """pip command that resolves requirements into wheel_dir via the store."""
+        command = [str(self.base_python()), '-m', 'pip', 'wheel',
+                   '--wheel-dir', str(wheel_dir),
+                   '--find-links', str(self.store.files)]
+        if offline:
+            command.append('--no-index')
+        return command + list(requirements)
+
+    def collect(self, user_id, wheel_dir):
+        """Add built wheels to the store and link them into the project env.
+
+        Returns the installed (name, version) pairs.
+        """
+        installed = []
+        digests = []
+        for wheel in sorted(Path(wheel_dir).glob('*.whl')):
+            name, version, digest = self.store.add(wheel)
+            installed.append((name, version))
+            digests.append(digest)
+        self.link(self.env_dir(user_id), digests)
+        return installed
+
+    def environ(self, user_id):
+        """Environment variables that activate the project's venv."""
+        env_dir = self.env_dir(user_id)
+        environ = dict(os.environ)
+        environ['VIRTUAL_ENV'] = str(env_dir)
+        environ['PATH'] = f'{env_dir / "bin"}{os.pathsep}{environ.get("PATH", "")}'
+        environ.pop('PYTHONHOME', None)
+        return environ
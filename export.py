@@ -0,0 +1,331 @@
+"""Streaming project export.
+
+Rows are read in keyset-paginated pages (WHERE id > last ORDER BY id), and
+code file contents are read in fixed-size pieces through incremental blob
+I/O (compressed blobs are inflated piece by piece), so an export holds at
+most one page and one piece in memory no matter how large the project is.
+Each page or piece borrows a pooled reader only for as long as the query
+takes, so a slow download never pins a connection.
+Terminal logs are streamed from the LogStore's partitions.
+"""
+import base64
+import binascii
+import codecs
+import itertools
+import json
+import time
+import zipfile
+import zlib
+
+from blobstore import row_content
+
+PAGE_ROWS = 200
+CONTENT_CHUNK = 256 * 1024
+MAX_API_LIMIT = 1000
+
+SECTIONS = ('code_files', 'libraries', 'terminal_logs')
+
+PAGE_SQL = {
+    'code_files': '''SELECT id, filename, updated_at FROM code_files
+                     WHERE user_id = ? AND project_name = ? AND id > ?
+                     ORDER BY id LIMIT ?''',
+    'libraries': '''SELECT id, package_name, version, command, installed_at FROM libraries
+                    WHERE user_id = ? AND project_name = ? AND id > ?
+                    ORDER BY id LIMIT ?''',
+}
+CONTENT_SQL = '''SELECT c.content, b.encoding, b.data FROM code_files c
+                 LEFT JOIN blobs b ON b.hash = c.hash WHERE c.id = ?'''
+# Where a row's content is: inline (legacy rows) or which blob, and its size
+SOURCE_SQL = '''SELECT c.content IS NOT NULL, b.id, b.encoding, b.size FROM code_files c
+                LEFT JOIN blobs b ON b.hash = c.hash WHERE c.id = ?'''
+
+
+class ExportOptions:
+    """What to export: the project row plus an optional log time range.
+
+    since and until are created_at strings ('YYYY-MM-DD HH:MM:SS', UTC).
+    """
+
+    def __init__(self, user_id, username, project_name, exported_at,
+                 include_logs=False, since=None, until=None):
+        self.user_id = user_id
+        self.username = username
+        self.project_name = project_name
+        self.exported_at = exported_at
+        self.include_logs = include_logs
+        self.since = since
+        self.until = until
+
+    @property
+    def sections(self):
+        return SECTIONS if self.include_logs else SECTIONS[:2]
+
+    def header(self):
+        return {
+            'username': self.username,
+            'project_name': self.project_name,
+            'exported_at': self.exported_at,
+        }
+
+
+def fetch_page(database, options, section, after, limit):
+    with database.reader() as conn:
+        return conn.execute(PAGE_SQL[section],
+                            (options.user_id, options.project_name, after, limit)).fetchall()
+
+
+def iter_rows(database, options, section, page_rows=PAGE_ROWS):
+    after = 0
+    while True:
+        rows = fetch_page(database, options, section, after, page_rows)
+        yield from rows
+        if len(rows) < page_rows:
+            return
+        after = rows[-1][0]
+
+
+def content_source(database, row_id):
+    """(table, column, id, encoding, size) to read a code file's content from, or None."""
+    with database.reader() as conn:
+        row = conn.execute(SOURCE_SQL, (row_id,)).fetchone()
+    if row is None:
+        return None
+    inline, blob_id, encoding, size = row
+    if inline:
+        return 'code_files', 'content', row_id, 'raw', None
+    if blob_id is None:
+        return None
+    return 'blobs', 'data', blob_id, encoding, size
+
+
+def content_size(database, row_id):
+    source = content_source(database, row_id)
+    if source is None:
+        return 0
+    table, column, source_id, _, size = source
+    if size is not None:
+        # Blobs know their size without being read
+        return size
+    with database.reader() as conn:
+        if not hasattr(conn, 'blobopen'):
+            return None
+        try:
+            with conn.blobopen(table, column, source_id, readonly=True) as blob:
+                return len(blob)
+        except Exception:
+            # NULL content or the row vanished
+            return 0
+
+
+def read_pieces(database, table, column, row_id, chunk=CONTENT_CHUNK):
+    """Yield a column's value in pieces of at most `chunk` bytes."""
+    offset = 0
+    while True:
+        with database.reader() as conn:
+            if not hasattr(conn, 'blobopen'):
+                # No incremental blob I/O before Python 3.11
+                row = conn.execute(f'SELECT {column} FROM {table} WHERE id = ?',
+                                   (row_id,)).fetchone()
+                value = row[0] if row and row[0] and not offset else b''
+                data = value.encode() if isinstance(value, str) else bytes(value)
+            else:
+                try:
+                    with conn.blobopen(table, column, row_id, readonly=True) as blob:
+                        blob.seek(offset)
+                        data = blob.read(chunk)
+                except Exception:
+                    data = b''
+        if not data:
+            return
+        offset += len(data)
+        yield data
+
+
+def inflate(pieces, chunk=CONTENT_CHUNK):
+    """Decompress zlib pieces, yielding at most `chunk` bytes at a time."""
+    decompressor = zlib.decompressobj()
+    for piece in pieces:
+        data = decompressor.decompress(piece, chunk)
+        while data:
+            yield data
+            data = decompressor.decompress(decompressor.unconsumed_tail, chunk)
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def iter_content(database, row_id, chunk=CONTENT_CHUNK):
+    """Yield a code file's UTF-8 content in pieces of at most `chunk` bytes."""
+    source = content_source(database, row_id)
+    if source is None:
+        return
+    table, column, source_id, encoding, _ = source
+    pieces = read_pieces(database, table, column, source_id, chunk)
+    yield from inflate(pieces, chunk) if encoding == 'zlib' else pieces
+
+
+def iter_text(database, row_id):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for data in iter_content(database, row_id):
+        text = decoder.decode(data)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def library_record(row):
+    _, package, version, command, installed_at = row
+    return {'package': package, 'version': version, 'command': command,
+            'installed_at': installed_at}
+
+
+def iter_logs(logs, options, after=None):
+    return logs.iter_project(options.user_id, options.project_name,
+                             options.since, options.until, after)
+
+
+def _line(record):
+    return (json.dumps(record) + '\n').encode()
+
+
+def ndjson_export(database, logs, options):
+    """Yield the project as NDJSON: one typed record per line."""
+    yield _line({'type': 'project', **options.header()})
+
+    for row_id, filename, updated_at in iter_rows(database, options, 'code_files'):
+        # The content is streamed as pieces of one JSON string
+        head = json.dumps({'type': 'code_file', 'filename': filename, 'updated_at': updated_at})
+        yield (head[:-1] + ', "content": "').encode()
+        for text in iter_text(database, row_id):
+            yield json.dumps(text)[1:-1].encode()
+        yield b'"}\n'
+
+    for row in iter_rows(database, options, 'libraries'):
+        yield _line({'type': 'library', **library_record(row)})
+
+    if options.include_logs:
+        for _, record in iter_logs(logs, options):
+            yield _line({'type': 'terminal_log', **record})
+
+
+class _ZipStream:
+    """Unseekable sink for ZipFile that hands written bytes back out."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _zip_entry(name):
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def zip_export(database, logs, options):
+    """Yield the project as a zip archive, produced entry by entry.
+
+    Layout: project.json, files/<filename>, libraries.ndjson and, with
+    logs included, terminal_logs.ndjson.
+    """
+    sink = _ZipStream()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('project.json', json.dumps(options.header(), indent=2))
+        yield sink.drain()
+
+        for row_id, filename, _ in iter_rows(database, options, 'code_files'):
+            info = _zip_entry(f'files/{filename}')
+            size = content_size(database, row_id)
+            if size is not None:
+                info.file_size = size
+            with archive.open(info, 'w', force_zip64=size is None) as entry:
+                for data in iter_content(database, row_id):
+                    entry.write(data)
+                    yield sink.drain()
+            yield sink.drain()
+
+        sections = [('libraries.ndjson',
+                     (library_record(row) for row in iter_rows(database, options, 'libraries')))]
+        if options.include_logs:
+            sections.append(('terminal_logs.ndjson',
+                             (record for _, record in iter_logs(logs, options))))
+        for name, records in sections:
+            with archive.open(_zip_entry(name), 'w', force_zip64=True) as entry:
+                for record in records:
+                    entry.write(_line(record))
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def encode_cursor(section, after):
+    return base64.urlsafe_b64encode(json.dumps([section, after]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(section, position) from an opaque cursor; ValueError if malformed.
+
+    Positions are row ids, except in terminal_logs where they are
+    LogStore position strings.
+    """
+    try:
+        section, after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, TypeError, ValueError, UnicodeError):
+        raise ValueError('invalid cursor')
+    if section not in SECTIONS or not isinstance(after, str if section == 'terminal_logs' else int):
+        raise ValueError('invalid cursor')
+    return section, after
+
+
+def json_page(database, logs, options, cursor=None, limit=PAGE_ROWS):
+    """One page of the JSON export, walking sections in order.
+
+    Returns the header plus up to `limit` rows grouped by section and a
+    next_cursor to pass back, or None once the export is complete.
+    """
+    sections = list(options.sections)
+    section, after = decode_cursor(cursor) if cursor else (sections[0], None)
+    if section not in sections:
+        raise ValueError('invalid cursor')
+    page = {**options.header(), **{name: [] for name in sections}}
+    remaining = limit
+
+    for name in sections[sections.index(section):]:
+        if name == 'terminal_logs':
+            positions = list(itertools.islice(iter_logs(logs, options, after), remaining))
+            page[name] = [record for _, record in positions]
+            last = positions[-1][0] if positions else None
+        else:
+            rows = fetch_page(database, options, name, after or 0, remaining)
+            if name == 'code_files':
+                with database.reader() as conn:
+                    page[name] = [{'filename': filename,
+                                   'content': row_content(*(conn.execute(CONTENT_SQL, (row_id,)).fetchone()
+                                                            or ('', None, None))),
+                                   'updated_at': updated_at}
+                                  for row_id, filename, updated_at in rows]
+            else:
+                page[name] = [library_record(row) for row in rows]
+            last = rows[-1][0] if rows else None
+        remaining -= len(page[name])
+        if remaining == 0:
+            page['next_cursor'] = encode_cursor(name, last)
+            return page
+        after = None
+
+    page['next_cursor'] = None
+    return page
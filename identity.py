@@ -0,0 +1,193 @@
+"""Cache of user ids and project lists, in front of the users table.
+
+A classroom starting at once means hundreds of logins within seconds,
+mostly for (username, project) pairs that already exist. Ids are cached
+per process for `ttl` seconds, so a returning login costs no query, and
+concurrent lookups of the same key share one: the first caller queries,
+the others wait for its answer. New pairs are created by one upsert
+that returns the id whether the row was inserted or already there, so
+two racing logins can't both insert.
+
+User rows are never deleted (purging a project deletes its files, not
+its user), so a cached id never goes stale. A username's project list
+can: another worker may create a project for it, so lists expire after
+`ttl`, and a list that lacks the session's own project is reloaded.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from db import FIND_USER_SQL, USER_PROJECTS_SQL
+
+UPSERT_USER_SQL = '''INSERT INTO users (username, ip_address, project_name) VALUES (?, ?, ?)
+                     ON CONFLICT (username, project_name) DO UPDATE SET username = username
+                     RETURNING id'''
+
+
+def _upsert_user(conn, username, ip_address, project_name):
+    return conn.execute(UPSERT_USER_SQL, (username, ip_address, project_name)).fetchone()[0]
+
+
+class TTLCache:
+    """LRU of at most max_entries values, each kept for ttl seconds."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class IdentityCache:
+    """User ids by (username, project) and project lists by username."""
+
+    def __init__(self, database, ttl=300, max_entries=100000):
+        self.database = database
+        self.users = TTLCache(ttl, max_entries)
+        self.projects = TTLCache(ttl, max_entries)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.created = 0
+        self.project_hits = 0
+        self.project_misses = 0
+
+    def _shared(self, key, load):
+        """load(), run once for all callers asking for key at the same time."""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self._inflight[key] = Future()
+                leader = True
+        if not leader:
+            return future.result()
+        try:
+            value = load()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def user_id(self, username, project_name, ip_address=None):
+        """The id of (username, project_name), created on first login."""
+        key = (username, project_name)
+        user_id = self.users.get(key)
+        if user_id is not None:
+            with self._lock:
+                self.hits += 1
+            return user_id
+        with self._lock:
+            self.misses += 1
+        return self._shared(('user',) + key,
+                            lambda: self._load_user(username, project_name, ip_address, True))
+
+    def find(self, username, project_name):
+        """The id of (username, project_name), or None if it was never created."""
+        key = (username, project_name)
+        user_id = self.users.get(key)
+        if user_id is not None:
+            with self._lock:
+                self.hits += 1
+            return user_id
+        with self._lock:
+            self.misses += 1
+        return self._shared(('find',) + key, lambda: self._load_user(username, project_name))
+
+    def _load_user(self, username, project_name, ip_address=None, create=False):
+        with self.database.reader() as conn:
+            row = conn.execute(FIND_USER_SQL, (username, project_name)).fetchone()
+        if row is not None:
+            user_id = row[0]
+        elif not create:
+            return None
+        else:
+            user_id = self.database.write(_upsert_user, username, ip_address, project_name)
+            with self._lock:
+                self.created += 1
+            # Maybe a new project for this username
+            self.projects.discard(username)
+        self.users.put((username, project_name), user_id)
+        return user_id
+
+    def project_names(self, username, current=None):
+        """The username's projects, newest first.
+
+        `current`, a project the caller knows exists, forces a reload if
+        the cached list lacks it.
+        """
+        projects = self.projects.get(username)
+        if projects is not None and (current is None or current in projects):
+            with self._lock:
+                self.project_hits += 1
+            return projects
+        with self._lock:
+            self.project_misses += 1
+        return self._shared(('projects', username), lambda: self._load_projects(username))
+
+    def _load_projects(self, username):
+        with self.database.reader() as conn:
+            projects = [row[0] for row in conn.execute(USER_PROJECTS_SQL, (username,))]
+        self.projects.put(username, projects)
+        return projects
+
+    def forget(self, username, project_name=None):
+        """Drop what is cached about a username, or one of its projects."""
+        if project_name is not None:
+            self.users.discard((username, project_name))
+        self.projects.discard(username)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self.users),
+                'project_lists': len(self.projects),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'coalesced': self.coalesced,
+                'created': self.created,
+                'project_hits': self.project_hits,
+                'project_misses': self.project_misses,
+            }
@@ -0,0 +1,499 @@
+"""pip install commands, parsed and run as a pipeline.
+
+A command such as `pip install -U "requests>=2.30" numpy==1.26.4 -r
+requirements.txt` is parsed into requirements plus the pip options we
+pass on. Requirements the project already satisfies (its libraries
+rows, newest per package) are skipped, so repeating an install costs no
+pip run. The rest are resolved in parallel, one `pip wheel` per
+requirement: offline from the wheel store first, from the index only if
+that fails. An upgrade (-U, --force-reinstall) skips both the check and
+the offline attempt: pip wheel always takes the newest matching release,
+so resolving against the index is what upgrades. If two requirements
+resolved different versions of a shared dependency, one joint offline
+resolution over the downloaded wheels settles it. Progress is reported
+as events (see Installer.install) and the wheels are linked into the
+project's env in one go.
+
+Requirement files may pin hashes (`pkg==1.0 --hash=sha256:...`). pip
+then checks every requirement and dependency against them, which needs
+the whole file in one run, so a hashed install is resolved as one
+`pip wheel --require-hashes -r` instead of per requirement.
+
+Only plain version specifiers are compared here; anything else (pre-
+releases, markers, URLs) is left to pip. A requirement with extras
+(`pkg[socks]`) is never taken as satisfied: the libraries rows don't
+record which extras were installed.
+"""
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from envs import normalize_name, parse_wheel_name
+
+INSTALL_PREFIXES = (('pip', 'install'), ('pip3', 'install'),
+                    ('python', '-m', 'pip', 'install'), ('python3', '-m', 'pip', 'install'))
+# Passed on to pip wheel, with a value
+VALUE_OPTIONS = {'-i': '--index-url', '--index-url': '--index-url',
+                 '--extra-index-url': '--extra-index-url', '-f': '--find-links',
+                 '--find-links': '--find-links'}
+# Passed on as they are
+FLAG_OPTIONS = {'--pre', '--no-deps', '--prefer-binary', '--only-binary=:all:'}
+UPGRADE_OPTIONS = {'-U', '--upgrade', '--force-reinstall'}
+# Meaningless here: wheels always go to the project's env
+IGNORED_OPTIONS = {'-q', '--quiet', '-v', '--verbose', '--user', '--no-cache-dir',
+                   '--no-warn-script-location', '--disable-pip-version-check', '--upgrade-strategy'}
+REQUIREMENT_FILE_OPTIONS = {'-r', '--requirement'}
+
+NAME = re.compile(r'^([A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)\s*(\[[^\]]*\])?\s*(.*)$')
+SPECIFIER = re.compile(r'^(===|==|!=|~=|>=|<=|>|<)\s*(\S+)$')
+RELEASE = re.compile(r'^v?(\d+(?:\.\d+)*)$')
+PARALLEL = 4
+
+
+class InstallError(ValueError):
+    """An install command we can't parse or run."""
+
+
+class Requirement:
+    """One requirement; name is None for URLs and paths, which pip handles alone."""
+
+    def __init__(self, text, name=None, specifiers=(), extras=()):
+        self.text = text
+        self.name = name
+        self.specifiers = list(specifiers)
+        self.extras = frozenset(extras)
+        # --hash values from a requirement file
+        self.hashes = []
+
+    def line(self):
+        """The requirement as a requirement file line, with its hashes."""
+        return ' '.join([self.text] + [f'--hash={value}' for value in self.hashes])
+
+    def __repr__(self):
+        return f'Requirement({self.text!r})'
+
+
+class InstallRequest:
+    """What an install command asks for."""
+
+    def __init__(self, requirements, options, upgrade=False):
+        self.requirements = requirements
+        self.options = options
+        self.upgrade = upgrade
+
+    @property
+    def hashed(self):
+        return any(requirement.hashes for requirement in self.requirements)
+
+
+def parse_requirement(text):
+    text = text.strip()
+    if '://' in text or '/' in text or text.startswith('.') or ' @ ' in text \
+            or text.endswith(('.whl', '.tar.gz', '.zip')):
+        return Requirement(text)
+    match = NAME.match(text)
+    if not match:
+        raise InstallError(f'invalid requirement: {text!r}')
+    name, extras, rest = match.groups()
+    extras = [normalize_name(e.strip()) for e in (extras or '[]')[1:-1].split(',') if e.strip()]
+    rest = rest.split(';', 1)[0].strip()
+    specifiers = []
+    for part in filter(None, (p.strip() for p in rest.split(','))):
+        spec = SPECIFIER.match(part)
+        if not spec:
+            raise InstallError(f'invalid version specifier in {text!r}: {part!r}')
+        specifiers.append(spec.groups())
+    return Requirement(text, normalize_name(name), specifiers, extras)
+
+
+def install_args(command):
+    """The arguments after `pip install`, or None if command isn't an install."""
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    for prefix in INSTALL_PREFIXES:
+        if tuple(words[:len(prefix)]) == prefix:
+            return words[len(prefix):]
+    return None
+
+
+def is_install(command):
+    return install_args(command) is not None
+
+
+def parse_install(command, read_file=None):
+    """An InstallRequest for a pip install command.
+
+    read_file(name) returns a project file's bytes, or None; it serves
+    -r requirement files.
+    """
+    args = install_args(command)
+    if args is None:
+        raise InstallError('not a pip install command')
+    return _parse_args(args, read_file, nested=False)
+
+
+def _parse_args(args, read_file, nested):
+    requirements = []
+    options = []
+    upgrade = False
+    words = iter(args)
+    for word in words:
+        option, eq, inline = word.partition('=') if word.startswith('--') else (word, '', '')
+        if word.startswith('-') and len(word) > 2 and not word.startswith('--') \
+                and word[:2] in VALUE_OPTIONS.keys() | REQUIREMENT_FILE_OPTIONS:
+            # -rrequirements.txt, -ihttps://...
+            option, eq, inline = word[:2], '=', word[2:]
+        if option in VALUE_OPTIONS or option in REQUIREMENT_FILE_OPTIONS:
+            value = inline if eq else next(words, None)
+            if not value:
+                raise InstallError(f'{option} needs a value')
+            if option in REQUIREMENT_FILE_OPTIONS:
+                if nested:
+                    raise InstallError('nested requirement files are not supported')
+                if read_file is None:
+                    raise InstallError('requirement files are not supported here')
+                nested_request = _parse_requirement_file(value, read_file)
+                requirements.extend(nested_request.requirements)
+                options.extend(nested_request.options)
+                upgrade = upgrade or nested_request.upgrade
+            else:
+                options.extend([VALUE_OPTIONS[option], value])
+        elif word in FLAG_OPTIONS:
+            options.append(word)
+        elif word in UPGRADE_OPTIONS:
+            upgrade = True
+        elif option == '--hash':
+            # Only valid after a requirement, in a requirement file (as in pip)
+            value = inline if eq else next(words, None)
+            if not nested:
+                raise InstallError('--hash is only allowed in requirement files')
+            if not requirements or not value:
+                raise InstallError('--hash needs a requirement and a value')
+            requirements[-1].hashes.append(value)
+        elif option in IGNORED_OPTIONS:
+            if option == '--upgrade-strategy' and not eq:
+                next(words, None)
+        elif word.startswith('-'):
+            raise InstallError(f'unsupported option: {word}')
+        else:
+            requirements.append(parse_requirement(word))
+    return InstallRequest(requirements, options, upgrade)
+
+
+def _parse_requirement_file(name, read_file):
+    data = read_file(name)
+    if data is None:
+        raise InstallError(f'requirement file not found: {name}')
+    args = []
+    for line in data.decode('utf-8', 'replace').splitlines():
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('-'):
+            args.extend(shlex.split(line))
+        else:
+            # A requirement may contain spaces; per-line options (--hash) follow it
+            requirement, _, options = line.partition(' --')
+            args.append(requirement.strip())
+            if options:
+                args.extend(shlex.split('--' + options))
+    return _parse_args(args, read_file, nested=True)
+
+
+def release(version):
+    """A plain release version as a tuple of ints, or None (pre-releases etc.)."""
+    match = RELEASE.match(version)
+    return tuple(int(part) for part in match.group(1).split('.')) if match else None
+
+
+def _compare(a, b):
+    width = max(len(a), len(b))
+    a, b = a + (0,) * (width - len(a)), b + (0,) * (width - len(b))
+    return (a > b) - (a < b)
+
+
+def _matches(version, op, wanted):
+    if op == '===':
+        return version == wanted
+    if wanted.endswith('.*') and op in ('==', '!='):
+        have, prefix = release(version), release(wanted[:-2])
+        if have is None or prefix is None:
+            return None
+        hit = have[:len(prefix)] + (0,) * (len(prefix) - len(have)) == prefix
+        return hit if op == '==' else not hit
+    have, want = release(version), release(wanted)
+    if have is None or want is None:
+        # Not a plain version: only an exact match is certain
+        return True if op == '==' and version == wanted else None
+    order = _compare(have, want)
+    if op == '~=':
+        return order >= 0 and len(want) > 1 and have[:len(want) - 1] == want[:-1]
+    return {'==': order == 0, '!=': order != 0, '>=': order >= 0,
+            '<=': order <= 0, '>': order > 0, '<': order < 0}[op]
+
+
+def satisfied(requirement, installed):
+    """True if installed ({name: version}) certainly satisfies requirement."""
+    if requirement.name is None or requirement.extras:
+        return False
+    version = installed.get(requirement.name)
+    if version is None:
+        return False
+    return all(_matches(version, op, wanted) is True for op, wanted in requirement.specifiers)
+
+
+def latest_versions(libraries):
+    """{name: version} from (name, version) rows ordered newest first."""
+    installed = {}
+    for name, version in libraries:
+        installed.setdefault(normalize_name(name), version)
+    return installed
+
+
+def _label(requirements):
+    return ' '.join(requirement.text for requirement in requirements)
+
+
+def _pip_args(unit, wheel_dir):
+    """pip wheel arguments for a unit (a list of requirements)."""
+    if not any(requirement.hashes for requirement in unit):
+        return [requirement.text for requirement in unit]
+    # --hash is only accepted in a requirement file
+    path = wheel_dir.parent / f'{wheel_dir.name}.txt'
+    path.write_text(''.join(requirement.line() + '\n' for requirement in unit))
+    return ['--require-hashes', '-r', str(path)]
+
+
+def _pins(packages):
+    return ' '.join(f'{name}-{version}' for name, version in packages)
+
+
+def describe(event):
+    """One line of text for an install event, for the log and plain clients."""
+    stage, package = event['stage'], event.get('package')
+    seconds = f' in {event["seconds"]:.2f}s' if 'seconds' in event else ''
+    if stage == 'satisfied':
+        return f'Requirement already satisfied: {package} ({event["version"]})'
+    if stage == 'resolving':
+        return f'Resolving {package}...'
+    if stage == 'resolved':
+        source = 'wheel cache' if event['source'] == 'cache' else 'package index'
+        return f'Resolved {package} from {source}{seconds}: {_pins(event["packages"])}'
+    if stage == 'failed':
+        return f'[ERROR] Could not resolve {package}{seconds}'
+    if stage == 'conflict':
+        return f'Versions of {", ".join(event["packages"])} differ, resolving together'
+    if stage == 'installed':
+        return f'Installed {package}-{event["version"]}'
+    if event['packages']:
+        return f'Successfully installed {_pins(event["packages"])}{seconds}'
+    return f'Nothing to install{seconds}'
+
+
+class ProcessGroup:
+    """The pip processes of one install, killed together on cancel."""
+
+    def __init__(self):
+        self._processes = []
+        self._killed = False
+        self._lock = threading.Lock()
+
+    def add(self, process):
+        with self._lock:
+            self._processes.append(process)
+            if self._killed:
+                process.kill()
+
+    def poll(self):
+        # Live until killed: a process may still be about to start
+        return -9 if self._killed else None
+
+    def kill(self):
+        with self._lock:
+            self._killed = True
+            for process in self._processes:
+                if process.poll() is None:
+                    process.kill()
+
+    @property
+    def killed(self):
+        return self._killed
+
+
+class Installer:
+    """Runs parsed installs into project envs (envs.EnvironmentManager)."""
+
+    def __init__(self, envs, parallel=PARALLEL):
+        self.envs = envs
+        self.parallel = parallel
+        self._slots = threading.BoundedSemaphore(parallel)
+        self._lock = threading.Lock()
+        self.installs = 0
+        self.noops = 0
+        self.resolved_offline = 0
+        self.resolved_online = 0
+        self.conflicts = 0
+        self.failures = 0
+
+    def install(self, job, user_id, request, installed, on_event, on_output=None):
+        """Install request into the env of user_id; returns the (name, version) installed.
+
+        installed is the project's {name: version}. on_event(event) gets
+        a dict per step: {'stage': 'satisfied' | 'resolving' | 'resolved'
+        | 'failed' | 'conflict' | 'installed' | 'done', 'package': ...,
+        plus 'version', 'source', 'seconds', 'packages' where they
+        apply}. on_output(bytes) gets pip's output when a step fails.
+        """
+        started = time.perf_counter()
+        pending = []
+        for requirement in request.requirements:
+            if not request.upgrade and satisfied(requirement, installed):
+                on_event({'stage': 'satisfied', 'package': requirement.text,
+                          'version': installed[requirement.name]})
+            else:
+                pending.append(requirement)
+        if pending and request.hashed:
+            # pip checks hashes over the whole file: resolve all of it as one
+            pending = [request.requirements]
+        else:
+            pending = [[requirement] for requirement in pending]
+        if not pending:
+            with self._lock:
+                self.noops += 1
+            on_event({'stage': 'done', 'packages': [], 'seconds': time.perf_counter() - started})
+            return []
+
+        group = ProcessGroup()
+        job.attach(group)
+        work = Path(tempfile.mkdtemp(prefix='cyber20un-wheels-'))
+        try:
+            dirs = self._resolve_all(pending, request.options, request.upgrade, work, group,
+                                     on_event, on_output)
+            if dirs is None:
+                return []
+            merged = self._merge(pending, request.options, dirs, work, group, on_event, on_output)
+            if merged is None:
+                return []
+            packages = self.envs.collect(user_id, merged)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        with self._lock:
+            self.installs += 1
+        for name, version in packages:
+            on_event({'stage': 'installed', 'package': name, 'version': version})
+        on_event({'stage': 'done', 'packages': packages, 'seconds': time.perf_counter() - started})
+        return packages
+
+    def _run(self, command, group):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        group.add(process)
+        output, _ = process.communicate()
+        return process.returncode, output
+
+    def _resolve(self, unit, options, upgrade, wheel_dir, group):
+        """(source, output) after resolving a unit into wheel_dir; source None on failure."""
+        args = options + _pip_args(unit, wheel_dir)
+        with self._slots:
+            if group.killed:
+                return None, b''
+            if not upgrade:
+                code, output = self._run(self.envs.wheel_command(args, wheel_dir, offline=True),
+                                         group)
+                if code == 0:
+                    return 'cache', output
+                if group.killed:
+                    return None, output
+            code, output = self._run(self.envs.wheel_command(args, wheel_dir, offline=False), group)
+            return ('index' if code == 0 else None), output
+
+    def _resolve_all(self, pending, options, upgrade, work, group, on_event, on_output):
+        """Resolve every unit in parallel; their wheel dirs, or None if one failed."""
+        results = [None] * len(pending)
+
+        def resolve(i, unit):
+            wheel_dir = work / str(i)
+            wheel_dir.mkdir()
+            on_event({'stage': 'resolving', 'package': _label(unit)})
+            step = time.perf_counter()
+            source, output = self._resolve(unit, options, upgrade, wheel_dir, group)
+            results[i] = (wheel_dir, source, output, time.perf_counter() - step)
+
+        threads = [threading.Thread(target=resolve, args=(i, unit), name='pip-resolve')
+                   for i, unit in enumerate(pending)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        failed = False
+        for unit, (wheel_dir, source, output, seconds) in zip(pending, results):
+            if source is None:
+                failed = True
+                with self._lock:
+                    self.failures += 1
+                on_event({'stage': 'failed', 'package': _label(unit), 'seconds': seconds})
+                if on_output is not None and output:
+                    on_output(output)
+                continue
+            with self._lock:
+                if source == 'cache':
+                    self.resolved_offline += 1
+                else:
+                    self.resolved_online += 1
+            wheels = [parse_wheel_name(path.name) for path in sorted(wheel_dir.glob('*.whl'))]
+            on_event({'stage': 'resolved', 'package': _label(unit), 'source': source,
+                      'seconds': seconds, 'packages': wheels})
+        return None if failed else [wheel_dir for wheel_dir, *_ in results]
+
+    def _merge(self, pending, options, dirs, work, group, on_event, on_output):
+        """One directory with one wheel per package; None if that can't be had."""
+        merged = work / 'merged'
+        merged.mkdir()
+        versions = {}
+        for wheel_dir in dirs:
+            for path in wheel_dir.glob('*.whl'):
+                name, version = parse_wheel_name(path.name)
+                versions.setdefault(name, set()).add(version)
+                if not (merged / path.name).exists():
+                    shutil.copyfile(path, merged / path.name)
+        clashes = sorted(name for name, found in versions.items() if len(found) > 1)
+        if not clashes:
+            return merged
+
+        # Resolved separately, the requirements disagree on a shared
+        # dependency: resolve them together, offline, from what we have
+        with self._lock:
+            self.conflicts += 1
+        on_event({'stage': 'conflict', 'packages': clashes})
+        joint = work / 'joint'
+        joint.mkdir()
+        requirements = [requirement for unit in pending for requirement in unit]
+        command = self.envs.wheel_command(options + ['--find-links', str(merged)]
+                                          + [r.text for r in requirements], joint, offline=True)
+        code, output = self._run(command, group)
+        if code != 0:
+            with self._lock:
+                self.failures += 1
+            on_event({'stage': 'failed', 'package': _label(requirements)})
+            if on_output is not None and output:
+                on_output(output)
+            return None
+        return joint
+
+    def stats(self):
+        with self._lock:
+            return {
+                'installs': self.installs,
+                'noops': self.noops,
+                'resolved_offline': self.resolved_offline,
+                'resolved_online': self.resolved_online,
+                'conflicts': self.conflicts,
+                'failures': self.failures,
+            }
@@ -0,0 +1,190 @@
+import atexit
+import codecs
+import queue
+import sqlite3
+import threading
+import time
+
+from logstore import timestamp
+
+
+class RunLog:
+    """Line buffer for one run; sealed into a terminal_logs row per chunk."""
+
+    def __init__(self, sink, run_id, user_id, terminal_type, command, project_name):
+        self.sink = sink
+        self.run_id = run_id
+        self.key = (user_id, terminal_type, command, project_name)
+        self._seq = 0
+        self._lines = []
+        self._size = 0
+        self._since = None
+        self._lock = threading.Lock()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial = ''
+
+    def feed(self, data):
+        """Log raw output bytes, keeping each non-blank line stripped."""
+        text = self._partial + self._decoder.decode(data)
+        lines = text.split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.write(line.strip())
+
+    def write(self, line):
+        with self._lock:
+            if not self._lines:
+                self._since = time.monotonic()
+            self._lines.append(line)
+            self._size += len(line) + 1
+            if self._size < self.sink.chunk_bytes:
+                return
+            row = self._seal()
+        self.sink._put(row)
+
+    def flush(self, older_than=None, into=None):
+        """Seal the buffered lines; the row is queued, or appended to `into`."""
+        with self._lock:
+            if not self._lines:
+                return
+            if older_than is not None and time.monotonic() - self._since < older_than:
+                return
+            row = self._seal()
+        if into is not None:
+            into.append(row)
+        else:
+            self.sink._put(row)
+
+    def close(self):
+        tail = self._partial + self._decoder.decode(b'', final=True)
+        self._partial = ''
+        if tail.strip():
+            self.write(tail.strip())
+        self.sink._forget(self)
+        self.flush()
+
+    def _seal(self):
+        row = ((self.run_id, self._seq) + self.key[:3] + ('\n'.join(self._lines),)
+               + self.key[3:] + (timestamp(),))
+        self._seq += 1
+        self._lines = []
+        self._size = 0
+        return row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TerminalLogSink:
+    """Background writer that batches terminal log rows into a LogStore.
+
+    Each run buffers its lines and seals them into one row per
+    chunk_bytes (or per flush_interval while the run is still going).
+    Sealed rows go through a bounded queue, so a slow disk blocks the
+    producing run instead of growing memory, and are written with
+    executemany in batches of up to batch_rows.
+    """
+
+    def __init__(self, store, chunk_bytes=64 * 1024, flush_interval=0.5,
+                 batch_rows=500, max_pending=2000):
+        self.store = store
+        self.chunk_bytes = chunk_bytes
+        self.flush_interval = flush_interval
+        self.batch_rows = batch_rows
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._runs = set()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def open_run(self, user_id, terminal_type, command, project_name):
+        run = RunLog(self, self.store.new_run_id(), user_id, terminal_type, command,
+                     project_name)
+        with self._lock:
+            self._runs.add(run)
+        self._ensure_thread()
+        return run
+
+    def _forget(self, run):
+        with self._lock:
+            self._runs.discard(run)
+
+    def _open_runs(self):
+        with self._lock:
+            return list(self._runs)
+
+    def record(self, user_id, terminal_type, command, output, project_name):
+        """Queue a single, already complete log row as a run of its own."""
+        self._ensure_thread()
+        self._put((self.store.new_run_id(), 0, user_id, terminal_type, command, output,
+                   project_name, timestamp()))
+
+    def _put(self, row):
+        if self._stopping.is_set():
+            self.store.append([row])
+        else:
+            self._pending.put(row)
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+                self._thread.start()
+
+    def _drain(self, rows):
+        while len(rows) < self.batch_rows:
+            try:
+                rows.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                rows = [self._pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                rows = []
+            # Straight into this batch: the queue's only consumer must
+            # never wait for room in it
+            for run in self._open_runs():
+                run.flush(older_than=self.flush_interval, into=rows)
+            self._write(self._drain(rows))
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            self.store.append(rows)
+        except (OSError, sqlite3.Error) as e:
+            print(f'[log-sink] dropped {len(rows)} log rows: {e}')
+
+    def stats(self):
+        with self._lock:
+            open_runs = len(self._runs)
+        return {'pending_rows': self._pending.qsize(), 'open_runs': open_runs}
+
+    def flush(self):
+        """Seal every open run and write out everything queued so far."""
+        for run in self._open_runs():
+            run.flush()
+        while not self._pending.empty():
+            self._write(self._drain([]))
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+def open_log_sink(store, **kwargs):
+    sink = TerminalLogSink(store, **kwargs)
+    atexit.register(sink.close)
+    return sink
@@ -0,0 +1,531 @@
+"""Terminal log storage partitioned into one SQLite file per day or week.
+
+    <root>/<partition>.db        hot: one row per sealed output chunk
+    <root>/<partition>.cold.db   compacted: a run's chunks batched into
+                                 compressed blocks
+
+Writes only ever touch the current partition, so the main database and
+the hot file stay small. Once a partition has been closed for
+`compact_after` seconds it is rewritten as a cold file, and partitions
+older than `retention_days` are deleted whole, with no DELETE scans.
+Compression uses zstandard when it is installed and zlib otherwise; the
+codec is stored per block, so both can be read back.
+"""
+import atexit
+import fcntl
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from db import Database
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+BLOCK_BYTES = 1024 * 1024
+PAGE_ROWS = 200
+
+HOT_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS terminal_logs
+       (id INTEGER PRIMARY KEY,
+        run_id TEXT,
+        seq INTEGER,
+        user_id INTEGER,
+        terminal_type TEXT,
+        command TEXT,
+        output TEXT,
+        project_name TEXT,
+        created_at TIMESTAMP)''',
+    'CREATE INDEX IF NOT EXISTS terminal_logs_run ON terminal_logs (run_id, seq)',
+    'CREATE INDEX IF NOT EXISTS terminal_logs_project ON terminal_logs (user_id, project_name)',
+)
+COLD_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS log_blocks
+       (id INTEGER PRIMARY KEY,
+        run_id TEXT,
+        first_seq INTEGER,
+        user_id INTEGER,
+        terminal_type TEXT,
+        command TEXT,
+        project_name TEXT,
+        first_at TIMESTAMP,
+        last_at TIMESTAMP,
+        codec TEXT,
+        data BLOB)''',
+    'CREATE INDEX IF NOT EXISTS log_blocks_run ON log_blocks (run_id, first_seq)',
+    'CREATE INDEX IF NOT EXISTS log_blocks_project ON log_blocks (user_id, project_name)',
+)
+
+INSERT_SQL = '''INSERT INTO terminal_logs
+                (run_id, seq, user_id, terminal_type, command, output, project_name, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+INSERT_BLOCK_SQL = '''INSERT INTO log_blocks
+                      (run_id, first_seq, user_id, terminal_type, command, project_name,
+                       first_at, last_at, codec, data)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+RUN_SQL = '''SELECT seq, output, created_at FROM terminal_logs
+             WHERE run_id = ? AND seq > ? ORDER BY seq LIMIT ?'''
+RUN_BLOCKS_SQL = '''SELECT first_seq, codec, data FROM log_blocks
+                    WHERE run_id = ? ORDER BY first_seq'''
+PROJECT_SQL = '''SELECT id, terminal_type, command, output, created_at FROM terminal_logs
+                 WHERE user_id = ? AND project_name = ? AND id > ?
+                   AND created_at >= ? AND created_at < ?
+                 ORDER BY id LIMIT ?'''
+PROJECT_BLOCKS_SQL = '''SELECT id, terminal_type, command, codec, data FROM log_blocks
+                        WHERE user_id = ? AND project_name = ? AND id > ?
+                          AND last_at >= ? AND first_at < ?
+                        ORDER BY id LIMIT ?'''
+LEGACY_SQL = '''SELECT id, user_id, terminal_type, command, output, project_name, created_at
+                FROM terminal_logs ORDER BY id LIMIT ?'''
+COMPACT_SQL = '''SELECT run_id, seq, user_id, terminal_type, command, output, project_name, created_at
+                 FROM terminal_logs ORDER BY run_id, seq'''
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def timestamp(moment=None):
+    """A created_at value in the format CURRENT_TIMESTAMP uses."""
+    return (moment or utcnow()).strftime(TIME_FORMAT)
+
+
+def run_id(started, suffix):
+    """Run ids start with the run's start time, to find its first partition."""
+    return f'{started:%Y%m%dT%H%M%S}-{suffix}'
+
+
+def run_started(run):
+    return datetime.strptime(run.split('-', 1)[0], '%Y%m%dT%H%M%S')
+
+
+def compress(data, codec=None):
+    codec = codec or ('zstd' if zstandard is not None else 'zlib')
+    if codec == 'zstd':
+        return codec, zstandard.ZstdCompressor(level=9).compress(data)
+    return 'zlib', zlib.compress(data, 6)
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('log block is zstd-compressed but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def decode_block(codec, data):
+    """[[seq, output, created_at], ...] packed in a block."""
+    return json.loads(decompress(codec, data))
+
+
+class Partition:
+    """One partition file on disk."""
+
+    def __init__(self, name, path, cold, start, end):
+        self.name = name
+        self.path = path
+        self.cold = cold
+        self.start = start
+        self.end = end
+
+    def connect(self):
+        conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+
+class LogStore:
+    """Time-partitioned terminal log files with compaction and retention."""
+
+    def __init__(self, root, period='day', retention_days=30, compact_after=3600,
+                 maintain_interval=600, codec=None):
+        if period not in ('day', 'week'):
+            raise ValueError(f'unknown partition period: {period}')
+        self.root = Path(root).absolute()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.period = period
+        self.retention_days = retention_days
+        self.compact_after = compact_after
+        self.maintain_interval = maintain_interval
+        self.codec = codec
+        self._hot = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.compactions = 0
+        self.expired = 0
+        self.expired_bytes = 0
+
+    # --- Partition naming ---
+
+    def partition_name(self, moment):
+        if self.period == 'week':
+            year, week, _ = moment.isocalendar()
+            return f'{year}-W{week:02d}'
+        return moment.strftime('%Y-%m-%d')
+
+    @staticmethod
+    def partition_span(name):
+        """[start, end) of a partition name, as naive UTC datetimes."""
+        if '-W' in name:
+            start = datetime.strptime(f'{name}-1', '%G-W%V-%u')
+            return start, start + timedelta(days=7)
+        start = datetime.strptime(name, '%Y-%m-%d')
+        return start, start + timedelta(days=1)
+
+    def _path(self, name, cold):
+        return self.root / (f'{name}.cold.db' if cold else f'{name}.db')
+
+    def partitions(self, since=None, until=None):
+        """Partitions overlapping [since, until), oldest first.
+
+        A partition can have both a cold file and a hot one holding
+        stragglers written after it was compacted; both are returned.
+        """
+        found = []
+        for path in self.root.glob('*.db'):
+            name = path.name[:-len('.db')]
+            cold = name.endswith('.cold')
+            if cold:
+                name = name[:-len('.cold')]
+            try:
+                start, end = self.partition_span(name)
+            except ValueError:
+                continue
+            if since is not None and end <= since:
+                continue
+            if until is not None and start >= until:
+                continue
+            found.append(Partition(name, path, cold, start, end))
+        found.sort(key=lambda p: (p.start, not p.cold))
+        return found
+
+    # --- Writing ---
+
+    def new_run_id(self):
+        return run_id(utcnow(), secrets.token_hex(6))
+
+    def append(self, rows):
+        """Write (run_id, seq, user_id, type, command, output, project, created_at) rows."""
+        current = self.partition_name(utcnow())
+        by_partition = {}
+        for row in rows:
+            name = self.partition_name(datetime.strptime(row[7], TIME_FORMAT))
+            if name != current and self._path(name, cold=True).exists():
+                # Too late for a compacted partition; keep it in the live one
+                name = current
+            by_partition.setdefault(name, []).append(row)
+        for name, part in by_partition.items():
+            self._database(name).executemany(INSERT_SQL, part)
+        self._close_stale(current, by_partition)
+
+    def _database(self, name):
+        with self._lock:
+            database = self._hot.get(name)
+            if database is None:
+                database = self._hot[name] = Database(self._path(name, cold=False))
+                database.write(_create, HOT_SCHEMA)
+            return database
+
+    def _close_stale(self, current, keep):
+        with self._lock:
+            stale = [name for name in self._hot if name != current and name not in keep]
+            databases = [self._hot.pop(name) for name in stale]
+        for database in databases:
+            database.close()
+
+    # --- Reading ---
+
+    def iter_run(self, run):
+        """Yield (seq, output, created_at) for one run, in order."""
+        last = -1
+        for partition in self.partitions(since=run_started(run)):
+            conn = partition.connect()
+            try:
+                if partition.cold:
+                    for _, codec, data in conn.execute(RUN_BLOCKS_SQL, (run,)):
+                        for seq, output, created_at in decode_block(codec, data):
+                            if seq > last:
+                                last = seq
+                                yield seq, output, created_at
+                    continue
+                while True:
+                    rows = conn.execute(RUN_SQL, (run, last, PAGE_ROWS)).fetchall()
+                    yield from rows
+                    if len(rows) < PAGE_ROWS:
+                        break
+                    last = rows[-1][0]
+                if rows:
+                    last = rows[-1][0]
+            except sqlite3.OperationalError:
+                # Compacted or expired while we were reading
+                continue
+            finally:
+                conn.close()
+
+    def iter_project(self, user_id, project_name, since, until, after=None):
+        """Yield (position, record) for a project's logs in [since, until).
+
+        Positions are opaque strings; pass one back as `after` to resume
+        right behind it.
+        """
+        since_at = datetime.strptime(since, TIME_FORMAT) if since else None
+        until_at = datetime.strptime(until, TIME_FORMAT) if until else None
+        since, until = since or '', until or '9999-12-31 23:59:59'
+        resume = None
+        if after:
+            name, kind, row_id, index = after.split(':')
+            resume = (name, kind == 'cold', int(row_id), int(index))
+
+        for partition in self.partitions(since_at, until_at):
+            if resume is not None:
+                if (partition.start, not partition.cold) < (
+                        self.partition_span(resume[0])[0], not resume[1]):
+                    continue
+                same = (partition.name, partition.cold) == resume[:2]
+                last_id, last_index = resume[2:] if same else (0, -1)
+                resume = None
+            else:
+                last_id, last_index = 0, -1
+            kind = 'cold' if partition.cold else 'hot'
+            conn = partition.connect()
+            try:
+                while True:
+                    if partition.cold:
+                        # Re-read the block we stopped in, skipping what was sent
+                        rows = conn.execute(PROJECT_BLOCKS_SQL, (user_id, project_name,
+                                                                 last_id - 1, since, until,
+                                                                 PAGE_ROWS)).fetchall()
+                        for row_id, terminal_type, command, codec, data in rows:
+                            for index, (_, output, created_at) in enumerate(decode_block(codec, data)):
+                                if row_id == last_id and index <= last_index:
+                                    continue
+                                if since <= created_at < until:
+                                    yield (f'{partition.name}:{kind}:{row_id}:{index}',
+                                           log_record(terminal_type, command, output, created_at))
+                            last_id, last_index = row_id, 1 << 62
+                    else:
+                        rows = conn.execute(PROJECT_SQL, (user_id, project_name, last_id,
+                                                          since, until, PAGE_ROWS)).fetchall()
+                        for row_id, terminal_type, command, output, created_at in rows:
+                            yield (f'{partition.name}:{kind}:{row_id}:0',
+                                   log_record(terminal_type, command, output, created_at))
+                            last_id = row_id
+                    if len(rows) < PAGE_ROWS:
+                        break
+            except sqlite3.OperationalError:
+                continue
+            finally:
+                conn.close()
+
+    # --- Maintenance ---
+
+    def compact(self, partition):
+        """Rewrite a closed hot partition as compressed blocks; True if done."""
+        cold = self._path(partition.name, cold=True)
+        with _try_lock(self.root / f'{partition.name}.lock') as locked:
+            if not locked or not partition.path.exists():
+                return False
+            with self._lock:
+                database = self._hot.pop(partition.name, None)
+            if database is not None:
+                database.close()
+            tmp = cold.with_name(cold.name + '.tmp')
+            _unlink(tmp)
+            source = partition.connect()
+            target = sqlite3.connect(str(tmp), isolation_level=None)
+            try:
+                _create(target, COLD_SCHEMA)
+                # A straggler file for an already cold partition merges in
+                merge = cold.exists()
+                if merge:
+                    target.execute('ATTACH DATABASE ? AS old', (str(cold),))
+                target.execute('BEGIN')
+                if merge:
+                    target.execute('INSERT INTO log_blocks SELECT * FROM old.log_blocks')
+                for block in _blocks(source.execute(COMPACT_SQL)):
+                    target.execute(INSERT_BLOCK_SQL, self._pack(block))
+                target.execute('COMMIT')
+            finally:
+                source.close()
+                target.close()
+            os.replace(tmp, cold)
+            for suffix in ('', '-wal', '-shm'):
+                _unlink(Path(f'{partition.path}{suffix}'))
+        with self._lock:
+            self.compactions += 1
+        return True
+
+    def _pack(self, block):
+        first = block[0]
+        lines = [[row[1], row[5], row[7]] for row in block]
+        codec, data = compress(json.dumps(lines).encode(), self.codec)
+        return (first[0], first[1], first[2], first[3], first[4], first[6],
+                min(row[7] for row in block), max(row[7] for row in block), codec, data)
+
+    def maintain(self):
+        """Compact closed partitions and drop expired ones."""
+        now = utcnow()
+        cutoff = now - timedelta(days=self.retention_days)
+        for partition in self.partitions():
+            if partition.end <= cutoff:
+                self._expire(partition)
+            elif not partition.cold and partition.end + timedelta(seconds=self.compact_after) <= now:
+                self.compact(partition)
+
+    def _expire(self, partition):
+        with self._lock:
+            database = self._hot.pop(partition.name, None)
+        if database is not None:
+            database.close()
+        reclaimed = 0
+        for suffix in ('', '-wal', '-shm'):
+            reclaimed += _unlink(Path(f'{partition.path}{suffix}'))
+        _unlink(self.root / f'{partition.name}.lock')
+        with self._lock:
+            self.expired += 1
+            self.expired_bytes += reclaimed
+
+    def adopt(self, database, batch_rows=5000):
+        """Move rows from the main database's terminal_logs into partitions.
+
+        Each old row becomes a one-chunk run. Returns the rows moved.
+        """
+        moved = 0
+        with _try_lock(self.root / 'adopt.lock') as locked:
+            while locked:
+                with database.reader() as conn:
+                    rows = conn.execute(LEGACY_SQL, (batch_rows,)).fetchall()
+                if not rows:
+                    break
+                self.append([(run_id(datetime.strptime(created_at, TIME_FORMAT), f'legacy{row_id}'),
+                              0, user_id, terminal_type, command, output, project_name, created_at)
+                             for row_id, user_id, terminal_type, command, output, project_name,
+                             created_at in rows])
+                database.execute('DELETE FROM terminal_logs WHERE id <= ?', (rows[-1][0],))
+                moved += len(rows)
+        return moved
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='log-store', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.maintain()
+            except (OSError, sqlite3.Error) as e:
+                print(f'[log-store] maintenance failed: {e}')
+            if self._stopping.wait(self.maintain_interval):
+                return
+
+    def stats(self):
+        partitions = self.partitions()
+        hot = cold = 0
+        for partition in partitions:
+            size = _size(partition.path)
+            if partition.cold:
+                cold += size
+            else:
+                hot += size
+        with self._lock:
+            return {
+                'partitions': len(partitions),
+                'hot_bytes': hot,
+                'cold_bytes': cold,
+                'compactions': self.compactions,
+                'expired': self.expired,
+                'expired_bytes': self.expired_bytes,
+            }
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            databases = list(self._hot.values())
+            self._hot.clear()
+        for database in databases:
+            database.close()
+
+
+def log_record(terminal_type, command, output, created_at):
+    return {'terminal_type': terminal_type, 'command': command, 'output': output,
+            'created_at': created_at}
+
+
+def _create(conn, statements):
+    for sql in statements:
+        conn.execute(sql)
+
+
+def _blocks(rows):
+    """Group rows (sorted by run, seq) into per-run blocks of ~BLOCK_BYTES."""
+    block = []
+    size = 0
+    for row in rows:
+        if block and (row[0] != block[0][0] or size >= BLOCK_BYTES):
+            yield block
+            block, size = [], 0
+        block.append(row)
+        size += len(row[5] or '')
+    if block:
+        yield block
+
+
+def _size(path):
+    try:
+        return sum(os.path.getsize(f'{path}{suffix}') for suffix in ('', '-wal', '-shm')
+                   if os.path.exists(f'{path}{suffix}'))
+    except OSError:
+        return 0
+
+
+def _unlink(path):
+    try:
+        size = path.stat().st_size
+        path.unlink()
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+class _try_lock:
+    """Non-blocking flock on a lock file, so only one worker compacts."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.fd)
+            self.fd = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+
+
+def open_log_store(root, **kwargs):
+    store = LogStore(root, **kwargs)
+    atexit.register(store.close)
+    store.start()
+    return store
@@ -0,0 +1,313 @@
+"""Counters, gauges and histograms in the Prometheus text format, and a
+sampling profiler.
+
+Metrics live in one process-wide REGISTRY and are rendered by /metrics.
+Recording is a dict lookup, a bisect and an increment under a lock; with
+CYBER20UN_METRICS=0 `timed` returns functions unwrapped and observations
+are dropped.
+
+The profiler is a real OS thread (not a green one) that samples the
+other threads' stacks every `interval` seconds and counts them in the
+collapsed format flamegraph.pl and speedscope read: one
+"outer;...;inner count" line per distinct stack. It costs nothing until
+started.
+"""
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+try:
+    # Under eventlet, threading is monkey patched; the sampler needs a
+    # thread that keeps running while the hub is busy
+    from eventlet.patcher import original
+    _os_threading = original('threading')
+    _sleep = original('time').sleep
+except ImportError:
+    _os_threading = threading
+    _sleep = time.sleep
+
+ENABLED = os.environ.get('CYBER20UN_METRICS', '1') != '0'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, doc, labels=(), registry=None):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _default(self):
+        return self.labels() if not self.labelnames else None
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if ENABLED:
+            with self._lock:
+                self.value += amount
+
+    def render(self, name, labelnames, values):
+        return [f'{name}{_labels(labelnames, values)} {_number(self.value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeValue(_Value):
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, fn):
+        self.function = fn
+        return fn
+
+    def render(self, name, labelnames, values):
+        value = self.function() if self.function is not None else self.value
+        return [f'{name}{_labels(labelnames, values)} {_number(value)}']
+
+
+class Gauge(Metric):
+    """A value that goes up and down; set_function reads it at scrape time."""
+
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set_function(self, fn):
+        return self._default().set_function(fn)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        if not ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """(count, sum) so far."""
+        with self._lock:
+            return sum(self.counts), self.sum
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def render(self, name, labelnames, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = _labels(labelnames, values, [('le', _number(bound))])
+            lines.append(f'{name}_bucket{le} {cumulative}')
+        labels = _labels(labelnames, values)
+        lines.append(f'{name}_sum{labels} {_number(total)}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, doc, labels, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def snapshot(self):
+        return self._default().snapshot()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CALL_SECONDS = Histogram('cyber20un_call_seconds', 'Latency of instrumented calls', ['call'])
+CALL_ERRORS = Counter('cyber20un_call_errors_total', 'Instrumented calls that raised', ['call'])
+
+
+def timed(call):
+    """Decorator: record the function's latency and errors as `call`."""
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+        histogram = CALL_SECONDS.labels(call)
+        errors = CALL_ERRORS.labels(call)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except BaseException:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class SamplingProfiler:
+    """Counts the stacks of every other thread, every `interval` seconds."""
+
+    def __init__(self, interval=0.005, max_depth=128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = StackCounter()
+        self.samples = 0
+        self._thread = None
+        self._stop = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return False
+        self.stacks = StackCounter()
+        self.samples = 0
+        self._stop = _os_threading.Event()
+        self._thread = _os_threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        own = _os_threading.get_ident()
+        while not self._stop.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            _sleep(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the collapsed stacks."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.collapsed()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
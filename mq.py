@@ -0,0 +1,371 @@
+"""Message queue for running the server as several processes.
+
+With a single process (the default) none of this leaves memory. To scale
+out, start several web processes and any number of execution workers
+(worker.py) with CYBER20UN_MESSAGE_QUEUE pointing at a shared backend:
+
+- unix:///path/to/mq.sock: the broker in this module (`python mq.py
+  /path/to/mq.sock`), for one host and for tests
+- redis://host:6379/0: Redis pub/sub and a Redis list (needs the redis
+  package)
+
+Socket.IO emits from any process then reach the client through whichever
+web process holds its connection, and runs are handed to execution
+workers through a shared job queue. Control messages (superseded runs,
+input for a run's or shell's pty) are broadcast to every process on
+CONTROL_CHANNEL.
+"""
+import os
+import pickle
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+SOCKETIO_CHANNEL = 'cyber20un-socketio'
+CONTROL_CHANNEL = 'cyber20un-control'
+JOB_QUEUE = 'cyber20un-jobs'
+
+_HEADER = struct.Struct('!I')
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def encode_frame(message):
+    data = pickle.dumps(message)
+    return _HEADER.pack(len(data)) + data
+
+
+def send_frame(sock, message):
+    sock.sendall(encode_frame(message))
+
+
+def recv_frame(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+class Broker:
+    """Pub/sub channels and FIFO queues served over a Unix socket.
+
+    Frames are length-prefixed pickles, so the socket is created 0600
+    and must only be reachable by the server's own user. Requests:
+    ('sub', channel), ('pub', channel, data), ('push', queue, data) and
+    ('pop', queue, timeout), answered with ('item', data or None).
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._subscribers = {}
+        # One per connection: publishers on other threads and the
+        # connection's own replies must not interleave their frames
+        self._send_locks = {}
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _queue(self, name):
+        with self._lock:
+            q = self._queues.get(name)
+            if q is None:
+                q = self._queues[name] = queue.Queue()
+            return q
+
+    def start(self):
+        """Listen in a background thread; returns once the socket exists."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(128)
+        self._server = server
+        threading.Thread(target=self._accept, name='mq-broker', daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.start()
+        while self._server is not None:
+            time.sleep(1)
+
+    def _accept(self):
+        while self._server is not None:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _send(self, conn, frame):
+        """Write one encoded frame to conn, whole."""
+        with self._lock:
+            lock = self._send_locks.get(conn)
+        if lock is None:
+            raise OSError('connection closed')
+        with lock:
+            conn.sendall(frame)
+
+    def _serve(self, conn):
+        channel = None
+        with self._lock:
+            self._send_locks[conn] = threading.Lock()
+        try:
+            while True:
+                request = recv_frame(conn)
+                op = request[0]
+                if op == 'sub':
+                    channel = request[1]
+                    with self._lock:
+                        self._subscribers.setdefault(channel, set()).add(conn)
+                elif op == 'pub':
+                    self._publish(request[1], request[2])
+                elif op == 'push':
+                    self._queue(request[1]).put(request[2])
+                elif op == 'pop':
+                    q = self._queue(request[1])
+                    try:
+                        item = q.get(timeout=request[2])
+                    except queue.Empty:
+                        item = None
+                    try:
+                        self._send(conn, encode_frame(('item', item)))
+                    except OSError:
+                        # The worker went away while waiting; keep its job
+                        if item is not None:
+                            q.put(item)
+                        raise
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        finally:
+            with self._lock:
+                if channel is not None:
+                    self._subscribers.get(channel, set()).discard(conn)
+                lock = self._send_locks.pop(conn)
+            # Not while a publisher is halfway through a frame
+            with lock:
+                conn.close()
+
+    def _publish(self, channel, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        # Pickled once for all subscribers
+        frame = encode_frame(data)
+        for conn in subscribers:
+            try:
+                self._send(conn, frame)
+            except OSError:
+                with self._lock:
+                    self._subscribers.get(channel, set()).discard(conn)
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is not None:
+            server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class BrokerConnection:
+    """One client connection to a Broker."""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def send(self, message):
+        send_frame(self.sock, message)
+
+    def recv(self):
+        return recv_frame(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+
+def _unix_path(url):
+    return urlparse(url).path
+
+
+class UnixManager(socketio.PubSubManager):
+    """Socket.IO client manager that shares emits through a Broker."""
+
+    name = 'unix'
+
+    def __init__(self, url, channel=SOCKETIO_CHANNEL, write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = _unix_path(url)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _publish(self, data):
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = BrokerConnection(self.path)
+                    self._publisher.send(('pub', self.channel, data))
+                    return
+                except OSError:
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        yield from subscribe_unix(self.path, self.channel)
+
+
+def subscribe_unix(path, channel, retry=1.0):
+    """Yield messages published on channel, reconnecting if the broker restarts."""
+    while True:
+        try:
+            conn = BrokerConnection(path)
+            conn.send(('sub', channel))
+            while True:
+                yield conn.recv()
+        except (OSError, EOFError):
+            time.sleep(retry)
+
+
+class LocalQueue:
+    """In-process stand-in: one process is both web and execution worker."""
+
+    url = None
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def socketio_options(self):
+        return {}
+
+    def push(self, job):
+        self._jobs.put(job)
+
+    def pop(self, timeout=None):
+        try:
+            return self._jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def publish(self, channel, data):
+        with self._lock:
+            listeners = [q for name, q in self._listeners if name == channel]
+        for q in listeners:
+            q.put(data)
+
+    def listen(self, channel):
+        q = queue.Queue()
+        with self._lock:
+            self._listeners.append((channel, q))
+        while True:
+            yield q.get()
+
+
+class UnixQueue:
+    """Backend on a Broker's Unix socket."""
+
+    def __init__(self, url):
+        self.url = url
+        self.path = _unix_path(url)
+        self._local = threading.local()
+
+    def socketio_options(self):
+        return {'client_manager': UnixManager(self.url)}
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = BrokerConnection(self.path)
+        return conn
+
+    def _request(self, message, reply=False):
+        try:
+            conn = self._conn()
+            conn.send(message)
+            return conn.recv() if reply else None
+        except (OSError, EOFError):
+            self._local.conn = None
+            raise
+
+    def push(self, job):
+        self._request(('push', JOB_QUEUE, job))
+
+    def pop(self, timeout=None):
+        _, job = self._request(('pop', JOB_QUEUE, timeout), reply=True)
+        return job
+
+    def publish(self, channel, data):
+        self._request(('pub', channel, data))
+
+    def listen(self, channel):
+        return subscribe_unix(self.path, channel)
+
+
+class RedisQueue:
+    """Backend on Redis: pub/sub for emits and control, a list for jobs."""
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('redis:// message queues need the redis package')
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+
+    def socketio_options(self):
+        return {'message_queue': self.url, 'channel': SOCKETIO_CHANNEL}
+
+    def push(self, job):
+        self.client.lpush(JOB_QUEUE, pickle.dumps(job))
+
+    def pop(self, timeout=None):
+        item = self.client.brpop(JOB_QUEUE, timeout=int(timeout or 0))
+        return pickle.loads(item[1]) if item else None
+
+    def publish(self, channel, data):
+        self.client.publish(channel, pickle.dumps(data))
+
+    def listen(self, channel):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        for message in pubsub.listen():
+            yield pickle.loads(message['data'])
+
+
+def open_message_queue(url=None):
+    """The backend for a CYBER20UN_MESSAGE_QUEUE url; LocalQueue without one."""
+    if not url:
+        return LocalQueue()
+    scheme = urlparse(url).scheme
+    if scheme == 'unix':
+        return UnixQueue(url)
+    if scheme in ('redis', 'rediss'):
+        return RedisQueue(url)
+    raise ValueError(f'unsupported message queue: {url}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: python mq.py /path/to/mq.sock')
+    print(f'[mq] broker listening on {sys.argv[1]}')
+    Broker(sys.argv[1]).serve_forever()
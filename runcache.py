@@ -0,0 +1,190 @@
+"""Cache of run results, for pressing Run again on code that hasn't changed.
+
+A run's key hashes everything that decides its output for a
+deterministic script: the interpreter, the project's installed
+libraries, and the name and contents of every file in the user's
+directory, subdirectories included. A cached run is the output it produced, as
+(offset, bytes) chunks, and its run_stats; a hit replays the chunks on
+their original schedule instead of starting a process.
+
+Caching is opt-in per run: the server can't tell whether a script reads
+the clock, the network or random numbers. Only clean runs are kept
+(exit 0, no limit hit, no input typed), and entries are evicted LRU
+within a byte budget.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from stat import S_ISREG
+
+# Per-chunk bookkeeping counted against the budget besides the bytes
+CHUNK_OVERHEAD = 64
+# A replay never takes longer than this, however slow the original run
+REPLAY_MAX_SECONDS = 1.0
+
+
+class CachedRun:
+    """Recorded output and stats of one clean run."""
+
+    def __init__(self, chunks, stats):
+        self.chunks = chunks
+        self.stats = stats
+        self.created = time.time()
+        self.size = sum(len(data) + CHUNK_OVERHEAD for _, data in chunks)
+
+    def schedule(self, max_seconds=REPLAY_MAX_SECONDS):
+        """(delay before chunk, chunk) pairs; gaps scaled to fit max_seconds."""
+        duration = self.chunks[-1][0] if self.chunks else 0.0
+        scale = min(1.0, max_seconds / duration) if duration > 0 else 0.0
+        previous = 0.0
+        for offset, data in self.chunks:
+            yield (offset - previous) * scale, data
+            previous = offset
+
+
+class Recorder:
+    """Collects a run's output for the cache, up to max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self.size = 0
+        self.overflowed = False
+        self.started = time.monotonic()
+
+    def feed(self, data):
+        if self.overflowed:
+            return
+        self.size += len(data) + CHUNK_OVERHEAD
+        if self.size > self.max_bytes:
+            # Too big to be worth caching; drop what we have
+            self.overflowed = True
+            self.chunks = []
+            return
+        self.chunks.append((time.monotonic() - self.started, bytes(data)))
+
+
+class FileDigests:
+    """sha256 of files, recomputed only when their size or mtime changes."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, path, stat):
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            known = self._digests.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return self.remember(path, stat, digest.digest())
+
+    def remember(self, path, stat, value):
+        """Record the digest of a file just written, so it isn't read back."""
+        with self._lock:
+            if len(self._digests) >= self.max_entries:
+                self._digests.clear()
+            self._digests[path] = ((stat.st_mtime_ns, stat.st_size), value)
+        return value
+
+
+def project_files(root):
+    """(relative name, path, stat) of every file under root, sorted by name.
+
+    Bytecode caches are skipped: a run writes them, and they follow from
+    the sources anyway.
+    """
+    files = []
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != '__pycache__']
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not S_ISREG(stat.st_mode):
+                continue
+            files.append((os.path.relpath(path, root).replace(os.sep, '/'), path, stat))
+    files.sort(key=lambda f: f[0])
+    return files
+
+
+class RunCache:
+    """LRU cache of CachedRun by key, within `budget` bytes."""
+
+    def __init__(self, budget=64 * 1024 * 1024, max_entry=None):
+        self.budget = budget
+        self.max_entry = max_entry or budget // 8
+        self.files = FileDigests()
+        self._runs = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def key(self, user_dir, filename, python, libraries):
+        """Key of running `filename` in user_dir with this interpreter and libraries."""
+        h = hashlib.sha256()
+        h.update(os.path.realpath(python).encode())
+        for name, version in sorted(set(libraries), key=lambda lib: (lib[0] or '', lib[1] or '')):
+            h.update(f'\0lib\0{name}\0{version}'.encode())
+        h.update(f'\0run\0{filename}'.encode())
+        for name, path, stat in project_files(user_dir):
+            h.update(f'\0file\0{name}\0'.encode())
+            h.update(self.files.digest(path, stat))
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            run = self._runs.get(key)
+            if run is None:
+                self.misses += 1
+                return None
+            self._runs.move_to_end(key)
+            self.hits += 1
+            return run
+
+    def recorder(self):
+        return Recorder(self.max_entry)
+
+    def put(self, key, recorder, stats):
+        """Keep a finished run if it was clean and small enough."""
+        if recorder.overflowed or stats['exit_code'] != 0 or stats['killed']:
+            return False
+        run = CachedRun(recorder.chunks, stats)
+        with self._lock:
+            old = self._runs.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+            self._runs[key] = run
+            self._size += run.size
+            self.stores += 1
+            while self._size > self.budget and len(self._runs) > 1:
+                _, evicted = self._runs.popitem(last=False)
+                self._size -= evicted.size
+                self.evictions += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'runs': len(self._runs),
+                'size': self._size,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
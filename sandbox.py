@@ -0,0 +1,346 @@
+"""Resource limits and accounting for user code.
+
+Every run gets rlimits (CPU seconds, extra address space, output file
+size, open files) applied in the child right after fork. Where a cgroup v2
+tree has been delegated to the server (CGROUP_ROOT, e.g. created with
+`mkdir /sys/fs/cgroup/cyber20un && chown` plus `+cpu +memory +pids` in
+its parent's subtree_control), each run also gets its own cgroup with
+cpu.max, memory.max and pids.max. Wall-clock time and output bytes are
+enforced from the web side by RunGuard. Every breach kills the whole
+process group, or the whole cgroup when there is one.
+
+RLIMIT_NPROC is not used. It counts every process of the server's uid,
+not just the run's, so pids are only limited through the cgroup.
+"""
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+CGROUP_ROOT = os.environ.get('CYBER20UN_CGROUP', '/sys/fs/cgroup/cyber20un')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+# Used when a fresh interpreter's address space can't be measured
+DEFAULT_BASELINE = 64 * 1024 * 1024
+
+
+class Limits:
+    """Per-run limits; None disables one."""
+
+    FIELDS = ('cpu_seconds', 'cpu_quota', 'memory_bytes', 'pids', 'wall_seconds',
+              'output_bytes', 'file_bytes', 'open_files')
+
+    def __init__(self, cpu_seconds=30, cpu_quota=1.0, memory_bytes=512 * 1024 * 1024, pids=64,
+                 wall_seconds=60, output_bytes=4 * 1024 * 1024, file_bytes=64 * 1024 * 1024,
+                 open_files=256):
+        self.cpu_seconds = cpu_seconds
+        self.cpu_quota = cpu_quota
+        self.memory_bytes = memory_bytes
+        self.pids = pids
+        self.wall_seconds = wall_seconds
+        self.output_bytes = output_bytes
+        self.file_bytes = file_bytes
+        self.open_files = open_files
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data.get(name) for name in cls.FIELDS})
+
+
+def _virtual_size():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+_baseline = None
+_baseline_lock = threading.Lock()
+
+
+def exec_baseline():
+    """Address space of a freshly started interpreter, measured once.
+
+    What a run exec'd from Popen starts with: the rlimit set before exec
+    outlives it, so the server's own (much larger) size is no measure.
+    """
+    global _baseline
+    with _baseline_lock:
+        if _baseline is None:
+            try:
+                out = subprocess.run(
+                    [sys.executable, '-c', "print(open('/proc/self/statm').read().split()[0])"],
+                    capture_output=True, timeout=30, check=True).stdout
+                _baseline = int(out) * PAGE_SIZE
+            except (OSError, ValueError, subprocess.SubprocessError):
+                _baseline = DEFAULT_BASELINE
+        return _baseline
+
+
+def _set(which, value):
+    if value is None:
+        return
+    _, hard = resource.getrlimit(which)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    try:
+        resource.setrlimit(which, (value, value))
+    except (ValueError, OSError):
+        pass
+
+
+def apply_limits(limits, cgroup_procs=None, baseline=None):
+    """Confine the calling process; run in the child between fork and exec/runpy.
+
+    The memory budget is on top of `baseline` bytes of address space; by
+    default what the calling process maps now, right for a fork that
+    runs the code itself. Before an exec, pass exec_baseline().
+    """
+    if cgroup_procs:
+        try:
+            with open(cgroup_procs, 'w') as f:
+                f.write('0')
+        except OSError:
+            pass
+    if limits is None:
+        return
+    # SIGXCPU at the soft limit; the hard limit a little later is SIGKILL
+    if limits.cpu_seconds is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        hard_cpu = limits.cpu_seconds + 1
+        if hard != resource.RLIM_INFINITY:
+            hard_cpu = min(hard_cpu, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_CPU, (min(limits.cpu_seconds, hard_cpu), hard_cpu))
+        except (ValueError, OSError):
+            pass
+    # Address space counts what the (possibly preloaded) interpreter
+    # already maps, so the memory budget is on top of that
+    if limits.memory_bytes is not None:
+        _set(resource.RLIMIT_AS, (_virtual_size() if baseline is None else baseline)
+             + limits.memory_bytes)
+    _set(resource.RLIMIT_FSIZE, limits.file_bytes)
+    _set(resource.RLIMIT_NOFILE, limits.open_files)
+    _set(resource.RLIMIT_CORE, 0)
+
+
+def preexec(limits, cgroup=None):
+    """preexec_fn for subprocess.Popen (pair with start_new_session=True)."""
+    procs = cgroup.procs if cgroup is not None else None
+    baseline = exec_baseline()
+    return lambda: apply_limits(limits, procs, baseline)
+
+
+class Cgroup:
+    """One run's cgroup v2 directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.procs = os.path.join(path, 'cgroup.procs')
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    def _write(self, name, value):
+        try:
+            with open(os.path.join(self.path, name), 'w') as f:
+                f.write(value)
+            return True
+        except OSError:
+            return False
+
+    def configure(self, limits):
+        if limits.cpu_quota is not None:
+            period = 100000
+            self._write('cpu.max', f'{int(limits.cpu_quota * period)} {period}')
+        if limits.memory_bytes is not None:
+            self._write('memory.max', str(limits.memory_bytes))
+            self._write('memory.swap.max', '0')
+        if limits.pids is not None:
+            self._write('pids.max', str(limits.pids))
+
+    def usage(self):
+        """CPU seconds, peak memory and OOM kills for everything that ran here."""
+        stat = dict(line.split() for line in self._read('cpu.stat').splitlines() if line)
+        events = dict(line.split() for line in self._read('memory.events').splitlines() if line)
+        peak = self._read('memory.peak').strip()
+        return {
+            'user_cpu': int(stat.get('user_usec', 0)) / 1e6,
+            'sys_cpu': int(stat.get('system_usec', 0)) / 1e6,
+            'max_rss': int(peak) if peak.isdigit() else None,
+            'oom_kills': int(events.get('oom_kill', 0)),
+        }
+
+    def kill(self):
+        if not self._write('cgroup.kill', '1'):
+            for pid in self._read('cgroup.procs').split():
+                try:
+                    os.kill(int(pid), signal.SIGKILL)
+                except (OSError, ValueError):
+                    pass
+
+    def remove(self):
+        # rmdir only succeeds once every process in it has been reaped
+        for _ in range(50):
+            try:
+                os.rmdir(self.path)
+                return
+            except FileNotFoundError:
+                return
+            except OSError:
+                time.sleep(0.02)
+
+
+class Cgroups:
+    """Creates per-run cgroups under a delegated cgroup v2 directory."""
+
+    def __init__(self, root=CGROUP_ROOT):
+        self.root = root
+        self.available = self._check()
+
+    def _check(self):
+        controllers = os.path.join(self.root, 'cgroup.controllers')
+        if not os.path.exists(controllers) or not os.access(self.root, os.W_OK):
+            return False
+        with open(controllers) as f:
+            wanted = {'cpu', 'memory', 'pids'} & set(f.read().split())
+        try:
+            with open(os.path.join(self.root, 'cgroup.subtree_control'), 'w') as f:
+                f.write(' '.join(f'+{name}' for name in sorted(wanted)))
+        except OSError:
+            pass
+        return True
+
+    def create(self, name, limits):
+        """A configured cgroup for one run, or None without cgroup support."""
+        if not self.available:
+            return None
+        path = os.path.join(self.root, name)
+        try:
+            os.mkdir(path)
+        except OSError:
+            return None
+        cgroup = Cgroup(path)
+        cgroup.configure(limits)
+        return cgroup
+
+
+def wait_with_usage(process, poll_interval=0.05):
+    """Wait for a Popen or WarmProcess; returns (exit code, rusage dict).
+
+    Popen children are reaped with wait4 (polled, so green threads keep
+    running) to collect their rusage; warm children report theirs, taken
+    the same way by the fork server.
+    """
+    if hasattr(process, 'rusage'):
+        return process.wait(), process.rusage
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss survives exec, so a child forked from the web
+            # process reports the web process's peak; only a cgroup's
+            # memory.peak is meaningful here
+            return process.returncode, {**rusage_dict(usage), 'max_rss': None}
+        time.sleep(poll_interval)
+
+
+def rusage_dict(usage):
+    return {
+        'user_cpu': usage.ru_utime,
+        'sys_cpu': usage.ru_stime,
+        # ru_maxrss is in KiB on Linux
+        'max_rss': usage.ru_maxrss * 1024,
+    }
+
+
+def kill_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class RunGuard:
+    """Enforces wall time and output size on one started run.
+
+    Feed every output chunk through count(); call finish() once the
+    process has exited to get its usage record. Attach the guard, not
+    the process, to a scheduler Job so cancelling kills the whole group.
+    """
+
+    def __init__(self, process, limits, cgroup=None):
+        self.process = process
+        self.limits = limits
+        self.cgroup = cgroup
+        self.bytes_out = 0
+        self.killed = None
+        self.returncode = None
+        self.started = time.monotonic()
+        self._timer = None
+        if limits.wall_seconds is not None:
+            self._timer = threading.Timer(limits.wall_seconds, self.kill, args=('wall_time',))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def count(self, data):
+        self.bytes_out += len(data)
+        if (self.limits.output_bytes is not None and self.bytes_out > self.limits.output_bytes
+                and self.killed is None):
+            self.kill('output_bytes')
+
+    def poll(self):
+        # Never reap here: finish() needs the child for wait4
+        return self.returncode
+
+    def kill(self, reason='cancelled'):
+        if self.killed is None:
+            self.killed = reason
+        if self.cgroup is not None:
+            self.cgroup.kill()
+        if hasattr(self.process, 'rusage'):
+            self.process.kill()
+        else:
+            kill_group(self.process)
+
+    def finish(self):
+        """Reap the process and return its usage record."""
+        code, usage = wait_with_usage(self.process)
+        self.returncode = code
+        wall = time.monotonic() - self.started
+        if self._timer is not None:
+            self._timer.cancel()
+        # Anything the run left behind in its group goes too
+        if hasattr(self.process, 'rusage'):
+            self.process.kill()
+        else:
+            kill_group(self.process)
+        if self.cgroup is not None:
+            usage = {**usage, **{k: v for k, v in self.cgroup.usage().items() if v is not None}}
+            if usage.pop('oom_kills', 0) and self.killed is None:
+                self.killed = 'memory'
+            self.cgroup.remove()
+        if self.killed is None and code in (-signal.SIGXCPU, -signal.SIGKILL) and \
+                usage['user_cpu'] + usage['sys_cpu'] >= (self.limits.cpu_seconds or float('inf')):
+            self.killed = 'cpu_time'
+        if self.killed is None and self.limits.file_bytes is not None and code == -signal.SIGXFSZ:
+            self.killed = 'file_bytes'
+        return {
+            'exit_code': code,
+            'user_cpu': round(usage['user_cpu'], 4),
+            'sys_cpu': round(usage['sys_cpu'], 4),
+            'max_rss': usage['max_rss'],
+            'wall_seconds': round(wall, 4),
+            'bytes_out': self.bytes_out,
+            'killed': self.killed,
+        }
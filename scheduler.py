@@ -0,0 +1,185 @@
+import itertools
+import os
+import threading
+from collections import deque
+
+
+class SchedulerBusy(Exception):
+    """Raised when an owner already has too many jobs waiting."""
+
+
+class Job:
+    """One queued or running execution."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, owner, key, fn, on_status):
+        self.id = next(self._ids)
+        self.owner = owner
+        self.key = key
+        self.fn = fn
+        self.on_status = on_status
+        self.process = None
+        self.state = 'queued'
+        self.position = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop the job; kills its child process if it already started one."""
+        self.cancelled.set()
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def attach(self, process):
+        """Register the job's child process so cancel() can kill it."""
+        self.process = process
+        if self.cancelled.is_set():
+            process.kill()
+
+    def _notify(self, state, position=None):
+        self.state = state
+        self.position = position
+        if self.on_status is not None:
+            self.on_status(self, state, position)
+
+
+class ExecutionScheduler:
+    """Runs jobs under a global concurrency cap with per-owner fairness.
+
+    Every owner (a user's project) has its own FIFO queue, and free
+    slots are handed out round-robin across owners, so one user queueing
+    many runs cannot starve the others. Submitting a job with the same
+    key as a queued or running one supersedes it. Jobs are started with
+    `spawn`, which should be socketio.start_background_task so they run
+    as green threads under eventlet.
+    """
+
+    def __init__(self, spawn, max_workers=None, max_queued=5):
+        self.spawn = spawn
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self._queues = {}
+        self._ring = deque()
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, owner, fn, key=None, on_status=None):
+        """Queue fn(job) for owner and return the Job."""
+        job = Job(owner, key, fn, on_status)
+        with self._lock:
+            superseded = self._supersede(key) if key is not None else []
+            queue = self._queues.get(owner)
+            if queue is not None and len(queue) >= self.max_queued:
+                raise SchedulerBusy(f'{len(queue)} jobs already waiting')
+            if queue is None:
+                queue = self._queues[owner] = deque()
+                self._ring.append(owner)
+            queue.append(job)
+            started = self._dispatch()
+            positions = self._positions()
+
+        for old in superseded:
+            old.cancel()
+            old._notify('cancelled')
+        self._announce(started, positions)
+        return job
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._running.get(job_id) or self._unqueue(lambda j: j.id == job_id)
+            positions = self._positions()
+        if job is None:
+            return False
+        job.cancel()
+        job._notify('cancelled')
+        self._announce([], positions)
+        return True
+
+    def cancel_key(self, key):
+        """Cancel every queued or running job submitted with key."""
+        with self._lock:
+            jobs = self._supersede(key)
+            positions = self._positions()
+        for job in jobs:
+            if job.state != 'cancelled':
+                job.cancel()
+                job._notify('cancelled')
+        self._announce([], positions)
+        return len(jobs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': len(self._running),
+                'queued': sum(len(q) for q in self._queues.values()),
+                'max_workers': self.max_workers,
+            }
+
+    def _supersede(self, key):
+        jobs = [job for job in self._running.values() if job.key == key]
+        while True:
+            job = self._unqueue(lambda j: j.key == key)
+            if job is None:
+                return jobs
+            jobs.append(job)
+
+    def _unqueue(self, match):
+        for owner, queue in self._queues.items():
+            for job in queue:
+                if match(job):
+                    queue.remove(job)
+                    if not queue:
+                        del self._queues[owner]
+                        self._ring.remove(owner)
+                    return job
+        return None
+
+    def _dispatch(self):
+        started = []
+        while self._ring and len(self._running) < self.max_workers:
+            owner = self._ring.popleft()
+            queue = self._queues[owner]
+            job = queue.popleft()
+            if queue:
+                self._ring.append(owner)
+            else:
+                del self._queues[owner]
+            self._running[job.id] = job
+            started.append(job)
+        return started
+
+    def _positions(self):
+        """Map each queued job to the slot it will get, in round-robin order."""
+        positions = {}
+        queues = [(owner, list(self._queues[owner])) for owner in self._ring]
+        position = 1
+        depth = 0
+        while queues:
+            for _, jobs in queues:
+                positions[jobs[depth]] = position
+                position += 1
+            depth += 1
+            queues = [(owner, jobs) for owner, jobs in queues if len(jobs) > depth]
+        return positions
+
+    def _announce(self, started, positions):
+        for job, position in positions.items():
+            if job.position != position:
+                job._notify('queued', position)
+        for job in started:
+            job._notify('running')
+            self.spawn(self._run, job)
+
+    def _run(self, job):
+        try:
+            if not job.cancelled.is_set():
+                job.fn(job)
+        finally:
+            with self._lock:
+                self._running.pop(job.id, None)
+                started = self._dispatch()
+                positions = self._positions()
+            if job.state == 'running':
+                job._notify('done')
+            self._announce(started, positions)
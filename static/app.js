@@ -0,0 +1,411 @@
+lucide.createIcons();
+const socket = io(JSON.parse(document.body.dataset.socketOptions || '{}'));
+
+// Background
+// The background is a flat colour: paint it on resize, not every frame
+const canvas = document.getElementById('bgCanvas');
+const ctx = canvas.getContext('2d');
+function resize() {
+    canvas.width = window.innerWidth; canvas.height = window.innerHeight;
+    ctx.fillStyle = '#020617'; ctx.fillRect(0,0,canvas.width,canvas.height);
+}
+window.onresize = resize; resize();
+
+// --- Dual Terminal Logic ---
+// A terminal keeps its lines in a ring buffer (the newest `scrollback`
+// lines) and only has DOM rows for what is on screen. Appends are
+// batched into one render per animation frame, so a flood of output
+// costs one layout per frame instead of one per line.
+const ROW_HEIGHT = 16;
+const OVERSCAN = 10;
+
+class TerminalView {
+    constructor(box, prefix = '') {
+        this.box = box;
+        this.prefix = prefix;
+        this.capacity = parseInt(box.dataset.scrollback, 10) || 10000;
+        this.lines = new Array(this.capacity);
+        this.start = 0;
+        this.length = 0;
+        this.dropped = 0;
+        this.follow = true;
+        this.frame = null;
+
+        // The placeholder text stays as the first line
+        const hint = box.textContent.trim();
+        box.textContent = '';
+        if(hint) this.lines[this.length++] = {text: hint, color: 'rgba(165, 243, 252, 0.5)'};
+        this.spacer = document.createElement('div');
+        this.spacer.className = 'term-spacer';
+        this.rows = document.createElement('div');
+        this.rows.className = 'term-rows';
+        this.spacer.appendChild(this.rows);
+        box.appendChild(this.spacer);
+        box.addEventListener('scroll', () => {
+            this.follow = box.scrollTop + box.clientHeight >= box.scrollHeight - ROW_HEIGHT;
+            this.schedule();
+        });
+    }
+
+    append(text, color = null) {
+        const line = {text: this.prefix + text, color};
+        if(this.length < this.capacity) {
+            this.lines[(this.start + this.length++) % this.capacity] = line;
+        } else {
+            // Full: the oldest line makes room
+            this.lines[this.start] = line;
+            this.start = (this.start + 1) % this.capacity;
+            this.dropped++;
+        }
+        this.schedule();
+    }
+
+    clear() {
+        this.start = this.length = 0;
+        this.follow = true;
+        this.schedule();
+    }
+
+    line(i) { return this.lines[(this.start + i) % this.capacity]; }
+
+    schedule() {
+        if(this.frame === null) this.frame = requestAnimationFrame(() => this.render());
+    }
+
+    render() {
+        this.frame = null;
+        const box = this.box;
+        this.spacer.style.height = `${this.length * ROW_HEIGHT}px`;
+        if(this.follow) box.scrollTop = box.scrollHeight;
+
+        const first = Math.max(0, Math.floor(box.scrollTop / ROW_HEIGHT) - OVERSCAN);
+        const count = Math.min(this.length - first, Math.ceil(box.clientHeight / ROW_HEIGHT) + 2 * OVERSCAN);
+        this.rows.style.transform = `translateY(${first * ROW_HEIGHT}px)`;
+
+        // Reuse row elements; only their text changes
+        const rows = this.rows.children;
+        while(rows.length < count) {
+            const row = document.createElement('div');
+            row.className = 'term-row';
+            this.rows.appendChild(row);
+        }
+        while(rows.length > Math.max(count, 0)) this.rows.lastChild.remove();
+        for(let i = 0; i < count; i++) {
+            const line = this.line(first + i);
+            const row = rows[i];
+            if(row.textContent !== line.text) row.textContent = line.text;
+            row.style.color = line.color || '';
+        }
+    }
+}
+
+const terminals = {};
+const libBox = document.getElementById('lib-terminal');
+const outBox = document.getElementById('out-terminal');
+if(libBox) terminals.lib = new TerminalView(libBox);
+if(outBox) terminals.out = new TerminalView(outBox, '> ');
+
+// The server says which terminal a line belongs to
+function appendLine(text, terminal = 'out', color = null) {
+    const view = terminals[terminal] || terminals.out;
+    if(view) view.append(text, color);
+}
+
+socket.on('terminal_output', data => appendLine(data.output, data.terminal, data.color));
+
+// Run/command output arrives as sequenced binary frames
+const streams = {};
+socket.on('terminal_frame', frame => {
+    let state = streams[frame.stream];
+    if(!state) state = streams[frame.stream] = {seq: -1, decoder: new TextDecoder(), tail: ''};
+    const terminal = frame.terminal;
+    if(frame.seq !== state.seq + 1) appendLine(`[SYSTEM] ${frame.seq - state.seq - 1} output frame(s) lost`, terminal);
+    state.seq = frame.seq;
+    if(frame.dropped) appendLine(`[SYSTEM] ${frame.dropped} bytes of output skipped (client too slow)`, terminal);
+
+    const lines = (state.tail + state.decoder.decode(new Uint8Array(frame.data), {stream: !frame.eof})).split('\n');
+    state.tail = frame.eof ? '' : lines.pop();
+    for(const line of lines) { const text = line.trim(); if(text) appendLine(text, terminal); }
+    if(frame.eof) delete streams[frame.stream];
+
+    // While a run is going, the input box feeds its input()
+    if(frame.stream.startsWith('run-')) activeRun = frame.eof ? null : frame.stream.slice(4);
+});
+
+socket.on('run_stats', stats => {
+    const rss = stats.max_rss == null ? '?' : (stats.max_rss / 1048576).toFixed(1);
+    const killed = stats.killed ? ` · killed (${stats.killed} limit)` : '';
+    if(stats.cached) { appendLine(`[STATS] exit ${stats.exit_code} · replayed from cache`, stats.terminal); return; }
+    appendLine(`[STATS] exit ${stats.exit_code} · ${stats.wall_seconds.toFixed(2)}s wall · ` +
+               `cpu ${stats.user_cpu.toFixed(2)}s user / ${stats.sys_cpu.toFixed(2)}s sys · ` +
+               `${rss} MB peak · ${stats.bytes_out} bytes out${killed}`, stats.terminal);
+});
+
+socket.on('run_cache', result => {
+    if(result.hit) appendLine(`[CACHE] Hit: replaying output recorded ${new Date(result.created * 1000).toLocaleTimeString()}`);
+    else appendLine('[CACHE] Miss: running');
+});
+
+// pip install steps, one event each
+const INSTALL_COLORS = {satisfied: 'var(--cyan)', failed: '#ef4444', done: '#10b981'};
+socket.on('install_progress', event => {
+    if(event.stage === 'installed') return;  // listed again by 'done'
+    appendLine(`[PIP] ${event.message}`, event.terminal, INSTALL_COLORS[event.stage] || null);
+});
+
+socket.on('run_status', status => {
+    if(status.state === 'queued') appendLine(`[QUEUE] Waiting for a free runner (position ${status.position})`);
+    if(status.state === 'cancelled') appendLine(`[SYSTEM] Job ${status.job} cancelled`);
+});
+
+// --- Interactive terminal ---
+let activeRun = null;
+function termSize() {
+    const box = document.getElementById('out-terminal');
+    if(!box) return {rows: 24, cols: 80};
+    return {rows: Math.max(5, Math.floor(box.clientHeight / 18)), cols: Math.max(20, Math.floor(box.clientWidth / 8))};
+}
+
+function sendCmd() {
+    const cmdInput = document.getElementById('cmd');
+    if(activeRun) {
+        // The run's tty echoes it back
+        socket.emit('run_input', {run: activeRun, data: cmdInput.value + '\n'});
+        cmdInput.value = '';
+        return;
+    }
+    if(!cmdInput.value) return;
+    // The server echoes the command to every tab on the project, this one too
+    socket.emit('terminal_command', {command: cmdInput.value, ...termSize()});
+    cmdInput.value = '';
+}
+
+const cmdBox = document.getElementById('cmd');
+if(cmdBox) cmdBox.addEventListener('keydown', e => {
+    if(e.key === 'Enter') { e.preventDefault(); sendCmd(); }
+    // Ctrl-C interrupts the run, or the shell's foreground command
+    if(e.ctrlKey && e.key === 'c' && !cmdBox.value.substring(cmdBox.selectionStart, cmdBox.selectionEnd)) {
+        e.preventDefault();
+        if(activeRun) socket.emit('run_input', {run: activeRun, data: '\x03'});
+        else socket.emit('terminal_input', {data: '\x03'});
+    }
+});
+
+let resizeTimer;
+function sendResize() {
+    clearTimeout(resizeTimer);
+    resizeTimer = setTimeout(() => socket.emit('terminal_resize', {...termSize(), run: activeRun}), 200);
+}
+socket.on('connect', sendResize);
+window.addEventListener('resize', sendResize);
+
+// --- Delta autosave ---
+// The server keeps a versioned copy of the file; we only send the
+// changed range against the last version it acknowledged.
+let doc = {filename: null, version: null, shadow: '', sent: null, opening: false, waiting: []};
+let saveTimer;
+
+function isLowSurrogate(code) { return code >= 0xDC00 && code <= 0xDFFF; }
+
+// Offsets are sent in code points, which is how Python indexes strings
+function codePoints(text) {
+    let count = 0;
+    for(let i = 0; i < text.length; i++) if(!isLowSurrogate(text.charCodeAt(i))) count++;
+    return count;
+}
+
+function diffOp(before, after) {
+    let start = 0;
+    const max = Math.min(before.length, after.length);
+    while(start < max && before.charCodeAt(start) === after.charCodeAt(start)) start++;
+    let endBefore = before.length, endAfter = after.length;
+    while(endBefore > start && endAfter > start &&
+          before.charCodeAt(endBefore - 1) === after.charCodeAt(endAfter - 1)) { endBefore--; endAfter--; }
+    // Never split a surrogate pair
+    if(start > 0 && (isLowSurrogate(before.charCodeAt(start)) || isLowSurrogate(after.charCodeAt(start)))) start--;
+    if(endBefore < before.length && isLowSurrogate(before.charCodeAt(endBefore))) { endBefore++; endAfter++; }
+    return [codePoints(before.slice(0, start)), codePoints(before.slice(start, endBefore)), after.slice(start, endAfter)];
+}
+
+function syncFile() {
+    const filename = document.getElementById('filename').value;
+    const content = document.getElementById('code').value;
+    if(filename !== doc.filename) doc = {filename, version: null, shadow: '', sent: null, opening: false, waiting: doc.waiting};
+    if(doc.sent !== null || doc.opening) return;  // the ack/state reply calls us again
+    if(doc.version === null) {
+        doc.sent = content;
+        socket.emit('save_file', {filename, content});
+    } else if(content !== doc.shadow) {
+        doc.sent = content;
+        socket.emit('edit_file', {filename, version: doc.version, ops: [diffOp(doc.shadow, content)]});
+    } else {
+        doc.waiting.splice(0).forEach(fn => fn());
+    }
+}
+
+function whenSynced(fn) {
+    clearTimeout(saveTimer);
+    doc.waiting.push(fn);
+    syncFile();
+}
+
+socket.on('file_ack', ack => {
+    if(ack.filename !== doc.filename) return;
+    doc.version = ack.version;
+    if(doc.sent !== null) doc.shadow = doc.sent;
+    doc.sent = null;
+    syncFile();
+});
+
+// Server's copy, on open or after a version mismatch; our next
+// delta is computed against it
+socket.on('file_state', state => {
+    if(state.filename !== doc.filename) return;
+    doc.version = state.version;
+    doc.shadow = state.content;
+    doc.sent = null;
+    doc.opening = false;
+    syncFile();
+});
+
+function runCode(btn) {
+    const filename = document.getElementById('filename').value;
+    terminals.out.clear();
+    terminals.out.append(`[SYSTEM] Running ${filename}...`, 'var(--cyan)');
+    const cache = document.getElementById('cache-run').checked;
+    whenSynced(() => socket.emit('run_code', {filename, cache}));
+
+    btn.innerHTML = '<i data-lucide="loader" class="spin"></i> Running...';
+    lucide.createIcons();
+    setTimeout(() => { 
+        btn.innerHTML = '<i data-lucide="play"></i> Run Code'; 
+        lucide.createIcons(); 
+    }, 1500);
+}
+
+// --- Workspace ---
+// The file tree comes without contents. A file's body is fetched when
+// it is opened and kept in localStorage under its hash, so reopening an
+// unchanged file costs no request; otherwise the browser revalidates
+// its copy with If-None-Match and gets a 304 if it is still current.
+const FILE_CACHE_PREFIX = 'cyber20un:file:';
+let workspace = {files: [], etag: null};
+
+function cachedFile(hash) {
+    try { return localStorage.getItem(FILE_CACHE_PREFIX + hash); } catch(e) { return null; }
+}
+
+function cacheFile(hash, content) {
+    try {
+        localStorage.setItem(FILE_CACHE_PREFIX + hash, content);
+    } catch(e) {
+        // Full: drop our cached files and try once more
+        try {
+            Object.keys(localStorage).filter(k => k.startsWith(FILE_CACHE_PREFIX)).forEach(k => localStorage.removeItem(k));
+            localStorage.setItem(FILE_CACHE_PREFIX + hash, content);
+        } catch(e2) {}
+    }
+}
+
+function filePath(name) { return name.split('/').map(encodeURIComponent).join('/'); }
+
+function formatSize(bytes) {
+    return bytes < 1024 ? `${bytes} B` : bytes < 1048576 ? `${(bytes / 1024).toFixed(1)} KB` : `${(bytes / 1048576).toFixed(1)} MB`;
+}
+
+async function loadWorkspace() {
+    const headers = workspace.etag ? {'If-None-Match': workspace.etag} : {};
+    const response = await fetch('/api/workspace', {headers, cache: 'no-store'});
+    if(response.status === 304 || !response.ok) return;
+    const data = await response.json();
+    workspace = {
+        etag: response.headers.get('ETag'),
+        files: data.files.map(row => Object.fromEntries(data.fields.map((field, i) => [field, row[i]]))),
+    };
+    renderTree();
+}
+
+function renderTree() {
+    const tree = document.getElementById('file-tree');
+    const current = document.getElementById('filename').value;
+    tree.textContent = '';
+    for(const file of workspace.files) {
+        const item = document.createElement('button');
+        item.className = file.name === current ? 'file-item active' : 'file-item';
+        item.textContent = file.name;
+        item.title = `${formatSize(file.size)}, edited ${new Date(file.mtime * 1000).toLocaleString()}`;
+        item.onclick = () => openFile(file.name);
+        tree.appendChild(item);
+    }
+}
+
+function showFile(filename, content, version) {
+    if(doc.filename !== filename) return;  // switched again meanwhile
+    codeBox.value = content;
+    doc.version = version;
+    doc.shadow = content;
+    doc.opening = false;
+    syncFile();
+}
+
+// Save what is being edited, then load another file into the editor
+function openFile(filename) {
+    const load = async () => {
+        document.getElementById('filename').value = filename;
+        doc = {filename, version: null, shadow: '', sent: null, opening: true, waiting: doc.waiting};
+        renderTree();
+        const entry = workspace.files.find(f => f.name === filename);
+        const cached = entry ? cachedFile(entry.hash) : null;
+        if(cached !== null) return showFile(filename, cached, entry.version);
+        const response = entry ? await fetch(`/api/workspace/files/${filePath(filename)}`) : null;
+        if(!response || !response.ok) {
+            // A new file: created by its first save
+            if(doc.filename !== filename) return;
+            codeBox.value = '';
+            doc.opening = false;
+            return;
+        }
+        const content = await response.text();
+        const hash = (response.headers.get('ETag') || '').replace(/"/g, '');
+        if(hash) cacheFile(hash, content);
+        showFile(filename, content, parseInt(response.headers.get('X-File-Version'), 10));
+    };
+    // Before the first file is loaded there is nothing of ours to save
+    if(doc.filename === null || doc.opening) load();
+    else whenSynced(load);
+}
+
+socket.on('file_ack', ack => {
+    // A file the tree doesn't know yet was just created
+    if(!workspace.files.some(f => f.name === ack.filename)) loadWorkspace();
+});
+
+// A snapshot was restored (from any tab): its files replace ours, so
+// drop the local copy of the open one instead of saving it over them
+socket.on('workspace_restored', () => {
+    clearTimeout(saveTimer);
+    doc = {...doc, sent: null, opening: true};
+    workspace.etag = null;
+    loadWorkspace().then(() => openFile(document.getElementById('filename').value));
+});
+
+// Autosave code on change
+const codeBox = document.getElementById('code');
+if(codeBox) {
+    let opened = false;
+    socket.on('connect', () => {
+        const filename = document.getElementById('filename').value;
+        if(!opened) {
+            opened = true;
+            loadWorkspace().then(() => openFile(filename));
+            return;
+        }
+        // Reconnected: keep what is in the editor, diff it against the server's copy
+        doc = {filename, version: null, shadow: '', sent: null, opening: true, waiting: doc.waiting};
+        socket.emit('open_file', {filename});
+    });
+    codeBox.addEventListener('input', function() {
+        clearTimeout(saveTimer);
+        saveTimer = setTimeout(syncFile, 1000);
+    });
+}
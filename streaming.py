@@ -0,0 +1,172 @@
+import errno
+import os
+import select
+import threading
+import time
+
+CHUNK_SIZE = 4096
+
+# Coalescing window and per-client budget for streamed output
+FRAME_WINDOW = 0.03
+# Shells echo keystrokes; a short window keeps typing responsive
+INTERACTIVE_WINDOW = 0.005
+CLIENT_RATE = 256 * 1024
+CLIENT_BURST = 64 * 1024
+MAX_BUFFER = 256 * 1024
+
+
+class TokenBucket:
+    """Byte budget refilled at `rate` bytes/sec, holding at most `burst`."""
+
+    def __init__(self, rate=CLIENT_RATE, burst=CLIENT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, wanted):
+        """Consume up to `wanted` bytes and return how many were granted."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            granted = int(min(wanted, self._tokens))
+            self._tokens -= granted
+            return granted
+
+    @property
+    def stamp(self):
+        return self._stamp
+
+    def wait_time(self, wanted):
+        with self._lock:
+            missing = min(wanted, self.burst) - self._tokens
+        return max(0.0, missing / self.rate)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_buckets_pruned = time.monotonic()
+# A bucket idle this long has refilled, so dropping it changes nothing
+BUCKET_IDLE = 300
+
+
+def client_bucket(client_id):
+    """Shared byte budget for everything streamed to one client."""
+    global _buckets_pruned
+    with _buckets_lock:
+        bucket = _buckets.get(client_id)
+        if bucket is None:
+            now = time.monotonic()
+            if now - _buckets_pruned >= BUCKET_IDLE:
+                # Execution workers never see disconnects, so clients
+                # are forgotten by age as well
+                for key in [key for key, b in _buckets.items() if now - b.stamp >= BUCKET_IDLE]:
+                    del _buckets[key]
+                _buckets_pruned = now
+            bucket = _buckets[client_id] = TokenBucket()
+        return bucket
+
+
+def forget_client(client_id):
+    """Drop a client's budget, e.g. once the last tab of its room has gone."""
+    with _buckets_lock:
+        _buckets.pop(client_id, None)
+
+
+class OutputStream:
+    """Coalesces raw output into sequenced, rate-limited frames.
+
+    Bytes are buffered and sent at most once per `window` as a frame
+    dict: {'stream', 'seq', 'data', 'dropped', 'eof'}. A frame never
+    exceeds what the client's TokenBucket allows; when the client falls
+    so far behind that the buffer passes `max_buffer`, the oldest output
+    is discarded and reported in the next frame's `dropped` count.
+    """
+
+    def __init__(self, stream_id, send, bucket, window=FRAME_WINDOW, max_buffer=MAX_BUFFER):
+        self.stream_id = stream_id
+        self.send = send
+        self.bucket = bucket
+        self.window = window
+        self.max_buffer = max_buffer
+        self.seq = 0
+        self.bytes_out = 0
+        self.bytes_dropped = 0
+        self._buffer = bytearray()
+        self._dropped = 0
+        self._last_flush = time.monotonic()
+
+    def feed(self, data):
+        self._buffer += data
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            # Cut at a line boundary so the client doesn't get half a line
+            newline = self._buffer.find(b'\n', overflow)
+            cut = newline + 1 if newline != -1 else overflow
+            del self._buffer[:cut]
+            self._dropped += cut
+            self.bytes_dropped += cut
+        self.maybe_flush()
+
+    def time_to_flush(self):
+        if not self._buffer and not self._dropped:
+            return None
+        return max(0.0, self._last_flush + self.window - time.monotonic())
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.window:
+            self.flush()
+
+    def flush(self, eof=False):
+        self._last_flush = time.monotonic()
+        size = self.bucket.take(len(self._buffer)) if self._buffer else 0
+        if not size and not self._dropped and not eof:
+            return
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.send({
+            'stream': self.stream_id,
+            'seq': self.seq,
+            'data': data,
+            'dropped': self._dropped,
+            'eof': eof,
+        })
+        self.seq += 1
+        self.bytes_out += size
+        self._dropped = 0
+
+    def close(self):
+        """Send whatever is still buffered, as fast as the budget allows."""
+        while self._buffer:
+            time.sleep(self.bucket.wait_time(len(self._buffer)))
+            self.flush()
+        self.flush(eof=True)
+
+
+def pump(pipe, stream, on_data=None, chunk_size=CHUNK_SIZE):
+    """Copy a child's pipe or pty into `stream` until EOF, in raw chunks.
+
+    select() with the stream's flush deadline as timeout means a frame
+    goes out on time even while the child is quiet.
+    """
+    fd = pipe.fileno()
+    while True:
+        ready, _, _ = select.select([fd], [], [], stream.time_to_flush())
+        if ready:
+            try:
+                data = os.read(fd, chunk_size)
+            except OSError as e:
+                # A pty master reports EIO once the other side has closed
+                if e.errno != errno.EIO:
+                    raise
+                data = b''
+            if not data:
+                break
+            if on_data is not None:
+                on_data(data)
+            stream.feed(data)
+        else:
+            stream.flush()
+    stream.close()
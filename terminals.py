@@ -0,0 +1,270 @@
+"""Pseudo-terminals for runs and persistent project shells.
+
+A run gets a pty instead of pipes, so the script sees a terminal: output
+is line buffered, input() reads what the user types, and Ctrl-C is a
+SIGINT. Each project can also keep a shell open on a pty; commands are
+written to it, so `cd`, exported variables and shell state survive from
+one command to the next and no shell is started per command.
+
+Shells are capped per user and closed after `idle_timeout` seconds
+without input or output. They live in the process that opened them;
+input for a shell or run in another process is routed through the
+message queue's control channel.
+"""
+import atexit
+import errno
+import fcntl
+import itertools
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import termios
+import threading
+import time
+
+from sandbox import apply_limits, exec_baseline
+
+DEFAULT_ROWS = 24
+DEFAULT_COLS = 80
+
+
+class TerminalLimit(Exception):
+    """Raised when a user already has the maximum number of shells open."""
+
+
+def set_winsize(fd, rows, cols):
+    rows = max(1, min(int(rows), 1000))
+    cols = max(1, min(int(cols), 1000))
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+
+def open_pty(rows=DEFAULT_ROWS, cols=DEFAULT_COLS, echo=True):
+    """(master, slave) fds of a new pty sized rows x cols."""
+    master, slave = os.openpty()
+    set_winsize(master, rows, cols)
+    if not echo:
+        attrs = termios.tcgetattr(slave)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    os.set_inheritable(master, False)
+    return master, slave
+
+
+def attach_tty(fd=0):
+    """Make fd the controlling terminal; call after setsid()."""
+    try:
+        fcntl.ioctl(fd, termios.TIOCSCTTY, 0)
+    except OSError:
+        pass
+
+
+def tty_preexec(limits, cgroup=None):
+    """preexec_fn for a Popen whose stdio is a pty slave (with start_new_session=True)."""
+    procs = cgroup.procs if cgroup is not None else None
+    # Measured here: the child is about to exec
+    baseline = exec_baseline()
+
+    def preexec():
+        attach_tty(0)
+        apply_limits(limits, procs, baseline)
+    return preexec
+
+
+def write_all(fd, data):
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                time.sleep(0.01)
+                continue
+            raise
+        data = data[written:]
+
+
+def shell_argv():
+    # No rc files, no readline (the tty echo is off, the client echoes)
+    bash = shutil.which('bash')
+    if bash:
+        return [bash, '--norc', '--noprofile', '--noediting', '-i']
+    return [shutil.which('sh') or '/bin/sh', '-i']
+
+
+class ShellSession:
+    """One long-lived shell on a pty."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, key, user, cwd, env, limits, cgroup=None, rows=DEFAULT_ROWS,
+                 cols=DEFAULT_COLS):
+        self.id = next(self._ids)
+        self.key = key
+        self.user = user
+        self.cgroup = cgroup
+        self.master, slave = open_pty(rows, cols, echo=False)
+        try:
+            self.process = subprocess.Popen(
+                shell_argv(),
+                stdin=slave,
+                stdout=slave,
+                stderr=slave,
+                cwd=str(cwd),
+                env={**env, 'PS1': '', 'PS2': '', 'TERM': 'dumb'},
+                start_new_session=True,
+                preexec_fn=tty_preexec(limits, cgroup)
+            )
+        except BaseException:
+            os.close(self.master)
+            if cgroup is not None:
+                cgroup.remove()
+            raise
+        finally:
+            os.close(slave)
+        self.output = os.fdopen(self.master, 'rb', buffering=0)
+        # Set by whoever pumps the output, if it keeps a log
+        self.run_log = None
+        self.last_active = time.monotonic()
+        self.closed = False
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def idle_for(self):
+        return time.monotonic() - self.last_active
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.touch()
+        write_all(self.master, data)
+
+    def resize(self, rows, cols):
+        set_winsize(self.master, rows, cols)
+
+    def alive(self):
+        return not self.closed and self.process.poll() is None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.cgroup is not None:
+            self.cgroup.kill()
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.process.wait()
+        if self.cgroup is not None:
+            self.cgroup.remove()
+
+
+class TerminalManager:
+    """Persistent shells keyed by project, capped per user, closed when idle.
+
+    `start(session)` is called once for every new shell and should pump
+    its output (session.output) until EOF; it runs as a background task
+    through `spawn`.
+    """
+
+    def __init__(self, spawn, start, max_per_user=3, idle_timeout=15 * 60, reap_interval=30):
+        self.spawn = spawn
+        self.start_session = start
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._reaping = False
+        self.opened = 0
+        self.reaped = 0
+
+    def get(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+        return session if session is not None and session.alive() else None
+
+    def open(self, key, user, cwd, env, limits, new_cgroup=None, rows=DEFAULT_ROWS,
+             cols=DEFAULT_COLS):
+        """The live shell for key, starting one if needed; (session, created).
+
+        new_cgroup() is only called when a shell is started.
+        """
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and session.alive():
+                return session, False
+            if session is not None:
+                del self._sessions[key]
+            if sum(1 for s in self._sessions.values() if s.user == user) >= self.max_per_user:
+                raise TerminalLimit(f'{self.max_per_user} terminals already open')
+            cgroup = new_cgroup() if new_cgroup is not None else None
+            session = self._sessions[key] = ShellSession(key, user, cwd, env, limits, cgroup,
+                                                         rows, cols)
+            self.opened += 1
+        self.spawn(self._run, session)
+        self._start_reaper()
+        return session, True
+
+    def _run(self, session):
+        try:
+            self.start_session(session)
+        finally:
+            session.close()
+            with self._lock:
+                if self._sessions.get(session.key) is session:
+                    del self._sessions[session.key]
+
+    def close(self, key):
+        with self._lock:
+            session = self._sessions.pop(key, None)
+        if session is not None:
+            session.close()
+        return session is not None
+
+    def reap_idle(self):
+        with self._lock:
+            idle = [s for s in self._sessions.values() if s.idle_for() >= self.idle_timeout]
+            for session in idle:
+                del self._sessions[session.key]
+        for session in idle:
+            session.close()
+        self.reaped += len(idle)
+        return len(idle)
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaping:
+                return
+            self._reaping = True
+        self.spawn(self._reap_loop)
+
+    def _reap_loop(self):
+        while not self._stopping.wait(self.reap_interval):
+            self.reap_idle()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'open': len(self._sessions),
+                'opened': self.opened,
+                'reaped_idle': self.reaped,
+                'max_per_user': self.max_per_user,
+            }
+
+    def close_all(self):
+        self._stopping.set()
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+def open_terminal_manager(spawn, start, **kwargs):
+    manager = TerminalManager(spawn, start, **kwargs)
+    atexit.register(manager.close_all)
+    return manager
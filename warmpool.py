@@ -0,0 +1,370 @@
+"""Pre-started fork servers that launch user scripts without a cold start.
+
+Each Python environment gets a fork server: a long-lived interpreter that
+has already imported site and the preload modules. A run connects to the
+server over a Unix socket, passes the write end of its output pipe (or
+the slave side of its pty) along, and the server forks a child that runs
+the script with runpy. The child
+only pays for the fork, not for interpreter startup and imports. The
+child confines itself with the run's sandbox limits before running the
+script, and the server reports its exit status with its rusage.
+
+Run as a script, this module is the fork server itself:
+    python warmpool.py <socket path> [module ...]
+"""
+import atexit
+import importlib
+import json
+import os
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+from sandbox import Limits, apply_limits, rusage_dict
+from terminals import DEFAULT_COLS, DEFAULT_ROWS, attach_tty, open_pty
+
+SERVER_SCRIPT = os.path.abspath(__file__)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+# --- Fork server side ---
+
+def serve(address, preload):
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(64)
+
+    # SIGCHLD wakes the select loop through the wakeup fd
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    # The web process holds our stdin open; EOF means it went away
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    parent = sys.stdin.fileno()
+
+    children = {}
+    print('ready', flush=True)
+    try:
+        while True:
+            readable, _, _ = select.select([listener, wake_r, parent], [], [])
+            if parent in readable and not os.read(parent, 1):
+                return
+            if listener in readable:
+                conn, _ = listener.accept()
+                message, fds, _, _ = socket.recv_fds(conn, 65536, 1)
+                request = json.loads(message)
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    for other in children.values():
+                        other.close()
+                    conn.close()
+                    signal.set_wakeup_fd(-1)
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    os.close(wake_r)
+                    os.close(wake_w)
+                    _run_child(request, fds[0])
+                os.close(fds[0])
+                conn.sendall(f'{pid}\n'.encode())
+                children[pid] = conn
+            if wake_r in readable:
+                os.read(wake_r, 4096)
+                _reap(children)
+    finally:
+        # Don't leave orphaned runs behind
+        for pid in children:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+def _reap(children):
+    while children:
+        pid, status, usage = os.wait4(-1, os.WNOHANG)
+        if pid == 0:
+            return
+        conn = children.pop(pid, None)
+        if conn is None:
+            continue
+        result = {'code': os.waitstatus_to_exitcode(status), 'rusage': rusage_dict(usage)}
+        try:
+            conn.sendall(f'{json.dumps(result)}\n'.encode())
+        except OSError:
+            pass
+        conn.close()
+
+
+def _run_child(request, out_fd):
+    # Own process group, so killing the run also kills anything it spawned
+    os.setsid()
+    limits = request.get('limits')
+    apply_limits(Limits.from_dict(limits) if limits else None, request.get('cgroup'))
+    if request.get('tty'):
+        # out_fd is a pty slave: it is stdin too, and the controlling tty
+        attach_tty(out_fd)
+        stdin = os.dup(out_fd)
+    else:
+        stdin = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(stdin, 0)
+    os.dup2(out_fd, 1)
+    os.dup2(out_fd, 2)
+    os.close(stdin)
+    os.close(out_fd)
+    # sys.std* were set up for the server's own pipes
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) else -1, closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, closefd=False)
+    os.chdir(request['cwd'])
+
+    path = request['path']
+    sys.argv = [path]
+    sys.path[0] = os.path.dirname(path)
+    # A script in a subdirectory can still import the project's top-level modules
+    project = os.getcwd()
+    if os.path.realpath(sys.path[0]) != project:
+        sys.path.insert(1, project)
+    code = 0
+    try:
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(code)
+
+
+# --- Web process side ---
+
+class WarmProcess:
+    """Popen-like handle for a script forked by a fork server.
+
+    For a run on a pty, `tty` is the master fd to write input to.
+    """
+
+    def __init__(self, server, conn, pid, stdout, tty=None, status=b''):
+        self.server = server
+        self.pid = pid
+        self.stdout = stdout
+        self.tty = tty
+        self.returncode = None
+        self.rusage = None
+        self._conn = conn
+        # A quick script's exit status may come in the same read as its pid
+        self._status = status
+
+    def poll(self):
+        if self.returncode is None:
+            readable, _, _ = select.select([self._conn], [], [], 0)
+            if readable or self._status.endswith(b'\n'):
+                self._read_status()
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self._read_status()
+        return self.returncode
+
+    def kill(self):
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _read_status(self):
+        data = self._status
+        while not data.endswith(b'\n'):
+            chunk = self._conn.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        self._conn.close()
+        if data.strip():
+            result = json.loads(data)
+            self.returncode = result['code']
+            self.rusage = result['rusage']
+        else:
+            # The fork server went away before reporting
+            self.returncode = -signal.SIGKILL
+            self.rusage = {'user_cpu': 0.0, 'sys_cpu': 0.0, 'max_rss': None}
+        self.stdout.close()
+        self.server._finished()
+
+
+class ForkServer:
+    """One fork server process for one Python executable."""
+
+    def __init__(self, python, preload=()):
+        self.python = python
+        self.address = os.path.join(tempfile.mkdtemp(prefix='cyber20un-warm-'), 'server.sock')
+        self.process = subprocess.Popen(
+            [python, SERVER_SCRIPT, self.address, *preload],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        if self.process.stdout.readline().strip() != b'ready':
+            self.process.kill()
+            raise OSError(f'fork server for {python} failed to start')
+        self.runs = 0
+        self.active = 0
+        self.retired = False
+        self._lock = threading.Lock()
+
+    def spawn(self, path, cwd, limits=None, cgroup=None, tty=False):
+        if tty:
+            read_fd, write_fd = open_pty(DEFAULT_ROWS, DEFAULT_COLS)
+        else:
+            read_fd, write_fd = os.pipe()
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.address)
+            request = json.dumps({
+                'path': str(path),
+                'cwd': str(cwd),
+                'limits': limits.to_dict() if limits is not None else None,
+                'cgroup': cgroup.procs if cgroup is not None else None,
+                'tty': tty,
+            }).encode()
+            socket.send_fds(conn, [request], [write_fd])
+            data = b''
+            while b'\n' not in data:
+                chunk = conn.recv(32)
+                if not chunk:
+                    raise OSError('fork server closed the connection')
+                data += chunk
+            pid, _, status = data.partition(b'\n')
+        except BaseException:
+            conn.close()
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        with self._lock:
+            self.runs += 1
+            self.active += 1
+        return WarmProcess(self, conn, int(pid), os.fdopen(read_fd, 'rb', buffering=0),
+                           read_fd if tty else None, status)
+
+    def rss(self):
+        try:
+            with open(f'/proc/{self.process.pid}/statm') as f:
+                return int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def retire(self):
+        with self._lock:
+            self.retired = True
+            idle = self.active == 0
+        if idle:
+            self.close()
+
+    def _finished(self):
+        with self._lock:
+            self.active -= 1
+            idle = self.retired and self.active == 0
+        if idle:
+            self.close()
+
+    def close(self):
+        if self.alive():
+            self.process.terminate()
+            self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        try:
+            os.unlink(self.address)
+            os.rmdir(os.path.dirname(self.address))
+        except OSError:
+            pass
+
+
+class WarmPool:
+    """Fork servers keyed by Python executable, recycled as they age.
+
+    A server is retired after max_runs forks or once its RSS passes
+    max_rss; retired servers finish their running scripts and exit.
+    """
+
+    def __init__(self, preload=(), max_runs=200, max_rss=512 * 1024 * 1024):
+        self.preload = tuple(preload)
+        self.max_runs = max_runs
+        self.max_rss = max_rss
+        self._servers = {}
+        self._lock = threading.Lock()
+
+    def prestart(self, python):
+        self._server(python)
+
+    def spawn(self, python, path, cwd, limits=None, cgroup=None, tty=False):
+        """Start path under python's fork server; returns a WarmProcess."""
+        try:
+            return self._server(python).spawn(path, cwd, limits, cgroup, tty)
+        except OSError:
+            # The server died under us; replace it and try once more
+            self.discard(python)
+            return self._server(python).spawn(path, cwd, limits, cgroup, tty)
+
+    def _server(self, python):
+        # Keyed by the interpreter's path as a string, however it was passed
+        python = str(python)
+        with self._lock:
+            server = self._servers.get(python)
+            if server is not None and (not server.alive() or server.runs >= self.max_runs
+                                       or server.rss() > self.max_rss):
+                del self._servers[python]
+                server.retire()
+                server = None
+            if server is None:
+                server = self._servers[python] = ForkServer(python, self.preload)
+            return server
+
+    def discard(self, python):
+        """Retire python's server, e.g. after its packages changed."""
+        with self._lock:
+            server = self._servers.pop(str(python), None)
+        if server is not None:
+            server.retire()
+
+    def close(self):
+        with self._lock:
+            servers = list(self._servers.values())
+            self._servers.clear()
+        for server in servers:
+            server.close()
+
+
+def open_warm_pool(**kwargs):
+    pool = WarmPool(**kwargs)
+    atexit.register(pool.close)
+    return pool
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,72 @@
+"""Execution worker: runs the jobs web processes queue on the message queue.
+
+Start web processes with CYBER20UN_EXECUTION=workers and as many of these
+as the hosts have cores for, all with the same CYBER20UN_MESSAGE_QUEUE:
+
+    python mq.py /run/cyber20un/mq.sock
+    CYBER20UN_MESSAGE_QUEUE=unix:///run/cyber20un/mq.sock CYBER20UN_EXECUTION=workers \\
+        CYBER20UN_DEBUG=0 python app.py        # one or more, same port
+    CYBER20UN_MESSAGE_QUEUE=unix:///run/cyber20un/mq.sock python worker.py
+
+Web processes share the port through SO_REUSEPORT; clients stay on one
+websocket, so no sticky routing is needed unless long-polling is
+re-enabled. A worker only takes a job off the queue when it has a free
+slot, and output goes straight to the project's room through the queue;
+input typed into a run reaches it over the control channel.
+Workers read code and environments from the same directories as the web
+processes, so they must share a filesystem with them.
+"""
+import threading
+import time
+
+from app import (MAX_CONCURRENT_RUNS, PROCESS_ID, job_status_sender, message_queue,
+                 project_room, run_job, socketio)
+from mq import CONTROL_CHANNEL
+from scheduler import SchedulerBusy
+
+
+def start(spec, slots):
+    send_status = job_status_sender(spec['user_id'], spec['project_name'])
+    finished = []
+
+    def on_status(job, state, position):
+        send_status(job, state, position)
+        if state in ('done', 'cancelled') and not finished:
+            finished.append(state)
+            slots.release()
+
+    if spec['key'] is not None:
+        spec['key'] = tuple(spec['key'])
+        message_queue.publish(CONTROL_CHANNEL, {'supersede': spec['key'], 'worker': PROCESS_ID})
+    try:
+        run_job(spec, on_status)
+    except SchedulerBusy:
+        socketio.emit('terminal_output', {'output': '[ERROR] Too many runs waiting, try again shortly',
+                                          'terminal': 'out'},
+                      to=project_room(spec['user_id'], spec['project_name']))
+        slots.release()
+
+
+def serve(max_jobs=MAX_CONCURRENT_RUNS):
+    # app.listen_control already handles supersedes and input for our runs
+    slots = threading.Semaphore(max_jobs)
+    print(f'[worker] {PROCESS_ID} taking up to {max_jobs} jobs from {message_queue.url}')
+    while True:
+        slots.acquire()
+        try:
+            spec = message_queue.pop(timeout=1)
+        except (OSError, EOFError) as e:
+            print(f'[worker] message queue unavailable: {e}')
+            slots.release()
+            time.sleep(1)
+            continue
+        if spec is None:
+            slots.release()
+            continue
+        start(spec, slots)
+
+
+if __name__ == '__main__':
+    if message_queue.url is None:
+        raise SystemExit('worker.py needs CYBER20UN_MESSAGE_QUEUE')
+    serve()
@@ -0,0 +1,274 @@
+"""A project's file tree, listed without reading file contents.
+
+Each code_files row carries its size and content hash (kept by
+SAVE_CODE_SQL), and the code_files_tree index covers every column the
+listing reads, so listing a project touches the index only. Edits the
+document cache hasn't snapshotted yet are laid over the rows.
+
+The listing is compact, one [name, size, hash, version, mtime] row per
+file, with hashes cut to HASH_CHARS. Clients fetch file bodies lazily
+and keep them by hash: a hash they already have costs no request, and
+a changed one costs a conditional GET. Names may include directories
+("pkg/util.py") so projects can be split into modules.
+
+Contents live in the blob store (blobstore.py). A snapshot records a
+project's (name, hash) pairs, so history costs a row per file and no
+content. The directory a run or shell works in (user_codes/<user_id>/)
+is a checkout of the project's hashes: a file is only written when its
+hash differs from what is on disk, right before something reads it,
+instead of on every save.
+"""
+import hashlib
+import os
+from pathlib import Path
+from stat import S_ISREG
+
+from blobstore import encode_content
+from runcache import FileDigests
+
+TREE_SQL = '''SELECT filename, size, hash, version, CAST(strftime('%s', updated_at) AS INTEGER)
+              FROM code_files WHERE user_id = ? AND project_name = ?
+              ORDER BY filename'''
+ENTRY_SQL = '''SELECT filename, size, hash, version, CAST(strftime('%s', updated_at) AS INTEGER)
+               FROM code_files WHERE user_id = ? AND project_name = ? AND filename = ?'''
+
+FIELDS = ('name', 'size', 'hash', 'version', 'mtime')
+# 64 bits: ample to tell versions of one file apart, and short on the wire
+HASH_CHARS = 16
+MAX_PATH = 255
+MAX_DEPTH = 8
+# Automatic snapshots (one per run that changed the files) kept per
+# project; labelled ones are kept until the project is purged
+KEEP_SNAPSHOTS = 50
+
+SNAPSHOT_ROWS_SQL = '''SELECT filename, hash, size FROM code_files
+                       WHERE user_id = ? AND project_name = ? AND hash IS NOT NULL
+                       ORDER BY filename'''
+LATEST_SNAPSHOT_SQL = '''SELECT id, tree FROM project_snapshots
+                         WHERE user_id = ? AND project_name = ? ORDER BY id DESC LIMIT 1'''
+SNAPSHOTS_SQL = '''SELECT id, label, files, bytes, created_at FROM project_snapshots
+                   WHERE user_id = ? AND project_name = ? ORDER BY id DESC LIMIT ?'''
+SNAPSHOT_FILES_SQL = '''SELECT f.filename, b.size, f.hash FROM project_snapshots s
+                        JOIN snapshot_files f ON f.snapshot_id = s.id
+                        LEFT JOIN blobs b ON b.hash = f.hash
+                        WHERE s.id = ? AND s.user_id = ? AND s.project_name = ?
+                        ORDER BY f.filename'''
+PRUNE_SNAPSHOTS_SQL = '''DELETE FROM project_snapshots
+                         WHERE user_id = ? AND project_name = ? AND label IS NULL
+                         AND id NOT IN (SELECT id FROM project_snapshots
+                                        WHERE user_id = ? AND project_name = ? AND label IS NULL
+                                        ORDER BY id DESC LIMIT ?)'''
+RESTORE_SQL = '''INSERT INTO code_files (user_id, filename, content, project_name, version, size, hash)
+                 SELECT ?, f.filename, NULL, ?, 1, b.size, f.hash
+                 FROM snapshot_files f JOIN blobs b ON b.hash = f.hash
+                 WHERE f.snapshot_id = ?
+                 ON CONFLICT (user_id, filename, project_name)
+                 DO UPDATE SET content = NULL, hash = excluded.hash, size = excluded.size,
+                               version = version + 1
+                 WHERE hash IS NOT excluded.hash'''
+
+
+class BadPath(ValueError):
+    """A file name that would leave the project directory, or is malformed."""
+
+
+def clean_path(name):
+    """The project-relative path for a client-supplied file name.
+
+    Directories are separated by '/'; absolute paths, '.' and '..'
+    parts, backslashes and control characters are refused.
+    """
+    if not isinstance(name, str) or not name.strip():
+        raise BadPath('empty file name')
+    if len(encode_content(name)) > MAX_PATH:
+        raise BadPath('file name too long')
+    if name.startswith('/') or '\\' in name or any(ord(c) < 32 for c in name):
+        raise BadPath(f'invalid file name: {name!r}')
+    parts = name.split('/')
+    if len(parts) > MAX_DEPTH:
+        raise BadPath('too many directories')
+    for part in parts:
+        if part in ('', '.', '..') or part != part.strip():
+            raise BadPath(f'invalid file name: {name!r}')
+    return '/'.join(parts)
+
+
+def short_hash(value):
+    return value[:HASH_CHARS] if value else None
+
+
+def tree_hash(rows):
+    """One hash for a list of (name, hash, ...) rows sorted by name."""
+    h = hashlib.sha256()
+    for name, digest, *_ in rows:
+        h.update(f'{name}\0{digest}\0'.encode('utf-8', 'surrogatepass'))
+    return h.hexdigest()
+
+
+def _snapshot(conn, user_id, project_name, label, keep):
+    rows = conn.execute(SNAPSHOT_ROWS_SQL, (user_id, project_name)).fetchall()
+    tree = tree_hash(rows)
+    latest = conn.execute(LATEST_SNAPSHOT_SQL, (user_id, project_name)).fetchone()
+    if label is None and latest is not None and latest[1] == tree:
+        # Nothing changed since the last one
+        return latest[0], False
+    snapshot_id = conn.execute('''INSERT INTO project_snapshots
+                                  (user_id, project_name, tree, label, files, bytes)
+                                  VALUES (?, ?, ?, ?, ?, ?)''',
+                               (user_id, project_name, tree, label, len(rows),
+                                sum(size or 0 for _, _, size in rows))).lastrowid
+    conn.executemany('INSERT INTO snapshot_files (snapshot_id, filename, hash) VALUES (?, ?, ?)',
+                     [(snapshot_id, name, digest) for name, digest, _ in rows])
+    conn.execute(PRUNE_SNAPSHOTS_SQL, (user_id, project_name, user_id, project_name, keep))
+    return snapshot_id, True
+
+
+def _restore(conn, user_id, project_name, snapshot_id):
+    names = [row[0] for row in conn.execute(
+        '''SELECT f.filename FROM snapshot_files f JOIN project_snapshots s ON s.id = f.snapshot_id
+           WHERE s.id = ? AND s.user_id = ? AND s.project_name = ?''',
+        (snapshot_id, user_id, project_name))]
+    if not names:
+        return None
+    conn.execute(RESTORE_SQL, (user_id, project_name, snapshot_id))
+    # Edits logged against the replaced versions no longer apply
+    conn.executemany('''DELETE FROM code_file_ops
+                        WHERE user_id = ? AND project_name = ? AND filename = ?''',
+                     [(user_id, project_name, name) for name in names])
+    return names
+
+
+class Workspace:
+    """Projects' file listings, snapshots and on-disk checkouts."""
+
+    def __init__(self, database, documents, blobs, keep_snapshots=KEEP_SNAPSHOTS):
+        self.database = database
+        self.documents = documents
+        self.blobs = blobs
+        self.keep_snapshots = keep_snapshots
+        self.disk = FileDigests()
+        self.checkouts = 0
+        self.files_written = 0
+        self.bytes_written = 0
+
+    def _pending(self, user_id, project_name):
+        # Cached documents the rows don't reflect yet; ones loaded for a
+        # name that was never saved (version 0) aren't files
+        return {doc.key[2]: doc for doc in self.documents.project_documents(user_id, project_name)
+                if doc.dirty and doc.version}
+
+    @staticmethod
+    def _doc_row(doc):
+        size, digest = doc.digest()
+        return [doc.key[2], size, short_hash(digest), doc.version, int(doc.modified)]
+
+    def files(self, user_id, project_name):
+        """Listing rows (see FIELDS), sorted by name."""
+        pending = self._pending(user_id, project_name)
+        with self.database.reader() as conn:
+            rows = conn.execute(TREE_SQL, (user_id, project_name)).fetchall()
+        files = []
+        for name, size, digest, version, mtime in rows:
+            doc = pending.pop(name, None)
+            files.append(self._doc_row(doc) if doc is not None
+                         else [name, size, short_hash(digest), version or 0, mtime])
+        if pending:
+            files.extend(self._doc_row(doc) for doc in pending.values())
+            files.sort(key=lambda row: row[0])
+        return files
+
+    def entry(self, user_id, project_name, filename):
+        """The listing row of one file, or None if there is no such file."""
+        doc = self._pending(user_id, project_name).get(filename)
+        if doc is not None:
+            return self._doc_row(doc)
+        with self.database.reader() as conn:
+            row = conn.execute(ENTRY_SQL, (user_id, project_name, filename)).fetchone()
+        if row is None:
+            return None
+        name, size, digest, version, mtime = row
+        return [name, size, short_hash(digest), version or 0, mtime]
+
+    def snapshot(self, user_id, project_name, label=None):
+        """Record the saved files as a snapshot; (id, created).
+
+        Without a label, nothing is recorded if the files are the same as
+        in the latest snapshot.
+        """
+        return self.database.write(_snapshot, user_id, project_name, label, self.keep_snapshots)
+
+    def snapshot_behind(self, user_id, project_name):
+        """snapshot(), queued on the writer thread; returns a Future.
+
+        Writes queued before it (saved documents) are in the snapshot.
+        """
+        return self.database.submit(_snapshot, user_id, project_name, None, self.keep_snapshots)
+
+    def snapshots(self, user_id, project_name, limit=100):
+        with self.database.reader() as conn:
+            rows = conn.execute(SNAPSHOTS_SQL, (user_id, project_name, limit)).fetchall()
+        return [{'id': snapshot_id, 'label': label, 'files': files, 'bytes': size,
+                 'created_at': created_at}
+                for snapshot_id, label, files, size, created_at in rows]
+
+    def snapshot_files(self, user_id, project_name, snapshot_id):
+        """[name, size, hash] rows of a snapshot; [] if the project has no such snapshot."""
+        with self.database.reader() as conn:
+            rows = conn.execute(SNAPSHOT_FILES_SQL,
+                                (snapshot_id, user_id, project_name)).fetchall()
+        return [[name, size, short_hash(digest)] for name, size, digest in rows]
+
+    def restore(self, user_id, project_name, snapshot_id):
+        """Put a snapshot's files back; returns their names, or None if there is no such snapshot.
+
+        Files created since the snapshot are kept. Cached documents of the
+        project are dropped so the restored contents are loaded.
+        """
+        self.documents.snapshot_project(user_id, project_name)
+        names = self.database.write(_restore, user_id, project_name, snapshot_id)
+        if names is not None:
+            self.documents.forget_project(user_id, project_name)
+        return names
+
+    def checkout(self, user_id, project_name, root):
+        """Write the project's saved files under root where they differ; returns files written.
+
+        Files on disk that aren't in the project (made by a run, say)
+        are left alone.
+        """
+        root = Path(root)
+        with self.database.reader() as conn:
+            rows = conn.execute(TREE_SQL, (user_id, project_name)).fetchall()
+        written = 0
+        for name, _, digest, _, _ in rows:
+            path = root / name
+            try:
+                stat = os.stat(path)
+                if S_ISREG(stat.st_mode) and digest and self.disk.digest(str(path), stat).hex() == digest:
+                    continue
+            except OSError:
+                pass
+            data = self.blobs.read_file(user_id, project_name, name)
+            if data is None:
+                # Deleted since we listed it
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Replace, don't rewrite: a running script may have it open
+            temp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+            if digest:
+                self.disk.remember(str(path), os.stat(path), bytes.fromhex(digest))
+            written += 1
+            self.bytes_written += len(data)
+        self.checkouts += 1
+        self.files_written += written
+        return written
+
+    def stats(self):
+        return {
+            'checkouts': self.checkouts,
+            'files_written': self.files_written,
+            'bytes_written': self.bytes_written,
+        }